@@ -0,0 +1,195 @@
+"""
+miniwdl download plugin for http:// and https:// URIs using aria2 -- https://aria2.github.io/
+Runs aria2c from the miniwdl process itself (it's installed in the swipe image), rather than in a
+container, downloading each file in [aria2] connections (default 16) segments fetched in parallel
+by range requests.
+
+Partial downloads are kept in a work directory named after the URI, so that a retried download
+resumes where the last attempt left off (unless the server reports a different ETag or length by
+then). The work directory is under the download cache directory if it's enabled, so that miniwdl
+can move the completed file into the cache, otherwise under [aria2] dir (default /mnt). Concurrent
+downloads of the same URI are serialized by a lockfile next to the work directory, which the
+holder removes when it's done. The completed file is moved into a directory of its own alongside,
+which is removed when the miniwdl process exits (by when miniwdl has either moved the file into its
+download cache, or finished using it).
+
+The completed file is verified against the length reported by the server, and against its MD5 if
+the server reports one, either as Content-MD5, as an x-goog-hash, or as the ETag of a (non-
+multipart) object served by Amazon S3.
+
+The plugin is installed using the "entry points" mechanism in setup.py. Furthermore, the miniwdl
+configuration [plugins] section has options to enable/disable installed plugins. Installed &
+enabled plugins can be observed using miniwdl --version and/or miniwdl run --debug.
+"""
+
+import os
+import re
+import fcntl
+import atexit
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+import urllib.request
+from base64 import b64decode
+from typing import Dict, List, Optional
+from urllib.error import URLError
+from urllib.parse import urlparse
+
+from WDL.runtime import config
+from WDL.runtime.error import DownloadFailed
+from WDL._util import StructuredLogMessage as _
+
+
+def main(cfg, logger, uri, **kwargs):
+    yield {"outputs": {"file": download(cfg, logger, uri)}}
+
+
+def get_option(cfg: config.Loader, key: str, default: str) -> str:
+    return cfg["aria2"][key] if cfg.has_option("aria2", key) else default
+
+
+def head(uri: str) -> Dict[str, str]:
+    """
+    response headers to a HEAD request (lowercased), or none if the server doesn't answer it (e.g.
+    a presigned URL valid only for GET)
+    """
+    try:
+        with urllib.request.urlopen(urllib.request.Request(uri, method="HEAD"), timeout=60) as response:
+            return {k.lower(): v for k, v in response.headers.items()}
+    except (URLError, OSError):
+        return {}
+
+
+def expected_md5(headers: Dict[str, str]) -> Optional[str]:
+    if "content-md5" in headers:
+        return b64decode(headers["content-md5"]).hex()
+    goog_md5 = re.search(r"md5=([A-Za-z0-9+/=]+)", headers.get("x-goog-hash", ""))
+    if goog_md5:
+        return b64decode(goog_md5.group(1)).hex()
+    etag = headers.get("etag", "").strip('"')
+    if ("x-amz-request-id" in headers or headers.get("server") == "AmazonS3") and re.fullmatch(
+        "[0-9a-f]{32}", etag
+    ):
+        return etag
+    return None
+
+
+def download(cfg: config.Loader, logger, uri: str) -> str:
+    headers = head(uri)
+    if cfg["download_cache"].get_bool("put"):
+        # work on the download cache's filesystem, from which miniwdl moves the file into place
+        base = os.path.join(cfg["download_cache"]["dir"], "ops")
+    else:
+        base = get_option(cfg, "dir", "/mnt")
+    work_dir = os.path.join(base, "aria2", hashlib.sha256(uri.encode()).hexdigest()[:32])
+    os.makedirs(os.path.dirname(work_dir), exist_ok=True)
+    # serialize concurrent downloads of the same URI (e.g. by other runs on this host) on the work dir
+    lock_fn = work_dir + ".lock"
+    while True:
+        with open(lock_fn, "w") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            if not same_file(lock_fn, lockfile.fileno()):
+                # removed by the download we waited on; lock afresh
+                continue
+            try:
+                return download_locked(cfg, logger, uri, headers, base, work_dir)
+            finally:
+                # remove the lockfile while still holding it, so that it doesn't accumulate
+                os.unlink(lock_fn)
+
+
+def same_file(fn: str, fd: int) -> bool:
+    try:
+        st = os.stat(fn)
+    except FileNotFoundError:
+        return False
+    fst = os.fstat(fd)
+    return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+
+def download_locked(cfg: config.Loader, logger, uri: str, headers: Dict[str, str], base: str, work_dir: str) -> str:
+    length = int(headers["content-length"]) if "content-length" in headers else None
+    md5 = expected_md5(headers)
+    os.makedirs(work_dir, exist_ok=True)
+    fn = os.path.basename(urlparse(uri).path) or "index.html"
+
+    # resume a previous partial download only if it was of the same version of the file
+    version = {"etag": headers.get("etag"), "length": length}
+    version_fn = os.path.join(work_dir, "version.json")
+    if os.path.exists(version_fn):
+        with open(version_fn) as infile:
+            if json.load(infile) != version:
+                logger.info(_("discarding partial download of a different version", uri=uri))
+                for leftover in os.listdir(work_dir):
+                    os.remove(os.path.join(work_dir, leftover))
+    with open(version_fn, "w") as outfile:
+        json.dump(version, outfile)
+
+    connections = get_option(cfg, "connections", "16")
+    cmd = [
+        "aria2c",
+        "-x", connections,
+        "-s", connections,
+        "--min-split-size", get_option(cfg, "min_split_size", "8M"),
+        "--continue=true",
+        "--auto-file-renaming=false",
+        "--allow-overwrite=true",
+        "--file-allocation=none",
+        "--max-tries=5",
+        "--retry-wait=2",
+        "--summary-interval=0",
+        "--console-log-level=warn",
+        "--enable-color=false",
+        "-d", work_dir,
+        "-o", fn,
+    ]
+    if md5:
+        cmd.append(f"--checksum=md5={md5}")
+    cmd.append(uri)
+    logger.info(_("aria2c", uri=uri, length=length, md5=md5, resume=os.path.exists(os.path.join(work_dir, fn))))
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    if proc.returncode != 0:
+        if proc.returncode == 32:
+            # checksum mismatch: discard the file rather than resuming from it next time
+            shutil.rmtree(work_dir, ignore_errors=True)
+        logger.error(_("aria2c failed", uri=uri, exit_status=proc.returncode, output=proc.stdout[-4096:]))
+        raise DownloadFailed(uri)
+
+    downloaded = os.path.join(work_dir, fn)
+    if length is not None and os.path.getsize(downloaded) != length:
+        # discard it rather than resuming from a corrupt file next time
+        shutil.rmtree(work_dir, ignore_errors=True)
+        logger.error(_("downloaded file has the wrong length", uri=uri, expected=length))
+        raise DownloadFailed(uri)
+
+    # move the completed file out of the work directory, onto the same filesystem
+    dn = download_dir(base)
+    os.rename(downloaded, os.path.join(dn, fn))
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return os.path.join(dn, fn)
+
+
+_download_dirs: List[str] = []
+_download_dirs_lock = threading.Lock()
+
+
+def download_dir(base: str) -> str:
+    """
+    a new directory under base for one completed download, which is removed when this process exits
+    """
+    with _download_dirs_lock:
+        if not _download_dirs:
+            atexit.register(remove_download_dirs)
+        dn = tempfile.mkdtemp(prefix="aria2_", dir=base)
+        _download_dirs.append(dn)
+        return dn
+
+
+def remove_download_dirs() -> None:
+    with _download_dirs_lock:
+        for dn in _download_dirs:
+            shutil.rmtree(dn, ignore_errors=True)
+        _download_dirs.clear()
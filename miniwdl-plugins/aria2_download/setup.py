@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+from setuptools import setup
+from os import path
+
+this_directory = path.abspath(path.dirname(__file__))
+with open(path.join(path.dirname(__file__), "README.md")) as f:
+    long_description = f.read()
+
+setup(
+    name="miniwdl-aria2",
+    version="0.0.1",
+    url="https://github.com/chanzuckerberg/swipe",
+    project_urls={
+        "Documentation": "https://github.com/chanzuckerberg/swipe",
+        "Source Code": "https://github.com/chanzuckerberg/swipe",
+        "Issue Tracker": "https://github.com/chanzuckerberg/swipe/issues"
+    },
+    description="miniwdl download plugin for http:// and https:// using aria2",
+    long_description=long_description,
+    long_description_content_type="text/markdown",
+    py_modules=["miniwdl_aria2"],
+    python_requires=">=3.6",
+    setup_requires=["reentry"],
+    reentry_register=True,
+    entry_points={
+        "miniwdl.plugin.file_download": [
+            "https = miniwdl_aria2:main",
+            "http = miniwdl_aria2:main",
+        ],
+    }
+)
@@ -2,7 +2,37 @@
 miniwdl download plugin for s3:// URIs using s3parcp -- https://github.com/chanzuckerberg/s3parcp
 Requires s3parcp docker image tag supplied in miniwdl configuration, either via custom cfg file
 (section s3parcp, key docker_image) or environment variable MINIWDL__S3PARCP__DOCKER_IMAGE.
-Inherits AWS credentials from miniwdl's environment (as detected by boto3).
+Inherits AWS credentials from miniwdl's environment (as detected by boto3), which are kept fresh
+in a directory under [s3parcp] dir shared by all the download containers (see CredentialBroker).
+
+With [s3parcp] batch_downloads = true, the URIs whose downloads start within batch_window_seconds
+(default 1.0) of each other are downloaded together by one s3parcp container, sharing its budget of
+concurrent part transfers, instead of starting a container for each. This helps when miniwdl
+downloads a workflow's inputs concurrently (up to [scheduler] download_concurrency at once). Each
+URI is still handed back to miniwdl individually, so it's stored in the download cache as usual.
+
+Objects smaller than [s3parcp] inprocess_max_bytes (default 16 MiB; 0 to disable), as found by a
+HEAD request, skip the container altogether: they're streamed by the miniwdl process itself with a
+pooled boto3 client, verified against their size and (non-multipart) ETag, and handed back to
+miniwdl directly. They're staged under the download cache directory if it's enabled (so they can be
+moved into it), otherwise under [s3parcp] dir, in a directory removed when miniwdl exits. The same
+HEAD request tells whether the object has the CRC32C checksum metadata written by s3parcp's uploads
+(and the s3upload plugin's); s3parcp is always asked to verify it (--checksum) if so, and otherwise
+not, since it'd fail on objects uploaded by other means.
+
+The s3parcp container's part size, concurrent part transfers, CPU and memory reservation are sized
+from the object's size (and for a batch, from the total size): small objects reserve one CPU and
+1G, while large ones get up to [s3parcp] max_concurrency (default 32) parts in flight, using up to
+max_cpu (default 8) CPUs and max_memory_gb (default 8) of memory for part buffers.
+
+Also provides a directory download plugin for s3:// prefixes (WDL Directory inputs), which lists the
+prefix (each immediate subfolder concurrently) and downloads all its objects in-process on a pool of
+[s3parcp] directory_concurrency (default 32) threads. When the download cache is enabled, each
+version of a directory's content is also kept under the cache directory's _s3dir/ subfolder, keyed
+by the prefix and a fingerprint of the listing (keys, sizes & ETags), so that downloading unchanged
+content again just hardlinks the stored copy. (miniwdl's own download cache is keyed by URI only.)
+The stored copy is flocked while in use, like miniwdl's cache entries, so that the download cache
+manager doesn't evict it meanwhile.
 
 The plugin is installed using the "entry points" mechanism in setup.py. Furthermore, the miniwdl
 configuration [plugins] section has options to enable/disable installed plugins. Installed &
@@ -10,53 +40,489 @@ enabled plugins can be observed using miniwdl --version and/or miniwdl run --deb
 """
 
 import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
 import tempfile
+import threading
+import atexit
 import boto3
+import botocore
 
-from typing import Dict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from WDL.runtime import config
+from WDL.runtime.error import DownloadFailed
+from WDL._util import StructuredLogMessage as _
+from botocore.config import Config  # type: ignore
 
 
 def main(cfg, logger, uri, **kwargs):
-    # get AWS credentials from boto3
-    b3 = boto3.session.Session()
-    b3creds = b3.get_credentials()
-    aws_credentials: Dict[str, str] = {
-        "AWS_ACCESS_KEY_ID": b3creds.access_key,
-        "AWS_SECRET_ACCESS_KEY": b3creds.secret_key,
+    inprocess_max_bytes = 16 * 1024 * 1024
+    if cfg.has_option("s3parcp", "inprocess_max_bytes"):
+        inprocess_max_bytes = cfg["s3parcp"].get_int("inprocess_max_bytes")
+    size = object_size(uri)
+    if size is not None and size < inprocess_max_bytes:
+        yield {"outputs": {"file": download_inprocess(cfg, logger, uri)}}
+        return
+
+    if cfg.has_option("s3parcp", "batch_downloads") and cfg["s3parcp"].get_bool("batch_downloads"):
+        yield from batch_download(cfg, logger, uri)
+        return
+
+    broker = credential_broker(cfg, logger)
+    # yield WDL task and inputs (followed by outputs as well)
+    recv = yield {
+        "task_wdl": wdl,
+        "inputs": {
+            "uri": uri,
+            "checksum_arg": checksum_arg([uri]),
+            "aws_credentials": broker.dir,
+            "aws_region": broker.region,
+            "docker": cfg["s3parcp"]["docker_image"],
+            **download_resources(cfg, size),
+        },
     }
-    if b3creds.token:
-        aws_credentials["AWS_SESSION_TOKEN"] = b3creds.token
-
-    # s3parcp (or perhaps underlying golang AWS lib) seems to require region set to match the
-    # bucket's; in contrast to awscli which can conveniently 'figure it out'
-    aws_credentials["AWS_REGION"] = b3.region_name if b3.region_name else "us-west-2"
-
-    # format them as env vars to be sourced in the WDL task command
-    aws_credentials_str = "\n".join(f"export {k}='{v}'" for (k, v) in aws_credentials.items())
-
-    # write them to a temp file that'll self-destruct automatically
-    temp_dir = "/mnt"
-    if cfg.has_option("s3parcp", "dir"):
-        temp_dir = cfg["s3parcp"]["dir"]
-    with tempfile.NamedTemporaryFile(
-        prefix="miniwdl_download_s3parcp_credentials_", delete=True, mode="w", dir=temp_dir
-    ) as aws_credentials_file:
-        print(aws_credentials_str, file=aws_credentials_file, flush=True)
-        # make file group-readable to ensure it'll be usable if the docker image runs as non-root
-        os.chmod(aws_credentials_file.name, os.stat(aws_credentials_file.name).st_mode | 0o40)
-
-        # yield WDL task and inputs (followed by outputs as well)
+
+    # yield task outputs (unchanged)
+    yield recv
+
+
+class CredentialBroker:
+    """
+    Resolves the AWS credentials once, and keeps them fresh (refreshing them before they expire) in
+    a shared directory, which the download containers mount to read them as a credential_process.
+    The AWS SDK in the container then rereads them upon their expiration, so that a transfer can
+    outlast the session token it started with.
+    """
+
+    def __init__(self, logger, temp_dir: str) -> None:
+        self._logger = logger
+        session = boto3.session.Session()
+        self._credentials = session.get_credentials()
+        # s3parcp (or perhaps underlying golang AWS lib) seems to require region set to match the
+        # bucket's; in contrast to awscli which can conveniently 'figure it out'
+        self.region = session.region_name if session.region_name else "us-west-2"
+        self._lock = threading.Lock()
+        self.dir = tempfile.mkdtemp(prefix="miniwdl_download_s3parcp_credentials_", dir=temp_dir)
+        # make it group-readable to ensure it'll be usable if the docker image runs as non-root
+        os.chmod(self.dir, 0o750)
+        atexit.register(shutil.rmtree, self.dir, True)
+        self.refresh()
+        threading.Thread(target=self._refresh_loop, daemon=True).start()
+
+    def refresh(self) -> None:
+        with self._lock:
+            # botocore refreshes expiring credentials as they're frozen
+            frozen = self._credentials.get_frozen_credentials()
+            doc = {"Version": 1, "AccessKeyId": frozen.access_key, "SecretAccessKey": frozen.secret_key}
+            if frozen.token:
+                doc["SessionToken"] = frozen.token
+            expiry = getattr(self._credentials, "_expiry_time", None)
+            if expiry:
+                doc["Expiration"] = expiry.isoformat()
+            # replace the file atomically, so that a container never reads it half-written
+            tmp = os.path.join(self.dir, ".credentials.json.tmp")
+            with open(tmp, "w") as outfile:
+                json.dump(doc, outfile)
+            os.chmod(tmp, 0o640)
+            os.replace(tmp, os.path.join(self.dir, "credentials.json"))
+
+    def _refresh_loop(self) -> None:
+        while True:
+            time.sleep(60)
+            try:
+                self.refresh()
+            except Exception as exn:
+                self._logger.warning(_("failed to refresh AWS credentials for s3parcp", error=str(exn)))
+
+
+_credential_broker: Optional[CredentialBroker] = None
+_credential_broker_lock = threading.Lock()
+
+
+def credential_broker(cfg: config.Loader, logger) -> CredentialBroker:
+    global _credential_broker
+    with _credential_broker_lock:
+        if _credential_broker is None:
+            temp_dir = "/mnt"
+            if cfg.has_option("s3parcp", "dir"):
+                temp_dir = cfg["s3parcp"]["dir"]
+            _credential_broker = CredentialBroker(logger, temp_dir)
+        return _credential_broker
+
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+def s3_client():
+    # boto3 clients are thread-safe, so all downloads share one (and its connection pool)
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is None:
+            _s3_client = boto3.session.Session().client(
+                "s3",
+                endpoint_url=os.getenv("AWS_ENDPOINT_URL"),
+                config=Config(max_pool_connections=32, retries={"max_attempts": 5}),
+            )
+        return _s3_client
+
+
+# uri -> (size, whether the object carries the CRC32C checksum metadata s3parcp --checksum verifies)
+_heads: Dict[str, Tuple[int, bool]] = {}
+_heads_lock = threading.Lock()
+
+
+def head(uri: str) -> Optional[Tuple[int, bool]]:
+    """
+    size of the S3 object and whether it has checksum metadata, as found by a HEAD request; or None
+    if it can't be HEADed (leaving the container to report any error)
+    """
+    with _heads_lock:
+        if uri in _heads:
+            return _heads[uri]
+    parsed = urlparse(uri)
+    try:
+        obj = s3_client().head_object(Bucket=parsed.netloc, Key=parsed.path.lstrip("/"))
+    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError):
+        return None
+    found = (obj["ContentLength"], any("crc32c" in key.lower() for key in obj.get("Metadata", {})))
+    with _heads_lock:
+        _heads[uri] = found
+    return found
+
+
+def object_size(uri: str) -> Optional[int]:
+    found = head(uri)
+    return found[0] if found else None
+
+
+def checksum_arg(uris: List[str]) -> str:
+    """
+    s3parcp --checksum fails on objects lacking its checksum metadata (uploaded by other means than
+    s3parcp or the s3upload plugin), so only ask for it if all the objects have it
+    """
+    return "--checksum" if all((head(uri) or (0, True))[1] for uri in uris) else ""
+
+
+MiB = 1024 * 1024
+GiB = 1024 * MiB
+
+
+def download_resources(cfg: config.Loader, size: Optional[int]) -> Dict[str, int]:
+    """
+    WDL inputs sizing the s3parcp container to download size bytes (leaving the defaults if the
+    size is unknown)
+    """
+    if size is None:
+        return {}
+
+    def option(key: str, default: int) -> int:
+        return cfg["s3parcp"].get_int(key) if cfg.has_option("s3parcp", key) else default
+
+    max_cpu = option("max_cpu", 8)
+    max_concurrency = option("max_concurrency", 32)
+    max_memory_gb = option("max_memory_gb", 8)
+    # aim for a few hundred parts, in parts of 8-64 MiB
+    part_size = 8 * MiB
+    while part_size < 64 * MiB and part_size * 256 < size:
+        part_size *= 2
+    concurrency = max(1, min(-(-size // part_size), max_concurrency))
+    # allow two buffered parts per transfer in flight
+    concurrency = max(1, min(concurrency, max_memory_gb * GiB // (2 * part_size)))
+    memory_gb = max(1, min(-(-2 * concurrency * part_size // GiB), max_memory_gb))
+    # allocating one hardware thread to two concurrent part xfers
+    cpu = max(1, min(-(-concurrency // 2), max_cpu))
+    return {"cpu": cpu, "memory_gb": memory_gb, "concurrency": concurrency, "part_size": part_size}
+
+
+_staging_dirs: Dict[str, str] = {}
+_staging_dirs_lock = threading.Lock()
+
+
+def staging_dir(cfg: config.Loader) -> str:
+    """
+    this process's directory for staging in-process downloads, which is removed when it exits (by
+    when miniwdl has either moved the downloads into its download cache, or finished using them)
+    """
+    if cfg["download_cache"].get_bool("put"):
+        # stage on the download cache's filesystem, from which miniwdl moves downloads into place
+        parent = os.path.join(cfg["download_cache"]["dir"], "ops")
+    else:
+        parent = "/mnt"
+        if cfg.has_option("s3parcp", "dir"):
+            parent = cfg["s3parcp"]["dir"]
+    with _staging_dirs_lock:
+        if parent not in _staging_dirs:
+            if not _staging_dirs:
+                atexit.register(remove_staging_dirs)
+            os.makedirs(parent, exist_ok=True)
+            _staging_dirs[parent] = tempfile.mkdtemp(prefix="s3parcp_staging_", dir=parent)
+        else:
+            # miniwdl moves downloads into its cache with os.renames, which removes the source's
+            # parent directories left empty -- including this one, once it held only that download
+            os.makedirs(_staging_dirs[parent], exist_ok=True)
+        return _staging_dirs[parent]
+
+
+def staging_subdir(cfg: config.Loader, prefix: str) -> str:
+    """
+    a new directory under staging_dir(cfg) for one download
+    """
+    while True:
+        try:
+            return tempfile.mkdtemp(prefix=prefix, dir=staging_dir(cfg))
+        except FileNotFoundError:
+            # the staging directory was removed in between (see above)
+            pass
+
+
+def remove_staging_dirs() -> None:
+    with _staging_dirs_lock:
+        for staging in _staging_dirs.values():
+            shutil.rmtree(staging, ignore_errors=True)
+        _staging_dirs.clear()
+
+
+def fetch_object(bucket: str, key: str, fn: str) -> int:
+    """
+    stream the S3 object to fn, verifying its size and (where it's the content MD5) ETag; returns
+    the size
+    """
+    obj = s3_client().get_object(Bucket=bucket, Key=key)
+    etag = obj["ETag"].strip('"')
+    if "-" in etag or obj.get("ServerSideEncryption") == "aws:kms" or "SSECustomerAlgorithm" in obj:
+        # the ETag of an object uploaded in parts, or encrypted with KMS or a customer key, isn't
+        # the MD5 of its content
+        etag = ""
+    md5 = hashlib.md5()
+    received = 0
+    with open(fn, "wb") as outfile:
+        for chunk in iter(lambda: obj["Body"].read(1024 * 1024), b""):
+            md5.update(chunk)
+            received += len(chunk)
+            outfile.write(chunk)
+    if received != obj["ContentLength"] or (etag and md5.hexdigest() != etag):
+        raise DownloadFailed(f"s3://{bucket}/{key}")
+    return received
+
+
+def download_inprocess(cfg: config.Loader, logger, uri: str) -> str:
+    parsed = urlparse(uri)
+    dn = staging_subdir(cfg, "s3parcp_inprocess_")
+    fn = os.path.join(dn, os.path.basename(parsed.path))
+    try:
+        received = fetch_object(parsed.netloc, parsed.path.lstrip("/"), fn)
+    except BaseException:
+        shutil.rmtree(dn, ignore_errors=True)
+        raise
+    logger.info(_("downloaded in-process", uri=uri, bytes=received))
+    return fn
+
+
+def directory_main(cfg, logger, uri, **kwargs):
+    """
+    directory download plugin for s3:// URIs (prefixes), downloading in-process
+    """
+    yield {"outputs": {"directory": download_directory(cfg, logger, uri)}}
+
+
+def list_prefix(bucket: str, prefix: str, pool: ThreadPoolExecutor) -> List[Dict]:
+    """
+    list all the objects under the prefix, listing each of its immediate subfolders concurrently
+    """
+    paginator = s3_client().get_paginator("list_objects_v2")
+    objects: List[Dict] = []
+    subfolders: List[str] = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter="/"):
+        objects.extend(page.get("Contents", []))
+        subfolders.extend(common_prefix["Prefix"] for common_prefix in page.get("CommonPrefixes", []))
+
+    def list_subfolder(subfolder: str) -> List[Dict]:
+        return [
+            obj for page in paginator.paginate(Bucket=bucket, Prefix=subfolder) for obj in page.get("Contents", [])
+        ]
+
+    for subfolder_objects in pool.map(list_subfolder, subfolders):
+        objects.extend(subfolder_objects)
+    return objects
+
+
+def download_directory(cfg: config.Loader, logger, uri: str) -> str:
+    parsed = urlparse(uri)
+    bucket = parsed.netloc
+    prefix = parsed.path.lstrip("/")
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+    dnm = os.path.basename(prefix.rstrip("/")) or bucket
+    concurrency = 32
+    if cfg.has_option("s3parcp", "directory_concurrency"):
+        concurrency = cfg["s3parcp"].get_int("directory_concurrency")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        files = {}
+        for obj in list_prefix(bucket, prefix, pool):
+            relpath = directory_relpath(prefix, obj["Key"])
+            # skip folder placeholder objects, and any key that would land outside the directory
+            if relpath:
+                files[relpath] = obj
+        # the listing fingerprint identifies this version of the directory's content
+        fingerprint = hashlib.sha256(
+            json.dumps(sorted((relpath, obj["Size"], obj["ETag"]) for relpath, obj in files.items())).encode()
+        ).hexdigest()
+
+        store = None
+        if cfg["download_cache"].get_bool("put"):
+            store = os.path.join(
+                cfg["download_cache"]["dir"],
+                "_s3dir",
+                bucket,
+                hashlib.sha256(prefix.encode()).hexdigest()[:16],
+                fingerprint,
+            )
+        staged = staging_subdir(cfg, "s3parcp_directory_")
+        # hold a shared flock on the stored copy while using it, as miniwdl does on its download
+        # cache entries, so that the download cache manager doesn't evict it meanwhile
+        lockfile = flock_shared(store + "._miniwdl_flock") if store else None
+        try:
+            if store and os.path.isdir(store):
+                logger.info(_("reusing stored directory download", uri=uri, fingerprint=fingerprint))
+                # mark it recently used, for download cache eviction
+                os.utime(store)
+            else:
+                target = staged
+                if store:
+                    os.makedirs(os.path.dirname(store), exist_ok=True)
+                    target = tempfile.mkdtemp(prefix="tmp_", dir=os.path.dirname(store))
+
+                def fetch(relpath: str) -> int:
+                    fn = os.path.join(target, dnm, relpath)
+                    assert fn.startswith(os.path.join(target, dnm, "")), fn
+                    os.makedirs(os.path.dirname(fn), exist_ok=True)
+                    return fetch_object(bucket, files[relpath]["Key"], fn)
+
+                os.makedirs(os.path.join(target, dnm), exist_ok=True)
+                received = sum(pool.map(fetch, files))
+                logger.info(_("downloaded directory in-process", uri=uri, files=len(files), bytes=received))
+                if store:
+                    try:
+                        os.rename(target, store)
+                    except OSError:
+                        # stored concurrently by another download of the same directory content
+                        shutil.rmtree(target, ignore_errors=True)
+            if store:
+                # hardlink the stored copy, which miniwdl will then move into its download cache
+                shutil.copytree(os.path.join(store, dnm), os.path.join(staged, dnm), copy_function=os.link)
+        except BaseException:
+            shutil.rmtree(staged, ignore_errors=True)
+            raise
+        finally:
+            if lockfile:
+                lockfile.close()
+    return os.path.join(staged, dnm)
+
+
+def directory_relpath(prefix: str, key: str) -> Optional[str]:
+    """
+    path of the object's file relative to the downloaded directory, or None if it has none (a folder
+    placeholder) or it'd be outside the directory (e.g. key prefix/../x, or prefix//etc/x)
+    """
+    relpath = os.path.normpath(key[len(prefix):])
+    if key.endswith("/") or os.path.isabs(relpath) or relpath in (".", "..") or relpath.startswith("../"):
+        return None
+    return relpath
+
+
+def flock_shared(fn: str):
+    """
+    open the lockfile fn and take a shared flock on it, waiting for any exclusive one; retries if
+    the lockfile was meanwhile removed (along with the entry it locked)
+    """
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    while True:
+        lockfile = open(fn, "a")
+        fcntl.flock(lockfile, fcntl.LOCK_SH)
+        try:
+            st, fst = os.stat(fn), os.fstat(lockfile.fileno())
+            if (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino):
+                return lockfile
+        except FileNotFoundError:
+            pass
+        lockfile.close()
+
+
+class DownloadBatch:
+    """
+    URIs to be downloaded by one s3parcp container; the first download to join the batch runs the
+    container, and the others wait on their futures for the files it downloaded for them
+    """
+
+    def __init__(self) -> None:
+        self.uris: List[str] = []
+        self.files: Dict[str, "Future[str]"] = {}
+
+
+_batch: Optional[DownloadBatch] = None
+_batch_lock = threading.Lock()
+
+
+def batch_download(cfg, logger, uri):
+    global _batch
+    with _batch_lock:
+        leader = _batch is None
+        if leader:
+            _batch = DownloadBatch()
+        batch = _batch
+        assert batch
+        if uri not in batch.files:
+            batch.uris.append(uri)
+            batch.files[uri] = Future()
+
+    if not leader:
+        # let miniwdl take the file straight from the container run by the batch's leader
+        yield {"outputs": {"file": batch.files[uri].result()}}
+        return
+
+    window = 1.0
+    if cfg.has_option("s3parcp", "batch_window_seconds"):
+        window = cfg["s3parcp"].get_float("batch_window_seconds")
+    time.sleep(window)
+    with _batch_lock:
+        # downloads starting from now on form the next batch
+        _batch = None
+    logger.info(f"downloading {len(batch.uris)} URI(s) with one s3parcp container")
+    sizes = [object_size(batch_uri) for batch_uri in batch.uris]
+    resources = download_resources(cfg, None if None in sizes else sum(size for size in sizes if size))
+
+    try:
+        broker = credential_broker(cfg, logger)
         recv = yield {
-            "task_wdl": wdl,
+            "task_wdl": batch_wdl,
             "inputs": {
-                "uri": uri,
-                "aws_credentials": aws_credentials_file.name,
+                "uris": batch.uris,
+                "checksum_arg": checksum_arg(batch.uris),
+                "aws_credentials": broker.dir,
+                "aws_region": broker.region,
                 "docker": cfg["s3parcp"]["docker_image"],
+                **resources,
             },
         }
+        files = recv["outputs"]["files"]
+        assert len(files) == len(batch.uris)
+        for batch_uri, file in zip(batch.uris, files):
+            batch.files[batch_uri].set_result(file)
+    finally:
+        # if the container failed, so do the downloads waiting on it
+        for batch_uri, future in batch.files.items():
+            if not future.done():
+                future.set_exception(DownloadFailed(batch_uri))
 
-    # yield task outputs (unchanged)
-    yield recv
+    yield {"outputs": {"file": batch.files[uri].result()}, "dir": recv["dir"]}
 
 
 # WDL task source code
@@ -64,19 +530,28 @@ wdl = """
 task s3parcp {
     input {
         String uri
-        File aws_credentials
+        String checksum_arg = "--checksum"
+        Directory aws_credentials
+        String aws_region
         String docker
 
         Int cpu = 4
+        Int memory_gb = cpu
+        # allocating one hardware thread to two concurrent part xfers
+        Int concurrency = cpu * 2
+        Int part_size = 0
     }
 
+    String part_size_arg = if part_size > 0 then "-p ~{part_size}" else ""
+
     command <<<
         set -euo pipefail
-        source "~{aws_credentials}"
+        # the credentials are read as a credential_process, to reread them when they expire
+        printf '[default]\\ncredential_process = cat "%s/credentials.json"\\n' "~{aws_credentials}" > aws_config
+        export AWS_CONFIG_FILE="$(pwd)/aws_config" AWS_SDK_LOAD_CONFIG=1 AWS_REGION="~{aws_region}"
         mkdir __out
         cd __out
-        # allocating one hardware thread to two concurrent part xfers
-        s3parcp --checksum -c ~{cpu*2} "~{uri}" .
+        s3parcp ~{checksum_arg} -c ~{concurrency} ~{part_size_arg} "~{uri}" .
     >>>
 
     output {
@@ -85,7 +560,57 @@ task s3parcp {
 
     runtime {
         cpu: cpu
-        memory: "~{cpu}G"
+        memory: "~{memory_gb}G"
+        docker: docker
+    }
+}
+"""
+
+batch_wdl = """
+task s3parcp_batch {
+    input {
+        Array[String] uris
+        String checksum_arg = "--checksum"
+        Directory aws_credentials
+        String aws_region
+        String docker
+
+        Int cpu = 4
+        Int memory_gb = cpu
+        # allocating one hardware thread to two concurrent part xfers, shared among the files
+        Int concurrency = cpu * 2
+        Int part_size = 0
+    }
+
+    Int parallel = if length(uris) < concurrency then length(uris) else concurrency
+    Int part_concurrency = if concurrency / parallel > 1 then concurrency / parallel else 1
+    String part_args = "-c ~{part_concurrency}" + (if part_size > 0 then " -p ~{part_size}" else "")
+
+    command <<<
+        set -euo pipefail
+        # the credentials are read as a credential_process, to reread them when they expire
+        printf '[default]\\ncredential_process = cat "%s/credentials.json"\\n' "~{aws_credentials}" > aws_config
+        export AWS_CONFIG_FILE="$(pwd)/aws_config" AWS_SDK_LOAD_CONFIG=1 AWS_REGION="~{aws_region}"
+        mkdir __out
+        i=0
+        while read -r uri; do
+            printf '%s\\0%s\\0' "$i" "$uri"
+            i=$((i+1))
+        done < "~{write_lines(uris)}" \\
+            | xargs -0 -n 2 -P ~{parallel} \\
+                sh -c 'mkdir "__out/$0" && cd "__out/$0" && s3parcp ~{checksum_arg} ~{part_args} "$1" .'
+        for ((i = 0; i < ~{length(uris)}; i++)); do
+            ls -d "__out/$i"/*
+        done > files.txt
+    >>>
+
+    output {
+        Array[File] files = read_lines("files.txt")
+    }
+
+    runtime {
+        cpu: cpu
+        memory: "~{memory_gb}G"
         docker: docker
     }
 }
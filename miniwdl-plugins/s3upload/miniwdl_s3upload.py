@@ -6,8 +6,42 @@ To enable, install this plugin (`pip3 install .` & confirm listed by `miniwdl --
 the environment variable MINIWDL__S3_PROGRESSIVE_UPLOAD__URI_PREFIX to a S3 URI prefix under which
 to store the output files (e.g. "s3://my_bucket/workflow123_outputs"). The prefix should be set
 uniquely for each run, to prevent different runs from overwriting each others' outputs.
-Shells out to s3parcp, for which the environment must be set up to authorize upload to the
-specified bucket (without explicit auth-related arguments).
+Uploads in-process with boto3, for which the environment must be set up to authorize upload to
+the specified bucket (without explicit auth-related arguments): a single PUT for files smaller than
+[s3_progressive_upload] multipart_threshold (default 16 MiB), otherwise a multipart upload sending
+up to max_concurrent_parts (default 16) parts of multipart_chunksize (default 16 MiB) at once. Each
+request carries the Content-MD5 of its body, computed as the file is read, so S3 rejects anything
+corrupted in transit, and the object gets the CRC32C metadata s3parcp --checksum writes, so that
+downloads by s3parcp --checksum verify it end to end. Files of at least s3parcp_threshold bytes
+(default 16 GiB), or all files if upload_backend = s3parcp, are instead uploaded by shelling out to
+s3parcp --checksum. Uploads run on
+bounded pools of worker threads shared by all tasks in the run: max_concurrent_uploads (default 8)
+limits concurrent uploads of small files, and max_concurrent_large_uploads (default 2) limits those
+of files at least large_upload_threshold bytes (default 256 MiB).
+With skip_identical_uploads = true, each task's output keys are first checked with concurrent HEAD
+requests, and files whose locally computed ETag matches the existing object's are recorded as
+uploaded without transferring them again (e.g. when resuming after a spot interruption).
+Each upload is also appended to a registry file under [s3_progressive_upload] registry_dir (default
+$MINIWDL_DIR), so that a resumed run on the same instance can still map local files to their S3
+URIs, e.g. to write outputs.s3.json.
+With call_cache_prefetch = true, the call cache entries under the call cache prefix are listed once
+at workflow start and downloaded concurrently in the background (up to
+call_cache_prefetch_max_entries, default 100000), so that lookups are answered from memory instead
+of each making a round trip to S3 (lookups before their entry is fetched make the round trip
+rather than waiting). Unless call_cache_validate = false, a call cache
+hit is accepted only if all the S3 objects its outputs reference still exist (they may have been
+expired by a lifecycle rule on intermediate outputs), as checked by concurrent HEAD requests whose
+results are memoized for call_cache_validate_ttl seconds (default 60). With
+call_cache_content_keys = true, call cache keys digest the content of input files (size & ETag,
+as uploaded by this plugin) instead of their paths or URIs, so that the same data under different
+prefixes still hits; such
+entries are stored under call_cache_content_uri_prefix (if set, e.g. to share them between runs)
+or else the usual prefixes. With call_cache_local_max_bytes set, the local call cache directory is
+pruned to that many bytes (least recently used first) when the top-level workflow finishes; dead
+entries in S3 are collected separately by miniwdl-s3upload-gc (see gc_main).
+With seed_download_cache = true, each uploaded file is also hardlinked (or, across filesystems,
+copied) into the local download cache ([download_cache] dir, if put is enabled) as its S3 URI, so
+that a later stage running on the same host downloads it without a transfer.
 Deposits into each successful task/workflow run directory and S3 folder, an additional file
 outputs.s3.json which copies outputs.json replacing local file paths with the uploaded S3 URIs.
 (The JSON printed to miniwdl standard output keeps local paths.)
@@ -23,13 +57,22 @@ Limitations:
 
 import os
 import re
+import fcntl
+import hashlib
+import shutil
 import subprocess
 import threading
+import time
 import json
 import logging
+import argparse
+from hashlib import sha256
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from urllib.parse import urlparse
-from typing import Dict, Optional, Tuple, Union, Set
+from typing import Any, Dict, List, Optional, Tuple, Union, Set
 import sys
 
 import WDL
@@ -40,15 +83,22 @@ from WDL._util import StructuredLogMessage as _
 
 import boto3
 import botocore
+from botocore.config import Config  # type: ignore
+
+try:
+    from crc32c import crc32c as _crc32c  # type: ignore
+except ImportError:
+    _crc32c = None
 
-s3 = boto3.resource("s3", endpoint_url=os.getenv("AWS_ENDPOINT_URL"))
 s3_client = boto3.client("s3", endpoint_url=os.getenv("AWS_ENDPOINT_URL"))
 
+MiB = 1024 * 1024
+
 
-def s3_object(uri: str):
+def split_s3_uri(uri: str) -> Tuple[str, str]:
     assert uri.startswith("s3://")
     bucket, key = uri.split("/", 3)[2:]
-    return s3.Bucket(bucket).Object(key)
+    return bucket, key
 
 
 def get_s3_put_prefix(cfg: config.Loader) -> str:
@@ -65,6 +115,18 @@ def get_s3_get_prefix(cfg: config.Loader) -> str:
     return s3prefix
 
 
+def get_int_option(cfg: config.Loader, key: str, default: int) -> int:
+    if not cfg.has_option("s3_progressive_upload", key):
+        return default
+    return cfg["s3_progressive_upload"].get_int(key)
+
+
+def get_bool_option(cfg: config.Loader, key: str, default: bool = False) -> bool:
+    if not cfg.has_option("s3_progressive_upload", key):
+        return default
+    return cfg["s3_progressive_upload"].get_bool(key)
+
+
 def tag_temporary_output_files(output_file_set, s3prefix):
     for object_path in _uploaded_files.values():
         if (object_path not in output_file_set) and (object_path not in _processed_files):
@@ -102,42 +164,522 @@ def inode(link: str):
 
 
 _uploaded_files: Dict[Tuple[int, int], str] = {}
-_cached_files: Dict[Tuple[int, int], Tuple[str, Env.Bindings[Value.Base]]] = {}
+# call cache keys waiting on the upload of each file, and the outputs & files still to be uploaded
+# for each of those keys
+_cached_files: Dict[Tuple[int, int], Set[str]] = {}
+_pending_cache_puts: Dict[str, Tuple[Env.Bindings[Value.Base], Set[Tuple[int, int]]]] = {}
 _key_inputs: Dict[str, Env.Bindings[Value.Base]] = {}
 _uploaded_files_lock = threading.Lock()
 _processed_files: Set = set()
 
 
-def cache_put(cfg: config.Loader, logger: logging.Logger, key: str, outputs: Env.Bindings[Value.Base]):
+class UploadRecord:
+    """
+    a file uploaded to S3, identified by its (dev, inode, size, mtime) at the time of upload
+    """
+
+    __slots__ = ("dev", "ino", "size", "mtime_ns", "uri", "etag")
+
+    def __init__(self, dev: int, ino: int, size: int, mtime_ns: int, uri: str, etag: Optional[str]):
+        self.dev = dev
+        self.ino = ino
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.uri = uri
+        self.etag = etag
+
+    def to_json(self) -> str:
+        return json.dumps([self.dev, self.ino, self.size, self.mtime_ns, self.uri, self.etag])
+
+
+class UploadRegistry:
+    """
+    Persistent record of uploaded files, so that the mapping from local files to S3 URIs survives
+    the miniwdl process (e.g. for a run resumed after an interruption). Kept as an append-only log
+    of JSON lines, loaded lazily on first use; a line torn by a crash is ignored on load, and the
+    log is rewritten without superseded records once they make up most of it.
+    """
+
+    def __init__(self, filename: str):
+        self._filename = filename
+        self._records: Optional[Dict[Tuple[int, int], UploadRecord]] = None
+        self._lines = 0
+        self._torn = False
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[Tuple[int, int], UploadRecord]:
+        if self._records is None:
+            self._records = {}
+            try:
+                with open(self._filename) as infile:
+                    for line in infile:
+                        self._torn = not line.endswith("\n")
+                        try:
+                            record = UploadRecord(*json.loads(line))
+                        except (ValueError, TypeError):
+                            continue
+                        self._records[(record.dev, record.ino)] = record
+                        self._lines += 1
+            except FileNotFoundError:
+                Path(self._filename).parent.mkdir(parents=True, exist_ok=True)
+        return self._records
+
+    def get(self, path: str) -> Optional[UploadRecord]:
+        """
+        look up the record of the given file, if it was uploaded and hasn't changed since
+        """
+        st = os.stat(os.path.realpath(path))
+        with self._lock:
+            record = self._load().get((st.st_dev, st.st_ino))
+        if record and record.size == st.st_size and record.mtime_ns == st.st_mtime_ns:
+            return record
+        return None
+
+    def add(self, path: str, uri: str, etag: Optional[str] = None) -> None:
+        st = os.stat(os.path.realpath(path))
+        record = UploadRecord(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, uri, etag)
+        with self._lock:
+            records = self._load()
+            records[(record.dev, record.ino)] = record
+            with open(self._filename, "a") as outfile:
+                # terminate any line torn by a crash, so it doesn't swallow this one
+                outfile.write(("\n" if self._torn else "") + record.to_json() + "\n")
+            self._torn = False
+            self._lines += 1
+            if self._lines > 1000 and self._lines > 2 * len(records):
+                self._compact(records)
+
+    def _compact(self, records: Dict[Tuple[int, int], UploadRecord]) -> None:
+        tmp_filename = self._filename + ".tmp"
+        with open(tmp_filename, "w") as outfile:
+            for record in records.values():
+                outfile.write(record.to_json() + "\n")
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_filename, self._filename)
+        self._lines = len(records)
+
+
+def get_registry_dir(cfg: config.Loader) -> Optional[str]:
+    if cfg.has_option("s3_progressive_upload", "registry_dir"):
+        return cfg["s3_progressive_upload"]["registry_dir"]
+    return os.environ.get("MINIWDL_DIR")
+
+
+_upload_registry: Optional[UploadRegistry] = None
+_upload_registry_lock = threading.Lock()
+
+
+def upload_registry(cfg: config.Loader) -> Optional[UploadRegistry]:
+    """
+    get the registry of files uploaded under the current S3 prefix, or None if there's nowhere to
+    keep it
+    """
+    global _upload_registry
+    with _upload_registry_lock:
+        if _upload_registry is None:
+            registry_dir = get_registry_dir(cfg)
+            if not registry_dir or not cfg.has_option("s3_progressive_upload", "uri_prefix"):
+                return None
+            prefix_digest = sha256(get_s3_put_prefix(cfg).encode()).hexdigest()[:16]
+            _upload_registry = UploadRegistry(
+                os.path.join(registry_dir, "s3_progressive_upload_registry", prefix_digest + ".jsonl")
+            )
+        return _upload_registry
+
+
+def uploaded_uri(cfg: config.Loader, path: str) -> Optional[str]:
+    """
+    look up the S3 URI to which the given local file or directory was uploaded, by this process or
+    (via the registry) an earlier one; call while holding _uploaded_files_lock
+    """
+    key = inode(path)
+    if key in _uploaded_files:
+        return _uploaded_files[key]
+    registry = upload_registry(cfg)
+    record = registry.get(path) if registry and not isinstance(key, str) else None
+    if record:
+        _uploaded_files[key] = record.uri
+        return record.uri
+    return None
+
+
+_upload_pools: Dict[bool, ThreadPoolExecutor] = {}
+_upload_pools_lock = threading.Lock()
+
+
+def upload_pool(cfg: config.Loader, large: bool) -> ThreadPoolExecutor:
+    """
+    get the worker pool shared by all tasks for uploading large or small files, so that the number
+    of concurrent uploads stays bounded however many tasks complete at once
+    """
+    with _upload_pools_lock:
+        if large not in _upload_pools:
+            if large:
+                max_workers = get_int_option(cfg, "max_concurrent_large_uploads", 2)
+            else:
+                max_workers = get_int_option(cfg, "max_concurrent_uploads", 8)
+            _upload_pools[large] = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="s3upload_" + ("large" if large else "small")
+            )
+        return _upload_pools[large]
+
+
+_upload_client = None
+_part_pool: Optional[ThreadPoolExecutor] = None
+_upload_client_lock = threading.Lock()
+
+
+def upload_client(cfg: config.Loader):
+    """
+    get the S3 client & pool of part upload workers shared by all in-process uploads, with enough
+    pooled HTTP connections for every upload worker to have one open
+    """
+    global _upload_client, _part_pool
+    with _upload_client_lock:
+        if _upload_client is None:
+            max_parts = get_int_option(cfg, "max_concurrent_parts", 16)
+            max_connections = (
+                max_parts
+                + get_int_option(cfg, "max_concurrent_uploads", 8)
+                + get_int_option(cfg, "max_concurrent_large_uploads", 2)
+            )
+            # when uploading many small outputs from the same pipeline you end up with a quick
+            #   intense burst of load that can bump into the S3 rate limit; allowing more retries
+            #   should overcome this
+            _upload_client = boto3.client(
+                "s3",
+                endpoint_url=os.getenv("AWS_ENDPOINT_URL"),
+                config=Config(max_pool_connections=max_connections, retries={"max_attempts": 10}),
+            )
+            _part_pool = ThreadPoolExecutor(max_workers=max_parts, thread_name_prefix="s3upload_part")
+        return _upload_client, _part_pool
+
+
+def multipart_chunksize(cfg: config.Loader, size: int) -> int:
+    chunksize = get_int_option(cfg, "multipart_chunksize", 16 * MiB)
+    # S3 allows at most 10,000 parts per upload; grow the parts (in whole MiB) for huge files
+    return max(chunksize, -(-size // (10000 * MiB)) * MiB)
+
+
+def put_chunksize(cfg: config.Loader, size: int) -> int:
+    """
+    the part size with which put_file uploads size bytes (0 for a single PUT)
+    """
+    if size < get_int_option(cfg, "multipart_threshold", 16 * MiB):
+        return 0
+    return multipart_chunksize(cfg, size)
+
+
+def cache_entry(
+    cfg: config.Loader, key: str, outputs: Env.Bindings[Value.Base]
+) -> Optional[Tuple[str, bytes]]:
+    """
+    formulate the S3 URI & body of the call cache entry for the given outputs, once they've all
+    been uploaded (None if there's nothing to write); call while holding _uploaded_files_lock
+    """
     if not (cfg["call_cache"].get_bool("put") and
             cfg["call_cache"]["backend"] == "s3_progressive_upload_call_cache_backend"):
-        return
+        return None
 
     missing = False
 
     def cache(v: Union[Value.File, Value.Directory]) -> str:
         nonlocal missing
-        missing = missing or inode(str(v.value)) not in _uploaded_files
+        uri = uploaded_uri(cfg, str(v.value))
+        missing = missing or uri is None
         if missing:
             return ""
-        return _uploaded_files[inode(str(v.value))]
+        return uri
 
     remapped_outputs = Value.rewrite_env_paths(outputs, cache)
+    if missing or not cfg.has_option("s3_progressive_upload", "uri_prefix"):
+        return None
+
+    if key in _content_keys:
+        uri = os.path.join(get_content_prefix(cfg, get_s3_put_prefix(cfg)), "cache", f"{_content_keys[key]}.json")
+        return uri, json.dumps(values_to_json(remapped_outputs)).encode()
 
     input_digest = Value.digest_env(
         Value.rewrite_env_paths(
-            _key_inputs[key], lambda v: _uploaded_files.get(inode(str(v.value)), str(v.value))
+            _key_inputs[key], lambda v: uploaded_uri(cfg, str(v.value)) or str(v.value)
         )
     )
     key_parts = key.split('/')
     key_parts[-1] = input_digest
     s3_cache_key = "/".join(key_parts)
 
-    if not missing and cfg.has_option("s3_progressive_upload", "uri_prefix"):
-        uri = os.path.join(get_s3_put_prefix(cfg), "cache", f"{s3_cache_key}.json")
-        s3_object(uri).put(Body=json.dumps(values_to_json(remapped_outputs)).encode())
-        flag_temporary(uri)
-        logger.info(_("call cache insert", cache_file=uri))
+    uri = os.path.join(get_s3_put_prefix(cfg), "cache", f"{s3_cache_key}.json")
+    return uri, json.dumps(values_to_json(remapped_outputs)).encode()
+
+
+# content-based call cache keys (by miniwdl's cache key), computed on get for use by put
+_content_keys: Dict[str, str] = {}
+# content digests of S3 objects that had to be read, by URI & ETag; persisted (if there's a
+# registry_dir) in a log of JSON lines, loaded on first use
+_s3_content_digests: Optional[Dict[Tuple[str, str], str]] = None
+_s3_content_digests_lock = threading.Lock()
+
+
+def s3_content_digests_filename(cfg: config.Loader) -> Optional[str]:
+    registry_dir = get_registry_dir(cfg)
+    return os.path.join(registry_dir, "s3_progressive_upload_digests.jsonl") if registry_dir else None
+
+
+def s3_content_digests(cfg: config.Loader) -> Dict[Tuple[str, str], str]:
+    """
+    get the memoized content digests of S3 objects; call while holding _s3_content_digests_lock
+    """
+    global _s3_content_digests
+    if _s3_content_digests is None:
+        _s3_content_digests = {}
+        filename = s3_content_digests_filename(cfg)
+        if filename and os.path.exists(filename):
+            with open(filename) as infile:
+                for line in infile:
+                    try:
+                        uri, etag, digest = json.loads(line)
+                    except ValueError:
+                        # torn by a crash
+                        continue
+                    _s3_content_digests[(uri, etag)] = digest
+    return _s3_content_digests
+
+
+def get_content_prefix(cfg: config.Loader, default: str) -> str:
+    if not cfg.has_option("s3_progressive_upload", "call_cache_content_uri_prefix"):
+        return default
+    s3prefix = cfg["s3_progressive_upload"]["call_cache_content_uri_prefix"]
+    assert s3prefix.startswith("s3://"), "MINIWDL__S3_PROGRESSIVE_UPLOAD__CALL_CACHE_CONTENT_URI_PREFIX invalid"
+    return s3prefix
+
+
+def content_digest(cfg: config.Loader, path: str) -> str:
+    """
+    digest the content of a local file or S3 object as its size & the ETag S3 reports for it when
+    uploaded by put_file, so that identical data digests identically wherever it's stored. S3
+    objects are just HEADed, except that the ETag of a KMS-encrypted object doesn't derive from its
+    content; those are read (once per URI & ETag, persisted under registry_dir) to compute it. The
+    same data uploaded with a different part size digests differently, which just misses.
+    """
+    if not path.startswith("s3://"):
+        size = os.path.getsize(path)
+        return f"{size}:{local_etag(path, put_chunksize(cfg, size))}"
+    bucket, key = split_s3_uri(path)
+    client, _ = upload_client(cfg)
+    head = client.head_object(Bucket=bucket, Key=key)
+    size, etag = head["ContentLength"], head["ETag"].strip('"')
+    if head.get("ServerSideEncryption") != "aws:kms":
+        return f"{size}:{etag}"
+    with _s3_content_digests_lock:
+        digest = s3_content_digests(cfg).get((path, etag))
+    if digest:
+        return digest
+
+    body = client.get_object(Bucket=bucket, Key=key, IfMatch=head["ETag"])["Body"]
+    digest = f"{size}:{stream_etag(body, size, put_chunksize(cfg, size))}"
+    with _s3_content_digests_lock:
+        s3_content_digests(cfg)[(path, etag)] = digest
+        filename = s3_content_digests_filename(cfg)
+        if filename:
+            Path(filename).parent.mkdir(parents=True, exist_ok=True)
+            with open(filename, "a") as outfile:
+                outfile.write(json.dumps([path, etag, digest]) + "\n")
+    return digest
+
+
+def content_cache_key(cfg: config.Loader, key: str, inputs: Env.Bindings[Value.Base]) -> str:
+    """
+    rewrite miniwdl's call cache key, replacing its input digest with one over the content of the
+    input files (directories and other URIs keep their paths)
+    """
+    def rewriter(v: Union[Value.File, Value.Directory]) -> str:
+        path = str(v.value)
+        if isinstance(v, Value.File) and (path.startswith("s3://") or not re.match(r"^\w+://", path)):
+            return content_digest(cfg, path)
+        return path
+
+    key_parts = key.split('/')
+    key_parts[-1] = Value.digest_env(Value.rewrite_env_paths(inputs, rewriter))
+    return "/".join(key_parts)
+
+
+def cache_put(cfg: config.Loader, logger: logging.Logger, uri: str, body: bytes) -> None:
+    # (called from upload worker threads, so with the shared client: boto3 resources aren't
+    # thread-safe)
+    client, _ = upload_client(cfg)
+    bucket, key = split_s3_uri(uri)
+    client.put_object(Bucket=bucket, Key=key, Body=body)
+    flag_temporary(uri)
+    logger.info(_("call cache insert", cache_file=uri))
+
+
+def cache_file_uploaded(cfg: config.Loader, file_inode) -> List[Tuple[str, bytes]]:
+    """
+    note that the given file has been uploaded, returning the call cache entries of any tasks
+    whose outputs are now all uploaded; call while holding _uploaded_files_lock
+    """
+    entries = []
+    for key in _cached_files.pop(file_inode, ()):
+        if key not in _pending_cache_puts:
+            # already written, or superseded by a later put of the same key with nothing pending
+            continue
+        outputs, pending = _pending_cache_puts[key]
+        pending.discard(file_inode)
+        if not pending:
+            _pending_cache_puts.pop(key, None)
+            entry = cache_entry(cfg, key, outputs)
+            if entry:
+                entries.append(entry)
+    return entries
+
+
+class CallCachePrefetch:
+    """
+    The S3 call cache entries under the call cache prefix (up to call_cache_prefetch_max_entries),
+    listed page by page and downloaded concurrently on a background thread, with its own client
+    pooling a connection for each download worker. Lookups don't wait for it: entries are usable as
+    soon as their page is fetched.
+    """
+
+    def __init__(self, cfg: config.Loader, logger: logging.Logger):
+        self._cfg = cfg
+        self._logger = logger
+        self._entries: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+        # whether all the entries were loaded, so that a key missing from them is a miss
+        self.complete = False
+        self._done = threading.Event()
+        threading.Thread(target=self._run, name="s3upload_call_cache_prefetch", daemon=True).start()
+
+    def _run(self) -> None:
+        try:
+            uri = urlparse(get_s3_get_prefix(self._cfg))
+            bucket, cache_prefix = uri.hostname, os.path.join(uri.path, "cache", "")[1:]
+            max_workers = get_int_option(self._cfg, "max_concurrent_parts", 16)
+            max_entries = get_int_option(self._cfg, "call_cache_prefetch_max_entries", 100000)
+            client = boto3.client(
+                "s3",
+                endpoint_url=os.getenv("AWS_ENDPOINT_URL"),
+                config=Config(max_pool_connections=max_workers, retries={"max_attempts": 10}),
+            )
+
+            def fetch(s3_key: str) -> Optional[bytes]:
+                try:
+                    return client.get_object(Bucket=bucket, Key=s3_key)["Body"].read()
+                except botocore.exceptions.ClientError as e:
+                    # deleted since listed
+                    if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+                        raise e
+                    return None
+
+            entries = self._entries
+            complete = True
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for page in client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=cache_prefix):
+                    keys = [obj["Key"] for obj in page.get("Contents", []) if obj["Key"].endswith(".json")]
+                    if len(entries) + len(keys) > max_entries:
+                        complete = False
+                        keys = keys[:max_entries - len(entries)]
+                    for s3_key, body in zip(keys, executor.map(fetch, keys)):
+                        if body is not None:
+                            with self._lock:
+                                entries[s3_key[len(cache_prefix):-len(".json")]] = body
+                    if not complete:
+                        break
+            with self._lock:
+                self.complete = complete
+            self._logger.info(
+                _(
+                    "call cache prefetched",
+                    uri=f"s3://{bucket}/{cache_prefix}",
+                    entries=len(entries),
+                    complete=complete,
+                )
+            )
+        except Exception as exn:
+            self._logger.warning(_("call cache prefetch failed", error=str(exn)))
+        finally:
+            self._done.set()
+
+    def entries(self) -> Dict[str, bytes]:
+        """
+        wait for the prefetch, returning the cache entries by key (those fetched before any failure)
+        """
+        self._done.wait()
+        with self._lock:
+            return dict(self._entries)
+
+    def lookup(self, key: str) -> Tuple[Optional[bytes], bool]:
+        """
+        without waiting, the cache entry for key if prefetched so far, and whether the prefetch is
+        complete (so that a key missing from it is a miss)
+        """
+        with self._lock:
+            return self._entries.get(key), self.complete
+
+
+_call_cache_prefetch: Optional[CallCachePrefetch] = None
+_call_cache_prefetch_lock = threading.Lock()
+
+
+def call_cache_prefetch(cfg: config.Loader, logger: logging.Logger) -> Optional[CallCachePrefetch]:
+    """
+    start prefetching the S3 call cache, if so configured and not already started
+    """
+    global _call_cache_prefetch
+    if not (
+        get_bool_option(cfg, "call_cache_prefetch")
+        and cfg["call_cache"].get_bool("get")
+        and cfg.has_option("s3_progressive_upload", "uri_prefix")
+    ):
+        return None
+    with _call_cache_prefetch_lock:
+        if _call_cache_prefetch is None:
+            _call_cache_prefetch = CallCachePrefetch(cfg, logger.getChild("s3_progressive_upload"))
+        return _call_cache_prefetch
+
+
+_s3_exists_memo: Dict[str, Tuple[float, bool]] = {}
+_s3_exists_memo_lock = threading.Lock()
+
+
+def s3_objects_exist(cfg: config.Loader, uris: Set[str]) -> Dict[str, bool]:
+    """
+    check concurrently whether each S3 object (or, for URIs ending in /, folder) exists, reusing
+    results memoized within the last call_cache_validate_ttl seconds
+    """
+    ttl = get_int_option(cfg, "call_cache_validate_ttl", 60)
+    now = time.time()
+    ans = {}
+    with _s3_exists_memo_lock:
+        for uri in uris:
+            memo = _s3_exists_memo.get(uri)
+            if memo and now - memo[0] < ttl:
+                ans[uri] = memo[1]
+    client, _ = upload_client(cfg)
+
+    def exists(uri: str) -> bool:
+        bucket, key = split_s3_uri(uri)
+        try:
+            if uri.endswith("/"):
+                return bool(client.list_objects_v2(Bucket=bucket, Prefix=key, MaxKeys=1).get("KeyCount"))
+            client.head_object(Bucket=bucket, Key=key)
+        except botocore.exceptions.ClientError as e:
+            # only a definite 404 counts as missing
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return False
+        return True
+
+    unknown = [uri for uri in uris if uri not in ans]
+    if unknown:
+        with ThreadPoolExecutor(max_workers=get_int_option(cfg, "max_concurrent_parts", 16)) as executor:
+            found = dict(zip(unknown, executor.map(exists, unknown)))
+        with _s3_exists_memo_lock:
+            for uri, uri_exists in found.items():
+                _s3_exists_memo[uri] = (now, uri_exists)
+        ans.update(found)
+    return ans
 
 
 class CallCache(cache.CallCache):
@@ -154,31 +696,81 @@ class CallCache(cache.CallCache):
 
         if not self._cfg.has_option("s3_progressive_upload", "uri_prefix"):
             return super().get(key, inputs, output_types)
-        uri = urlparse(get_s3_get_prefix(self._cfg))
+        s3prefix = get_s3_get_prefix(self._cfg)
+        lookup_key = key
+        if get_bool_option(self._cfg, "call_cache_content_keys"):
+            try:
+                lookup_key = _content_keys[key] = content_cache_key(self._cfg, key, inputs)
+                s3prefix = get_content_prefix(self._cfg, s3prefix)
+            except Exception as exn:
+                self._logger.warning(_("unable to digest call inputs by content", key=key, error=str(exn)))
+        uri = urlparse(s3prefix)
         bucket, prefix = uri.hostname, uri.path
 
-        s3_key = os.path.join(prefix, "cache", f"{key}.json")[1:]
+        s3_key = os.path.join(prefix, "cache", f"{lookup_key}.json")[1:]
         abs_fn = os.path.join(self._cfg["call_cache"]["dir"], f"{key}.json")
         Path(abs_fn).parent.mkdir(parents=True, exist_ok=True)
-        try:
-            s3_client.download_file(bucket, s3_key, abs_fn)
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] != "404":
-                raise e
+        prefetch = call_cache_prefetch(self._cfg, self._logger)
+        prefetched, complete = (None, False)
+        if prefetch and s3prefix == get_s3_get_prefix(self._cfg):
+            prefetched, complete = prefetch.lookup(lookup_key)
+        if prefetched is not None:
+            with open(abs_fn, "wb") as outfile:
+                outfile.write(prefetched)
+        elif not complete:
+            # (a miss in complete prefetched entries needs no round trip to S3, but one not yet
+            # prefetched does rather than waiting on the rest of the listing)
+            try:
+                s3_client.download_file(bucket, s3_key, abs_fn)
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] != "404":
+                    raise e
+
+        outputs = super().get(key, inputs, output_types)
+        if outputs is not None and get_bool_option(self._cfg, "call_cache_validate", True):
+            s3_uris = set()
 
-        return super().get(key, inputs, output_types)
+            def collect(v: Union[Value.File, Value.Directory]) -> str:
+                if str(v.value).startswith("s3://"):
+                    s3_uris.add(str(v.value))
+                return str(v.value)
+
+            Value.rewrite_env_paths(outputs, collect)
+            missing = sorted(uri for uri, uri_exists in s3_objects_exist(self._cfg, s3_uris).items() if not uri_exists)
+            if missing:
+                self._logger.warning(
+                    _("call cache entry references missing S3 objects; treating as miss", key=key, missing=missing)
+                )
+                os.remove(abs_fn)
+                return None
+        return outputs
 
     def put(self, key: str, outputs: Env.Bindings[Value.Base]) -> None:  # type: ignore[override]
         if not self._cfg["call_cache"].get_bool("put"):
             return
 
+        # the entry can only be written once all the output files are uploaded; track those
+        # still pending, so that it's formulated exactly once, upon the last upload
+        pending = set()
+
         def cache(v: Union[Value.File, Value.Directory]) -> str:
-            _cached_files[inode(v.value)] = (key, outputs)
+            if uploaded_uri(self._cfg, str(v.value)) is None:
+                pending.add(inode(str(v.value)))
             return ""
 
         with _uploaded_files_lock:
             Value.rewrite_env_paths(outputs, cache)
-            cache_put(self._cfg, self._logger, key, outputs)
+            entry = None
+            if pending:
+                # a later put of the same key supersedes any still pending
+                _pending_cache_puts[key] = (outputs, pending)
+                for file_inode in pending:
+                    _cached_files.setdefault(file_inode, set()).add(key)
+            else:
+                _pending_cache_puts.pop(key, None)
+                entry = cache_entry(self._cfg, key, outputs)
+        if entry:
+            cache_put(self._cfg, self._logger, *entry)
 
 
 def task(cfg, logger, run_id, run_dir, task, **recv):
@@ -193,15 +785,30 @@ def task(cfg, logger, run_id, run_dir, task, **recv):
     # ignore command/runtime/container
     recv = yield recv
 
-    def upload_file(abs_fn, s3uri):
-        s3cp(logger, abs_fn, s3uri)
+    registry = upload_registry(cfg)
+
+    def upload_file(abs_fn, s3uri, existing=None):
+        # existing: (size, ETag) of an object already at s3uri
+        skipped = existing is not None and is_identical(cfg, abs_fn, *existing)
+        if skipped:
+            etag = existing[1]
+        else:
+            etag = upload(cfg, logger, abs_fn, s3uri)
+        if registry:
+            registry.add(abs_fn, s3uri, etag)
         # record in _uploaded_files (keyed by inode, so that it can be found from any
         # symlink or hardlink)
         with _uploaded_files_lock:
             _uploaded_files[inode(abs_fn)] = s3uri
-            if inode(abs_fn) in _cached_files:
-                cache_put(cfg, logger, *_cached_files[inode(abs_fn)])
-        logger.info(_("task output uploaded", file=abs_fn, uri=s3uri))
+            cache_entries = cache_file_uploaded(cfg, inode(abs_fn))
+        for cache_entry_uri, cache_entry_body in cache_entries:
+            cache_put(cfg, logger, cache_entry_uri, cache_entry_body)
+        if get_bool_option(cfg, "seed_download_cache"):
+            seed_download_cache(cfg, logger, abs_fn, s3uri)
+        if skipped:
+            logger.info(_("task output already in S3; skipped upload", file=abs_fn, uri=s3uri))
+        else:
+            logger.info(_("task output uploaded", file=abs_fn, uri=s3uri))
 
     if not cfg.has_option("s3_progressive_upload", "uri_prefix"):
         logger.debug("skipping because MINIWDL__S3_PROGRESSIVE_UPLOAD__URI_PREFIX is unset")
@@ -218,6 +825,8 @@ def task(cfg, logger, run_id, run_dir, task, **recv):
     def _raise(ex):
         raise ex
 
+    # collect (local file, S3 URI) pairs to upload
+    uploads: List[Tuple[str, str]] = []
     links_dir = os.path.join(run_dir, "out")
     for output in os.listdir(links_dir):
         abs_output = os.path.join(links_dir, output)
@@ -226,21 +835,23 @@ def task(cfg, logger, run_id, run_dir, task, **recv):
         assert output_contents
         if len(output_contents) == 1 and os.path.isdir(output_contents[0]) and os.path.islink(output_contents[0]):
             # directory output
-            _uploaded_files[inode(output_contents[0])] = (
-                os.path.join(s3prefix, os.path.basename(output_contents[0])) + "/"
-            )
+            dir_uri = os.path.join(s3prefix, os.path.basename(output_contents[0])) + "/"
+            with _uploaded_files_lock:
+                _uploaded_files[inode(output_contents[0])] = dir_uri
+            if registry:
+                registry.add(output_contents[0], dir_uri)
             for (dn, subdirs, files) in os.walk(output_contents[0], onerror=_raise):
                 assert dn == output_contents[0] or dn.startswith(output_contents[0] + "/"), dn
                 for fn in files:
                     abs_fn = os.path.join(dn, fn)
                     s3uri = os.path.join(s3prefix, os.path.relpath(abs_fn, abs_output))
-                    upload_file(abs_fn, s3uri)
+                    uploads.append((abs_fn, s3uri))
         elif len(output_contents) == 1 and os.path.isfile(output_contents[0]):
             # file output
             basename = os.path.basename(output_contents[0])
             abs_fn = os.path.join(abs_output, basename)
             s3uri = os.path.join(s3prefix, basename)
-            upload_file(abs_fn, s3uri)
+            uploads.append((abs_fn, s3uri))
         else:
             # file array output
             assert all(os.path.basename(abs_fn).isdigit() for abs_fn in output_contents), output_contents
@@ -249,7 +860,26 @@ def task(cfg, logger, run_id, run_dir, task, **recv):
                 assert len(fns) == 1
                 abs_fn = os.path.join(index_dir, fns[0])
                 s3uri = os.path.join(s3prefix, fns[0])
-                upload_file(abs_fn, s3uri)
+                uploads.append((abs_fn, s3uri))
+
+    t_0 = time.time()
+    existing: Dict[str, Tuple[int, str]] = {}
+    if get_bool_option(cfg, "skip_identical_uploads"):
+        existing = head_objects(cfg, [s3uri for _, s3uri in uploads])
+
+    # hand the files to the shared upload pools, then wait for this task's uploads only
+    large_threshold = get_int_option(cfg, "large_upload_threshold", 256 * 1024 * 1024)
+    futures = [
+        upload_pool(cfg, os.path.getsize(abs_fn) >= large_threshold).submit(
+            upload_file, abs_fn, s3uri, existing.get(s3uri)
+        )
+        for abs_fn, s3uri in uploads
+    ]
+    wait(futures)
+    for future in futures:
+        future.result()
+    # for the sfn_wdl plugin's timeline, which follows this one
+    recv["s3_upload_seconds"] = time.time() - t_0
     yield recv
 
 
@@ -259,6 +889,8 @@ def workflow(cfg, logger, run_id, run_dir, workflow, **recv):
     with local filenames rewritten to the uploaded S3 URIs (as previously recorded on completion of
     each task).
     """
+    # get a head start on call cache lookups for the workflow's calls
+    call_cache_prefetch(cfg, logger)
     logger = logger.getChild("s3_progressive_upload")
 
     # ignore inputs
@@ -267,6 +899,7 @@ def workflow(cfg, logger, run_id, run_dir, workflow, **recv):
     if cfg.has_option("s3_progressive_upload", "uri_prefix"):
         # write outputs.s3.json using _uploaded_files
         write_outputs_s3_json(
+            cfg,
             logger,
             recv["outputs"],
             run_dir,
@@ -274,10 +907,54 @@ def workflow(cfg, logger, run_id, run_dir, workflow, **recv):
             workflow.name,
         )
 
+    max_bytes = get_int_option(cfg, "call_cache_local_max_bytes", 0)
+    if max_bytes and len(run_id) == 1 and cfg["call_cache"].get_bool("get"):
+        prune_local_call_cache(logger, cfg["call_cache"]["dir"], max_bytes)
+
     yield recv
 
 
-def write_outputs_s3_json(logger, outputs, run_dir, s3prefix, namespace):
+FICLONE = 0x40049409
+
+
+def seed_download_cache(cfg: config.Loader, logger: logging.Logger, fn: str, s3uri: str) -> None:
+    """
+    add the uploaded file to the local download cache as s3uri, so that a later download of s3uri
+    on this host, e.g. by the next stage, finds it without a transfer. The file is hardlinked if the
+    cache is on the same filesystem (or, if hardlinking it isn't permitted, reflinked where the
+    filesystem supports that), and otherwise copied.
+    """
+    cache_path = cache.CallCache(cfg, logger).download_cacheable(s3uri)
+    if not cache_path or os.path.exists(cache_path):
+        return
+    src = os.path.realpath(fn)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp = os.path.join(os.path.dirname(cache_path), f".seed.{os.path.basename(cache_path)}.{os.getpid()}")
+    try:
+        try:
+            os.link(src, tmp)
+        except OSError:
+            with open(src, "rb") as infile, open(tmp, "wb") as outfile:
+                try:
+                    fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+                except OSError:
+                    # e.g. EXDEV: like hardlinks, reflinks only work within one filesystem
+                    shutil.copyfileobj(infile, outfile, MiB)
+        # transient exclusive flock on the whole cache directory, as miniwdl takes to add entries
+        with open(os.path.join(cfg["download_cache"]["dir"], "_miniwdl_flock"), "a") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            if not os.path.exists(cache_path):
+                os.rename(tmp, cache_path)
+                logger.info(_("seeded download cache", uri=s3uri, cache_path=cache_path))
+    except OSError as exn:
+        # e.g. out of space in the cache
+        logger.debug(_("unable to seed download cache", uri=s3uri, error=str(exn)))
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def write_outputs_s3_json(cfg, logger, outputs, run_dir, s3prefix, namespace):
     # write to outputs.s3.json
     fn = os.path.join(run_dir, "outputs.s3.json")
 
@@ -287,8 +964,10 @@ def write_outputs_s3_json(logger, outputs, run_dir, s3prefix, namespace):
             return fd.value
 
         try:
-            return _uploaded_files[inode(fd.value)]
+            uri = uploaded_uri(cfg, fd.value)
         except Exception:
+            uri = None
+        if uri is None:
             logger.warning(
                 _(
                     "output file or directory wasn't uploaded to S3; keeping local path in outputs.s3.json",
@@ -296,6 +975,7 @@ def write_outputs_s3_json(logger, outputs, run_dir, s3prefix, namespace):
                 )
             )
             return fd.value
+        return uri
 
     with _uploaded_files_lock:
         outputs_s3 = WDL.Value.rewrite_env_paths(outputs, rewriter)
@@ -317,31 +997,382 @@ def write_outputs_s3_json(logger, outputs, run_dir, s3prefix, namespace):
 
     tag_temporary_output_files(output_file_set=output_set, s3prefix=s3prefix)
 
-    s3cp(
+    upload(
+        cfg,
         logger,
         fn,
         os.environ.get("WDL_OUTPUT_URI", os.path.join(s3prefix, "outputs.s3.json"))
     )
 
 
-_s3parcp_lock = threading.Lock()
+def upload(cfg: config.Loader, logger: logging.Logger, fn: str, s3uri: str) -> Optional[str]:
+    """
+    upload fn to s3uri, returning the object's ETag if known
+    """
+    backend = "boto3"
+    if cfg.has_option("s3_progressive_upload", "upload_backend"):
+        backend = cfg["s3_progressive_upload"]["upload_backend"]
+    assert backend in ("boto3", "s3parcp"), "MINIWDL__S3_PROGRESSIVE_UPLOAD__UPLOAD_BACKEND invalid"
+    if backend == "s3parcp" or os.path.getsize(fn) >= get_int_option(cfg, "s3parcp_threshold", 16 * 1024 * MiB):
+        s3cp(logger, fn, s3uri)
+        return None
+    try:
+        return put_file(cfg, logger, fn, s3uri)
+    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as exn:
+        logger.error(_("failed uploading output file", file=fn, uri=s3uri, error=str(exn)))
+        raise WDL.Error.RuntimeError(f"failed uploading {fn} to {s3uri}") from exn
+
+
+# the object metadata in which s3parcp --checksum stores (and verifies) the CRC32C of the content
+CRC32C_METADATA_KEY = "crc32c-checksum"
+
+
+def _crc32c_table() -> List[int]:
+    table = []
+    for i in range(256):
+        crc = i
+        for _i in range(8):
+            crc = (crc >> 1) ^ (0x82F63B78 if crc & 1 else 0)
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _crc32c_table()
+
+
+def crc32c(data: bytes, crc: int = 0) -> int:
+    """
+    CRC32C (Castagnoli) of data, continuing from crc (the CRC32C of what came before it); computed by
+    the crc32c package if installed, otherwise (much more slowly) in Python
+    """
+    if _crc32c is not None:
+        return _crc32c(data, crc)
+    crc ^= 0xFFFFFFFF
+    for byte in data:
+        crc = _CRC32C_TABLE[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def file_crc32c(fn: str) -> int:
+    crc = 0
+    with open(fn, "rb") as infile:
+        for block in iter(lambda: infile.read(MiB), b""):
+            crc = crc32c(block, crc)
+    return crc
+
+
+def crc32c_metadata(crc: int) -> Dict[str, str]:
+    """
+    object metadata recording the content's CRC32C as s3parcp --checksum does, so that downloads by
+    s3parcp --checksum verify it end to end
+    """
+    return {CRC32C_METADATA_KEY: str(crc)}
+
+
+def put_file(cfg: config.Loader, logger: logging.Logger, fn: str, s3uri: str) -> str:
+    """
+    upload fn to s3uri in-process, returning the object's ETag as computed locally (the MD5 of the
+    file for a single PUT, or the MD5 of the parts' MD5s suffixed with the part count otherwise)
+    """
+    bucket, key = split_s3_uri(s3uri)
+    client, part_pool = upload_client(cfg)
+    size = os.path.getsize(fn)
+
+    chunksize = put_chunksize(cfg, size)
+    if not chunksize:
+        with open(fn, "rb") as infile:
+            body = infile.read()
+        digest = hashlib.md5(body).digest()
+        client.put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=body,
+            ContentMD5=b64encode(digest).decode(),
+            Metadata=crc32c_metadata(crc32c(body)),
+        )
+        return digest.hex()
+
+    # the metadata has to be given upfront, so the CRC32C takes a pass over the file before the
+    # parts are sent (concurrently, out of order)
+    metadata = crc32c_metadata(file_crc32c(fn))
+    upload_id = client.create_multipart_upload(Bucket=bucket, Key=key, Metadata=metadata)["UploadId"]
+
+    def upload_part(part_number: int) -> Tuple[bytes, Dict[str, Union[int, str]]]:
+        with open(fn, "rb") as infile:
+            infile.seek((part_number - 1) * chunksize)
+            body = infile.read(chunksize)
+        digest = hashlib.md5(body).digest()
+        rslt = client.upload_part(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=body,
+            ContentMD5=b64encode(digest).decode(),
+        )
+        return digest, {"PartNumber": part_number, "ETag": rslt["ETag"]}
+
+    try:
+        parts = list(part_pool.map(upload_part, range(1, -(-size // chunksize) + 1)))
+        client.complete_multipart_upload(
+            Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": [part for _, part in parts]}
+        )
+    except Exception as exn:
+        try:
+            client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        except Exception as abort_exn:
+            # leave the upload failure to be reported, rather than the failure to clean up after it
+            logger.warning(_("failed aborting multipart upload", uri=s3uri, upload_id=upload_id, error=str(abort_exn)))
+        raise exn
+    return hashlib.md5(b"".join(digest for digest, _ in parts)).hexdigest() + f"-{len(parts)}"
+
+
+_local_etags: Dict[Tuple[int, int, int, int, int], str] = {}
+_local_etags_lock = threading.Lock()
+
+
+def local_etag(fn: str, chunksize: int) -> str:
+    """
+    compute the ETag S3 reports for fn uploaded in parts of chunksize bytes (0 for a single PUT),
+    memoized by inode & mtime so that repeated comparisons don't re-read the file
+    """
+    st = os.stat(os.path.realpath(fn))
+    memo_key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, chunksize)
+    with _local_etags_lock:
+        if memo_key in _local_etags:
+            return _local_etags[memo_key]
+
+    with open(fn, "rb") as infile:
+        etag = stream_etag(infile, st.st_size, chunksize)
+
+    with _local_etags_lock:
+        _local_etags[memo_key] = etag
+    return etag
+
+
+def stream_etag(infile, size: int, chunksize: int) -> str:
+    """
+    compute the ETag S3 reports for the size bytes read from infile, uploaded in parts of chunksize
+    bytes (0 for a single PUT)
+    """
+    digests = []
+    consumed = 0
+    while True:
+        md5 = hashlib.md5()
+        remaining = chunksize or size
+        while remaining > 0:
+            block = infile.read(min(remaining, MiB))
+            if not block:
+                break
+            md5.update(block)
+            remaining -= len(block)
+            consumed += len(block)
+        digests.append(md5)
+        if not chunksize or remaining > 0 or consumed >= size:
+            break
+    if chunksize:
+        return hashlib.md5(b"".join(md5.digest() for md5 in digests)).hexdigest() + f"-{len(digests)}"
+    return digests[0].hexdigest()
+
+
+def is_identical(cfg: config.Loader, fn: str, size: int, etag: str) -> bool:
+    """
+    check whether fn has the same content as an existing S3 object of the given size & ETag
+    """
+    if os.path.getsize(fn) != size:
+        return False
+    registry = upload_registry(cfg)
+    record = registry.get(fn) if registry else None
+    if record and record.etag == etag:
+        return True
+    if "-" not in etag:
+        return local_etag(fn, 0) == etag
+    # multipart ETag: try our own part size and the whole-MiB part size the part count implies
+    # (which covers objects uploaded by s3parcp)
+    parts = int(etag.split("-")[1])
+    chunksizes = {multipart_chunksize(cfg, size), -(-size // (parts * MiB)) * MiB}
+    return any(
+        -(-size // chunksize) == parts and local_etag(fn, chunksize) == etag for chunksize in chunksizes if chunksize
+    )
+
+
+def head_objects(cfg: config.Loader, uris: List[str]) -> Dict[str, Tuple[int, str]]:
+    """
+    HEAD the given S3 URIs concurrently, returning the size & ETag of each existing object
+    """
+    client, _ = upload_client(cfg)
+
+    def head(uri: str) -> Optional[Tuple[int, str]]:
+        bucket, key = split_s3_uri(uri)
+        try:
+            rslt = client.head_object(Bucket=bucket, Key=key)
+        except botocore.exceptions.ClientError:
+            # missing (or unreadable) objects just get uploaded
+            return None
+        return rslt["ContentLength"], rslt["ETag"].strip('"')
+
+    with ThreadPoolExecutor(max_workers=get_int_option(cfg, "max_concurrent_parts", 16)) as executor:
+        return {uri: found for uri, found in zip(uris, executor.map(head, uris)) if found}
 
 
 def s3cp(logger, fn, s3uri):
-    with _s3parcp_lock:
-        # when uploading many small outputs from the same pipeline you end up with a
-        #   quick intense burst of load that can bump into the S3 rate limit
-        #   allowing more retries should overcome this
-        cmd = ["s3parcp", "--checksum", "--max-retries", "10", fn, s3uri]
-        logger.debug(" ".join(cmd))
-        rslt = subprocess.run(cmd, stderr=subprocess.PIPE)
-        if rslt.returncode != 0:
-            logger.error(
-                _(
-                    "failed uploading output file",
-                    cmd=" ".join(cmd),
-                    exit_status=rslt.returncode,
-                    stderr=rslt.stderr.decode("utf-8"),
-                )
+    # allow extra retries to ride out S3 rate limiting, as for in-process uploads
+    cmd = ["s3parcp", "--checksum", "--max-retries", "10", fn, s3uri]
+    logger.debug(" ".join(cmd))
+    rslt = subprocess.run(cmd, stderr=subprocess.PIPE)
+    if rslt.returncode != 0:
+        logger.error(
+            _(
+                "failed uploading output file",
+                cmd=" ".join(cmd),
+                exit_status=rslt.returncode,
+                stderr=rslt.stderr.decode("utf-8"),
             )
-            raise WDL.Error.RuntimeError("failed: " + " ".join(cmd))
+        )
+        raise WDL.Error.RuntimeError("failed: " + " ".join(cmd))
+
+
+# Garbage collection for the S3 call cache and the local call cache directory mirroring it, run
+# by the miniwdl-s3upload-gc command (gc_main). Entries under <prefix>/cache/ are dead once they're
+# older than a maximum age, or once any S3 object referenced by their outputs has been deleted (e.g.
+# expired by a lifecycle rule on intermediate outputs); dead entries are deleted in batches. The
+# local mirror (miniwdl's call_cache.dir) is pruned to a byte budget by evicting the least recently
+# used entries.
+#
+# Usage: miniwdl-s3upload-gc s3://bucket/prefix [--max-age-days N] [--dry-run]
+#                            [--local-dir DIR --local-max-bytes N]
+
+GC_DESCRIPTION = "Garbage collection for the S3 call cache written by the s3_progressive_upload plugin"
+
+
+def referenced_s3_uris(value: Any, uris: Set[str]) -> None:
+    if isinstance(value, str) and value.startswith("s3://"):
+        uris.add(value)
+    elif isinstance(value, list):
+        for item in value:
+            referenced_s3_uris(item, uris)
+    elif isinstance(value, dict):
+        for item in value.values():
+            referenced_s3_uris(item, uris)
+
+
+def collect_call_cache(
+    cfg: config.Loader,
+    logger: logging.Logger,
+    s3prefix: str,
+    max_age: Optional[timedelta] = None,
+    dry_run: bool = False,
+) -> Tuple[int, int]:
+    """
+    Delete the dead entries of the S3 call cache under s3prefix, returning the numbers of live
+    entries and of dead entries deleted (or, for a dry run, to be deleted); entries S3 fails to
+    delete are logged and left for the next run
+    """
+    bucket, prefix = split_s3_uri(os.path.join(s3prefix, "cache", ""))
+    now = datetime.now(timezone.utc)
+    keys: List[str] = []
+    dead: List[str] = []
+    for page in s3_client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if not obj["Key"].endswith(".json"):
+                continue
+            if max_age is not None and now - obj["LastModified"] > max_age:
+                dead.append(obj["Key"])
+            else:
+                keys.append(obj["Key"])
+
+    def referenced(key: str) -> Set[str]:
+        uris: Set[str] = set()
+        try:
+            referenced_s3_uris(json.loads(s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()), uris)
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+                raise e
+        return uris
+
+    with ThreadPoolExecutor(max_workers=get_int_option(cfg, "max_concurrent_parts", 16)) as executor:
+        entry_uris = list(executor.map(referenced, keys))
+    # many entries reference the same objects (e.g. one task's outputs are several others' inputs),
+    # so check each object once
+    exists = s3_objects_exist(cfg, set().union(set(), *entry_uris))
+    live: List[str] = []
+    for key, uris in zip(keys, entry_uris):
+        (live if all(exists[uri] for uri in uris) else dead).append(key)
+
+    failed = 0
+    if not dry_run:
+        # DeleteObjects takes up to 1,000 keys per request, and reports each key it failed to delete
+        for i in range(0, len(dead), 1000):
+            rslt = s3_client.delete_objects(
+                Bucket=bucket, Delete={"Objects": [{"Key": key} for key in dead[i:i + 1000]], "Quiet": True}
+            )
+            for error in rslt.get("Errors", []):
+                logger.warning(
+                    _(
+                        "failed deleting dead call cache entry",
+                        key=error.get("Key"),
+                        code=error.get("Code"),
+                        message=error.get("Message"),
+                    )
+                )
+                failed += 1
+    logger.info(
+        _(
+            "call cache garbage collection",
+            uri=s3prefix,
+            live=len(live),
+            dead=len(dead),
+            failed=failed,
+            dry_run=dry_run,
+        )
+    )
+    return len(live), len(dead) - failed
+
+
+def prune_local_call_cache(logger: logging.Logger, cache_dir: str, max_bytes: int) -> int:
+    """
+    Delete least recently used entries from the local call cache directory until it takes no more
+    than max_bytes, returning the number deleted
+    """
+    entries = []
+    total = 0
+    for dn, _subdirs, files in os.walk(cache_dir):
+        for fn in files:
+            if fn.endswith(".json"):
+                path = os.path.join(dn, fn)
+                st = os.stat(path)
+                entries.append((max(st.st_atime, st.st_mtime), st.st_size, path))
+                total += st.st_size
+    deleted = 0
+    for _used, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        deleted += 1
+    if deleted:
+        logger.info(_("pruned local call cache", dir=cache_dir, deleted=deleted, bytes=total))
+    return deleted
+
+
+def gc_main(args: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="miniwdl-s3upload-gc", description=GC_DESCRIPTION)
+    parser.add_argument("s3prefix", help="S3 prefix under which the call cache/ folder lives")
+    parser.add_argument("--max-age-days", type=float, help="also delete entries older than this")
+    parser.add_argument("--dry-run", action="store_true", help="report dead entries without deleting them")
+    parser.add_argument("--local-dir", help="local call cache directory to prune")
+    parser.add_argument("--local-max-bytes", type=int, help="byte budget for --local-dir")
+    parsed = parser.parse_args(args)
+    assert parsed.s3prefix.startswith("s3://"), "s3prefix should be an s3:// URI"
+
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger("miniwdl-s3upload-gc")
+    cfg = config.Loader(logger)
+    max_age = timedelta(days=parsed.max_age_days) if parsed.max_age_days is not None else None
+    collect_call_cache(cfg, logger, parsed.s3prefix, max_age=max_age, dry_run=parsed.dry_run)
+    if parsed.local_dir and parsed.local_max_bytes is not None and not parsed.dry_run:
+        prune_local_call_cache(logger, parsed.local_dir, parsed.local_max_bytes)
+    return 0
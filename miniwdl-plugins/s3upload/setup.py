@@ -22,11 +22,12 @@ setup(
     py_modules=["miniwdl_s3upload"],
     python_requires=">=3.6",
     setup_requires=["reentry"],
-    install_requires=["boto3"],
+    install_requires=["boto3", "crc32c"],
     reentry_register=True,
     entry_points={
         'miniwdl.plugin.task': ['s3_progressive_upload_task = miniwdl_s3upload:task'],
         'miniwdl.plugin.workflow': ['s3_progressive_upload_workflow = miniwdl_s3upload:workflow'],
         'miniwdl.plugin.cache_backend': ['s3_progressive_upload_call_cache_backend = miniwdl_s3upload:CallCache'],
+        'console_scripts': ['miniwdl-s3upload-gc = miniwdl_s3upload:gc_main'],
     }
 )
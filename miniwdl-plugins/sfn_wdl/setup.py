@@ -23,6 +23,7 @@ setup(
         # (so that the uploads really are complete once sets the status to say so). miniwdl runs
         # the plugins in alphabetical order, so "sfnwdl_miniwdl_plugin_task" has to follow the
         # corresponding upload plugin's name(s).
-        "miniwdl.plugin.task": ["sfnwdl_miniwdl_plugin_task = sfnwdl_miniwdl_plugin:task"]
+        "miniwdl.plugin.task": ["sfnwdl_miniwdl_plugin_task = sfnwdl_miniwdl_plugin:task"],
+        "miniwdl.plugin.workflow": ["sfnwdl_miniwdl_plugin_workflow = sfnwdl_miniwdl_plugin:workflow"],
     },
 )
@@ -1,13 +1,17 @@
+import atexit
+import calendar
 import json
 import os
 import re
 import threading
 import time
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 import boto3
 import botocore
-from WDL._util import StructuredLogMessage as _
+import docker  # type: ignore
+import WDL
+from WDL._util import StructuredLogMessage as _, VERBOSE_LEVEL
 from WDL.runtime import config
 
 s3 = boto3.resource("s3", endpoint_url=os.getenv("AWS_ENDPOINT_URL"))
@@ -29,9 +33,11 @@ def task(cfg, logger, run_id, run_dir, task, **recv):
     t_0 = time.time()
 
     s3_wd_uri = get_s3_put_prefix(cfg)
+    step_name = task_step_name(task)
     update_status_json(
         logger,
-        task,
+        cfg,
+        step_name,
         run_id,
         s3_wd_uri,
         {"status": "running", "start_time": str(time.time())},
@@ -45,37 +51,58 @@ def task(cfg, logger, run_id, run_dir, task, **recv):
     recv = yield recv
 
     # provide a callback for stderr log messages that attempts to parse them as JSON and pass them
-    # on in structured form
+    # on in structured form. Tasks can be very chatty (e.g. aligners), so the lines logged are rate-
+    # limited, counting those suppressed; JSON lines are always parsed though, to keep the last one
+    # for the error status below.
     stderr_logger = logger.getChild("stderr")
     last_stderr_json = None
+    limiter = StderrRateLimiter(cfg)
 
     def stderr_callback(line):
         nonlocal last_stderr_json
         line2 = line.strip()
-        parsed = False
-        if line2.startswith("{") and line2.endswith("}"):
+        if line2[:1] == "{" and line2[-1:] == "}":
             try:
-                d = json.loads(line)
+                d = json.loads(line2)
                 assert isinstance(d, dict)
-                msg = ""
-                if "message" in d:
-                    msg = d["message"]
-                    del d["message"]
-                elif "msg" in d:
-                    msg = d["msg"]
-                    del d["msg"]
-                stderr_logger.verbose(_(msg.strip(), **d))
-                last_stderr_json = d
-                parsed = True
+                last_stderr_json = dict(d)
+                if not stderr_logger.isEnabledFor(VERBOSE_LEVEL):
+                    return
+                # never suppress error details
+                if "wdl_error_message" in d or "error" in d or limiter.allow():
+                    msg = d.pop("message", None) or d.pop("msg", None) or ""
+                    stderr_logger.verbose(_(str(msg).strip(), **d))
+                return
             except Exception:
                 pass
-        if not parsed:
+        if stderr_logger.isEnabledFor(VERBOSE_LEVEL) and limiter.allow():
             stderr_logger.verbose(line.rstrip())
 
     recv["container"].stderr_callback = stderr_callback
+    profiler = TaskProfiler(cfg, logger, recv["container"])
+    t_command = time.time()
 
     try:
-        recv = yield recv
+        try:
+            recv = yield recv
+        finally:
+            resources = profiler.stop()
+            t_end = time.time()
+            t_upload = t_end - (recv.get("s3_upload_seconds", 0.0) if "outputs" in recv else 0.0)
+            t_started = profiler.started_at if profiler.started_at else t_command
+            record_timeline(
+                run_id,
+                [
+                    ("download inputs", t_0, t_command),
+                    ("container startup", t_command, t_started),
+                    ("run", t_started, t_upload),
+                    ("upload outputs", t_upload, t_end),
+                ],
+            )
+            if limiter.suppressed:
+                logger.warning(
+                    _("suppressed task stderr lines over rate limit", lines=limiter.suppressed)
+                )
 
         # After task completion -- logging elapsed time in structured form, to be picked up by
         # CloudWatch Logs. We also have access to the task outputs in recv.
@@ -86,12 +113,13 @@ def task(cfg, logger, run_id, run_dir, task, **recv):
                 run_id=run_id[-1],
                 task_name=task.name,
                 elapsed_seconds=round(t_elapsed, 3),
+                **({"resources": resources} if resources else {}),
             )
         )
     except Exception as exn:
         if s3_wd_uri:
             # read the error message to determine status user_errored or pipeline_errored
-            status = dict(status="pipeline_errored")
+            status: Dict[str, Any] = dict(status="pipeline_errored")
             msg = str(exn)
             if last_stderr_json and "wdl_error_message" in last_stderr_json:
                 msg = last_stderr_json.get(
@@ -102,7 +130,11 @@ def task(cfg, logger, run_id, run_dir, task, **recv):
                 if "step_description_md" in last_stderr_json:
                     status.update(description=last_stderr_json["step_description_md"])
             status.update(error=msg, end_time=str(time.time()))
-            update_status_json(logger, task, run_id, s3_wd_uri, status)
+            if resources and profiler.status_json:
+                status.update(resources=resources)
+            update_status_json(logger, cfg, step_name, run_id, s3_wd_uri, status)
+            # don't leave the failure to a background write, which might not happen before exit
+            flush_status_json()
         raise
 
     if s3_wd_uri:
@@ -114,80 +146,412 @@ def task(cfg, logger, run_id, run_dir, task, **recv):
             # idseq_dag steps may dynamically generate their description to reflect different
             # behaviors based on the input. The WDL tasks output this as a String value.
             status["description"] = recv["outputs"]["step_description_md"].value
-        update_status_json(logger, task, run_id, s3_wd_uri, status)
+        if resources and profiler.status_json:
+            status["resources"] = resources
+        update_status_json(logger, cfg, step_name, run_id, s3_wd_uri, status)
 
     # do nothing with outputs
     yield recv
 
 
-_status_json: Dict[str, Any] = {}
-_status_json_lock = threading.Lock()
+class TaskProfiler:
+    """
+    Samples the resource usage of a task's docker container every [sfn_wdl] profile_interval_seconds
+    (default 30; 0 to disable) from a background thread, for a summary logged on task completion
+    (and added to the status JSON if [sfn_wdl] profile_status_json is true): CPU time & average
+    cores used, peak memory (excluding reclaimable page cache), disk bytes read & written, and peak
+    size of the working directory (sampled every profile_scratch_every samples, default 10, since
+    it has to walk the directory).
+    """
+
+    def __init__(self, cfg: config.Loader, logger, container) -> None:
+        self.interval = 30.0
+        self.scratch_every = 10
+        self.status_json = False
+        if cfg.has_option("sfn_wdl", "profile_interval_seconds"):
+            self.interval = cfg["sfn_wdl"].get_float("profile_interval_seconds")
+        if cfg.has_option("sfn_wdl", "profile_scratch_every"):
+            self.scratch_every = max(1, cfg["sfn_wdl"].get_int("profile_scratch_every"))
+        if cfg.has_option("sfn_wdl", "profile_status_json"):
+            self.status_json = cfg["sfn_wdl"].get_bool("profile_status_json")
+        self._logger = logger
+        self._container = container
+        self._docker_container = None
+        self.started_at: Optional[float] = None
+        self._samples = 0
+        self._t_start = time.time()
+        self._t_last: Optional[float] = None
+        self._cpu_ns = 0
+        self._peak_memory = 0
+        self._read_bytes = 0
+        self._write_bytes = 0
+        self._peak_scratch = 0
+        self._stopped = threading.Event()
+        self._thread = None
+        if self.interval > 0:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
 
+    def stop(self) -> Dict[str, Any]:
+        """
+        stop sampling and return the summary (empty if no samples were taken)
+        """
+        if not self._thread:
+            return {}
+        self._stopped.set()
+        self._thread.join()
+        try:
+            self._sample_scratch()
+        except OSError:
+            pass
+        if not self._samples:
+            return {}
+        elapsed = max(self._t_last - self._t_start, 1.0)
+        gib = 2 ** 30
+        return {
+            "cpu_seconds": round(self._cpu_ns / 1e9, 1),
+            "cpu_mean": round(self._cpu_ns / 1e9 / elapsed, 2),
+            "peak_memory_gb": round(self._peak_memory / gib, 2),
+            "read_gb": round(self._read_bytes / gib, 2),
+            "write_gb": round(self._write_bytes / gib, 2),
+            "peak_scratch_gb": round(self._peak_scratch / gib, 2),
+            "samples": self._samples,
+        }
+
+    def _run(self) -> None:
+        try:
+            client = docker.from_env(version="auto")
+            while not self._stopped.wait(self.interval):
+                if self._sample(client) and self._samples % self.scratch_every == 1:
+                    self._sample_scratch()
+        except Exception as exn:
+            # profiling is best-effort (e.g. the container may be run by another backend)
+            self._logger.debug(_("task profiling stopped", error=str(exn)))
+
+    def _find_container(self, client):
+        # the container running the task is the one with our working directory mounted
+        work_dir = os.path.realpath(self._container.host_work_dir())
+        for ctr in client.containers.list(filters={"label": f"miniwdl_run_id={self._container.run_id}"}):
+            if any(os.path.realpath(m.get("Source", "")) == work_dir for m in ctr.attrs.get("Mounts", [])):
+                return ctr
+        return None
+
+    def _sample(self, client) -> bool:
+        if self._docker_container is None:
+            self._docker_container = self._find_container(client)
+            if self._docker_container is None:
+                return False
+            m = re.match(r"(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?Z$",
+                         self._docker_container.attrs.get("State", {}).get("StartedAt", ""))
+            if m and not m.group(1).startswith("0001"):
+                self.started_at = calendar.timegm(time.strptime(m.group(1), "%Y-%m-%dT%H:%M:%S")) + float(
+                    m.group(2) or 0
+                )
+        try:
+            # one_shot skips waiting for a second sample to compute CPU percentage, which we don't use
+            stats = self._docker_container.stats(stream=False, one_shot=True)
+        except TypeError:
+            stats = self._docker_container.stats(stream=False)
+        except docker.errors.NotFound:
+            return False
+        memory_stats = stats.get("memory_stats") or {}
+        if not memory_stats:
+            # container exited
+            return False
+        self._t_last = time.time()
+        self._samples += 1
+        self._cpu_ns = max(self._cpu_ns, stats.get("cpu_stats", {}).get("cpu_usage", {}).get("total_usage", 0))
+        mem = memory_stats.get("stats", {})
+        cache = mem.get("inactive_file", mem.get("total_inactive_file", 0))
+        self._peak_memory = max(self._peak_memory, memory_stats.get("usage", 0) - cache)
+        read_bytes = write_bytes = 0
+        for entry in (stats.get("blkio_stats") or {}).get("io_service_bytes_recursive") or []:
+            op = entry.get("op", "").lower()
+            if op == "read":
+                read_bytes += entry.get("value", 0)
+            elif op == "write":
+                write_bytes += entry.get("value", 0)
+        self._read_bytes = max(self._read_bytes, read_bytes)
+        self._write_bytes = max(self._write_bytes, write_bytes)
+        return True
 
-def update_status_json(logger, task, run_ids, s3_wd_uri, entries):
+    def _sample_scratch(self) -> None:
+        total = 0
+        for dn, _subdirs, files in os.walk(self._container.host_work_dir()):
+            for fn in files:
+                try:
+                    total += os.lstat(os.path.join(dn, fn)).st_blocks * 512
+                except FileNotFoundError:
+                    pass
+        self._peak_scratch = max(self._peak_scratch, total)
+
+
+class StderrRateLimiter:
     """
-    Post short-read-mngs workflow status JSON files to the output S3 bucket. These status files
-    were originally created by idseq-dag, used to display pipeline progress in the IDseq webapp.
-    We update it at the beginning and end of each task (carefully, because some tasks run
-    concurrently).
+    Token bucket limiting the rate of task stderr lines logged to [sfn_wdl] stderr_lines_per_second
+    (default 100; 0 for no limit), with bursts up to [sfn_wdl] stderr_burst_lines (default 1000)
     """
-    global _status_json
 
-    if not s3_wd_uri:
-        return
+    def __init__(self, cfg: config.Loader) -> None:
+        self.rate = 100.0
+        self.burst = 1000.0
+        if cfg.has_option("sfn_wdl", "stderr_lines_per_second"):
+            self.rate = cfg["sfn_wdl"].get_float("stderr_lines_per_second")
+        if cfg.has_option("sfn_wdl", "stderr_burst_lines"):
+            self.burst = cfg["sfn_wdl"].get_float("stderr_burst_lines")
+        self.tokens = self.burst
+        self.t_last = time.monotonic()
+        self.suppressed = 0
+
+    def allow(self) -> bool:
+        if self.rate <= 0:
+            return True
+        t = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (t - self.t_last) * self.rate)
+        self.t_last = t
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.suppressed += 1
+        return False
 
+
+def workflow(cfg, logger, run_id, run_dir, workflow, **recv):
+    """
+    on workflow completion (or failure), write out any status updates still pending, and for the
+    top-level workflow, the timeline of its tasks
+    """
+    t_0 = time.time()
     try:
-        if os.getenv("OUTPUT_STATUS_JSON_FILES") == "true":
-            # Figure out workflow and step names:
-            # e.g. run_ids = ["host_filter", "call-validate_input"]
-            workflow_name = run_ids[0]
-            workflow_name = "_".join(workflow_name.split("_")[1:])
-            # parse --step-name from the task command template. For historical reasons, the status JSON
-            # keys use this name and it's not the same as the WDL task name.
-            step_name = task.name  # use WDL task name as default
-            step_name_re = re.compile(r"--step-name\s+(\S+)\s")
-            for part in task.command.parts:
-                m = step_name_re.search(part) if isinstance(part, str) else None
-                if m:
-                    step_name = m.group(1)
-            assert step_name, "reading --step-name from task command"
-
-            # Update _status_json which is accumulating over the course of workflow execution.
-            with _status_json_lock:
-                status_uri = os.path.join(s3_wd_uri, f"{workflow_name}_status2.json")
-
-                # If the run is being resumed via call caching _status_json will be empty even
-                #   though we should have step statuses. We need to populate it before
-                #   updating or we will overwrite previous steps.
-                #   This check will happen at the beginning of every run, whether or not it is
-                #   resumed. If there was no previous run then the object won't be found and
-                #   we do nothing
-                if not _status_json:
+        # (workflow plugins see the inputs, then the outputs)
+        recv = yield recv
+        yield recv
+    finally:
+        flush_status_json()
+        if len(run_id) == 1 and (
+            not cfg.has_option("sfn_wdl", "timeline") or cfg["sfn_wdl"].get_bool("timeline")
+        ):
+            try:
+                write_timeline(logger, run_id, run_dir, workflow, get_s3_put_prefix(cfg), t_0)
+            except Exception as exn:
+                logger.warning(_("failed to write timeline", error=str(exn)))
+
+
+_timelines: Dict[str, List[Tuple[List[str], List[Tuple[str, float, float]]]]] = {}
+_timelines_lock = threading.Lock()
+
+
+def record_timeline(run_id: List[str], phases: List[Tuple[str, float, float]]) -> None:
+    """
+    record the (name, start, end) phases of a task (or a workflow's own work) for the timeline of
+    the top-level workflow run_id[0]
+    """
+    with _timelines_lock:
+        _timelines.setdefault(run_id[0], []).append((list(run_id), [p for p in phases if p[2] > p[1]]))
+
+
+def write_timeline(logger, run_id, run_dir, workflow, s3_wd_uri, t_0) -> None:
+    """
+    Write the recorded timeline as {workflow_name}_timeline.json, in Chrome trace event format
+    (viewable in chrome://tracing or https://ui.perfetto.dev), to the run directory and next to
+    outputs.s3.json. Its otherData.critical_path is the chain of top-level calls, ending with the
+    last to finish, in which each waited on the one before it (its last-finishing dependency).
+    """
+    with _timelines_lock:
+        records = _timelines.pop(run_id[0], [])
+    events = []
+    calls: Dict[str, Tuple[float, float]] = {}
+    for tid, (ids, phases) in enumerate(sorted(records, key=lambda r: min(p[1] for p in r[1]) if r[1] else 0)):
+        if not phases:
+            continue
+        call = ".".join(ids[1:]) or ids[0]
+        start, end = min(p[1] for p in phases), max(p[2] for p in phases)
+        events.append(dict(name=call, cat="call", ph="X", ts=int((start - t_0) * 1e6), dur=int((end - start) * 1e6),
+                           pid=1, tid=tid))
+        for name, p_start, p_end in phases:
+            events.append(dict(name=name, cat="phase", ph="X", ts=int((p_start - t_0) * 1e6),
+                               dur=int((p_end - p_start) * 1e6), pid=1, tid=tid, args={"call": call}))
+        if len(ids) > 1:
+            # aggregate scatter instances & subworkflow tasks to the top-level call node, e.g.
+            # call-foo-3 to call-foo (WDL identifiers can't contain -)
+            node_id = "-".join(ids[1].split("-")[:2])
+            prev = calls.get(node_id, (start, end))
+            calls[node_id] = (min(prev[0], start), max(prev[1], end))
+
+    critical_path = []
+    node_id = max(calls, key=lambda n: calls[n][1]) if calls else None
+    while node_id:
+        start, end = calls[node_id]
+        critical_path.append({"call": node_id, "start_seconds": round(start - t_0, 3),
+                              "end_seconds": round(end - t_0, 3), "seconds": round(end - start, 3)})
+        deps = [dep for dep in call_dependencies(workflow, node_id) if dep in calls and calls[dep][1] <= start]
+        node_id = max(deps, key=lambda n: calls[n][1]) if deps else None
+    critical_path.reverse()
+    logger.notice(_("critical path", calls=[(c["call"], c["seconds"]) for c in critical_path]))
+
+    workflow_name = "_".join(run_id[0].split("_")[1:])
+    body = json.dumps(
+        {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"critical_path": critical_path}}
+    )
+    with open(os.path.join(run_dir, f"{workflow_name}_timeline.json"), "w") as outfile:
+        outfile.write(body)
+    if s3_wd_uri:
+        output_uri = os.environ.get("WDL_OUTPUT_URI", os.path.join(s3_wd_uri, "outputs.s3.json"))
+        s3_object(os.path.join(os.path.dirname(output_uri), f"{workflow_name}_timeline.json")).put(
+            Body=body.encode()
+        )
+
+
+def call_dependencies(workflow, node_id: str) -> Set[str]:
+    """
+    ids of the call nodes that the workflow node depends on, directly or through declarations,
+    gathers, and enclosing sections
+    """
+    sections = {}
+
+    def walk(nodes, section):
+        for node in nodes:
+            sections[node.workflow_node_id] = section
+            if isinstance(node, WDL.Tree.WorkflowSection):
+                walk(node.body, node)
+                walk(node.gathers.values(), node)
+
+    walk(workflow.body, None)
+    ans: Set[str] = set()
+    visited: Set[str] = set()
+    pending = [node_id]
+    while pending:
+        node = workflow.get_node(pending.pop())
+        deps = set(node.workflow_node_dependencies)
+        if sections.get(node.workflow_node_id):
+            deps.add(sections[node.workflow_node_id].workflow_node_id)
+        for dep in deps - visited:
+            visited.add(dep)
+            if isinstance(workflow.get_node(dep), WDL.Tree.Call):
+                ans.add(dep)
+            else:
+                pending.append(dep)
+    return ans
+
+
+# parse --step-name from the task command template. For historical reasons, the status JSON keys
+# use this name and it's not the same as the WDL task name.
+_step_name_re = re.compile(r"--step-name\s+(\S+)\s")
+
+
+def task_step_name(task) -> str:
+    step_name = task.name  # use WDL task name as default
+    for part in task.command.parts:
+        m = _step_name_re.search(part) if isinstance(part, str) else None
+        if m:
+            step_name = m.group(1)
+    assert step_name, "reading --step-name from task command"
+    return step_name
+
+
+class StatusWriter:
+    """
+    Accumulates the status JSON for one workflow over the course of its execution, and writes it to
+    S3 from a background thread, coalescing the updates made within window seconds into one PUT,
+    so that tasks never wait on status writes.
+    """
+
+    def __init__(self, logger, status_uri: str, window: float) -> None:
+        self._logger = logger
+        self._status_uri = status_uri
+        self._window = window
+        self._status_json: Optional[Dict[str, Any]] = None
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._cond = threading.Condition()
+        # serializes flushes (from the background thread and synchronous callers)
+        self._flush_lock = threading.Lock()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def update(self, step_name: str, entries: Dict[str, Any]) -> None:
+        with self._cond:
+            self._pending.setdefault(step_name, {}).update(entries)
+            self._cond.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            time.sleep(self._window)
+            self.flush()
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            with self._cond:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            try:
+                if self._status_json is None:
+                    # If the run is being resumed via call caching the existing status JSON will have
+                    #   step statuses, which we need to populate before updating or we will overwrite
+                    #   previous steps. If there was no previous run then the object won't be found
+                    #   and we start afresh.
                     try:
-                        # Populate _status_json with the existing status_json
-                        _status_json = json.loads(s3_object(status_uri).get()["Body"].read().decode())
+                        self._status_json = json.loads(s3_object(self._status_uri).get()["Body"].read().decode())
                     except botocore.exceptions.ClientError as e:
                         # If the error is not 404 it was something other than the object
                         #   not existing, so we want to raise it.
                         if e.response['Error']['Code'] != "NoSuchKey":
                             raise e
-
-                status = _status_json.setdefault(step_name, {})
-                for k, v in entries.items():
-                    status[k] = v
+                        self._status_json = {}
+                for step_name, entries in pending.items():
+                    self._status_json.setdefault(step_name, {}).update(entries)
 
                 # Upload it
-                logger.verbose(
-                    _("update_status_json", step_name=step_name, status=status)
-                )
-                s3_object(status_uri).put(Body=json.dumps(_status_json).encode())
-    except Exception as exn:
-        logger.error(
-            _(
-                "update_status_json failed",
-                error=str(exn),
-                s3_wd_uri=s3_wd_uri,
-                run_ids=run_ids,
-            )
-        )
-        # Don't allow mere inability to update status to crash the whole workflow.
+                self._logger.verbose(_("update_status_json", status_uri=self._status_uri, steps=list(pending)))
+                s3_object(self._status_uri).put(Body=json.dumps(self._status_json).encode())
+            except Exception as exn:
+                self._logger.error(_("update_status_json failed", error=str(exn), status_uri=self._status_uri))
+                # Don't allow mere inability to update status to crash the whole workflow; retry the
+                # updates with the next flush
+                with self._cond:
+                    for step_name, entries in pending.items():
+                        self._pending[step_name] = {**entries, **self._pending.get(step_name, {})}
+
+
+_status_writers: Dict[str, StatusWriter] = {}
+_status_writers_lock = threading.Lock()
+
+
+def update_status_json(logger, cfg, step_name, run_ids, s3_wd_uri, entries):
+    """
+    Post short-read-mngs workflow status JSON files to the output S3 bucket. These status files
+    were originally created by idseq-dag, used to display pipeline progress in the IDseq webapp.
+    We update it at the beginning and end of each task (carefully, because some tasks run
+    concurrently).
+    """
+    if not s3_wd_uri or os.getenv("OUTPUT_STATUS_JSON_FILES") != "true":
+        return
+
+    # Figure out workflow name:
+    # e.g. run_ids = ["host_filter", "call-validate_input"]
+    workflow_name = run_ids[0]
+    workflow_name = "_".join(workflow_name.split("_")[1:])
+    status_uri = os.path.join(s3_wd_uri, f"{workflow_name}_status2.json")
+    with _status_writers_lock:
+        writer = _status_writers.get(status_uri)
+        if writer is None:
+            window = 2.0
+            if cfg.has_option("sfn_wdl", "status_json_coalesce_seconds"):
+                window = cfg["sfn_wdl"].get_float("status_json_coalesce_seconds")
+            writer = _status_writers[status_uri] = StatusWriter(logger, status_uri, window)
+    writer.update(step_name, entries)
+
+
+def flush_status_json():
+    """
+    write out pending status updates now
+    """
+    with _status_writers_lock:
+        writers = list(_status_writers.values())
+    for writer in writers:
+        writer.flush()
+
+
+atexit.register(flush_status_json)
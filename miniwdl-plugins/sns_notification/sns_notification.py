@@ -1,10 +1,19 @@
 """
 Send SNS notifications after each miniwdl step
+
+Messages are queued and published from a background thread, in batches of up to 10 with
+PublishBatch, so that tasks don't wait on SNS; the queue is flushed at the end of the workflow.
+A message whose outputs would exceed SNS's 256 KiB limit (e.g. large file array outputs) has its
+detail stored in S3 under the upload prefix instead, replaced by {"swipe_offload_uri": <uri>}.
 """
 
 import os
 import json
-from typing import Dict
+import queue
+import atexit
+import hashlib
+import threading
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime
 from WDL import values_to_json
 from WDL._util import StructuredLogMessage as _
@@ -12,8 +21,13 @@ from WDL._util import StructuredLogMessage as _
 import boto3
 
 sns_client = boto3.client("sns", endpoint_url=os.getenv("AWS_ENDPOINT_URL"))
+s3_client = boto3.client("s3", endpoint_url=os.getenv("AWS_ENDPOINT_URL"))
 topic_arn = os.getenv('STEP_NOTIFICATION_TOPIC_ARN')
 
+# SNS limits the message (including attributes) and also the whole PublishBatch request to 256 KiB
+MAX_MESSAGE_BYTES = 256 * 1024
+MAX_BATCH_ENTRIES = 10
+
 
 def process_outputs(outputs: Dict):
     """process outputs dict into string to be passed into SQS"""
@@ -31,6 +45,115 @@ def send_message(attr, body):
     return sns_resp
 
 
+def message_size(attr, body: str) -> int:
+    return len(body.encode()) + sum(
+        len(k) + len(v["DataType"]) + len(v["StringValue"].encode()) for k, v in attr.items()
+    )
+
+
+def offload_detail(s3prefix: Optional[str], attr, message_body: Dict) -> str:
+    """
+    the message body, with its detail stored in S3 if it'd make the message too large for SNS
+    """
+    body = json.dumps(message_body)
+    if message_size(attr, body) <= MAX_MESSAGE_BYTES:
+        return body
+    assert s3prefix, "notification too large for SNS and no S3 prefix to offload it to"
+    detail = message_body["detail"].encode()
+    bucket, prefix = s3prefix[5:].split("/", 1) if "/" in s3prefix[5:] else (s3prefix[5:], "")
+    key = os.path.join(prefix, "sns_notifications", hashlib.sha256(detail).hexdigest() + ".json")
+    s3_client.put_object(Bucket=bucket, Key=key, Body=detail)
+    return json.dumps({**message_body, "detail": json.dumps({"swipe_offload_uri": f"s3://{bucket}/{key}"})})
+
+
+class NotificationQueue:
+    """
+    Publishes queued messages from a background thread, batching those waiting at the time
+    """
+
+    def __init__(self, logger) -> None:
+        self._logger = logger
+        self._queue: "queue.Queue[Tuple[Optional[str], Dict, Dict]]" = queue.Queue()
+        if not hasattr(sns_client, "publish_batch"):
+            logger.warning(
+                _("boto3 lacks sns publish_batch; publishing messages individually", boto3_version=boto3.__version__)
+            )
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def put(self, s3prefix: Optional[str], attr, message_body: Dict) -> None:
+        self._queue.put((s3prefix, attr, message_body))
+
+    def flush(self) -> None:
+        """
+        wait until all messages queued so far have been published (or failed to)
+        """
+        self._queue.join()
+
+    def _run(self) -> None:
+        while True:
+            items = [self._queue.get()]
+            while len(items) < MAX_BATCH_ENTRIES:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                messages = []
+                for s3prefix, attr, message_body in items:
+                    try:
+                        messages.append((attr, offload_detail(s3prefix, attr, message_body)))
+                    except Exception as exn:
+                        self._logger.error(_("failed to prepare sns message", error=str(exn)))
+                self._publish(messages)
+            finally:
+                for _item in items:
+                    self._queue.task_done()
+
+    def _publish(self, messages: List[Tuple[Dict, str]]) -> None:
+        # split into batches within the request size limit
+        batches: List[List[Tuple[Dict, str]]] = [[]]
+        batch_size = 0
+        for attr, body in messages:
+            size = message_size(attr, body)
+            if batches[-1] and batch_size + size > MAX_MESSAGE_BYTES:
+                batches.append([])
+                batch_size = 0
+            batches[-1].append((attr, body))
+            batch_size += size
+        for batch in batches:
+            failed = batch
+            if len(batch) > 1 and hasattr(sns_client, "publish_batch"):
+                try:
+                    resp = sns_client.publish_batch(
+                        TopicArn=topic_arn,
+                        PublishBatchRequestEntries=[
+                            {"Id": str(i), "Message": body, "MessageAttributes": attr}
+                            for i, (attr, body) in enumerate(batch)
+                        ],
+                    )
+                    failed = [batch[int(entry["Id"])] for entry in resp.get("Failed", [])]
+                except Exception as exn:
+                    self._logger.warning(_("sns publish_batch failed; publishing individually", error=str(exn)))
+            for attr, body in failed:
+                try:
+                    send_message(attr, body)
+                except Exception as exn:
+                    self._logger.error(_("failed to send sns message", error=str(exn)))
+
+
+_notification_queue: Optional[NotificationQueue] = None
+_notification_queue_lock = threading.Lock()
+
+
+def notification_queue(logger) -> NotificationQueue:
+    global _notification_queue
+    with _notification_queue_lock:
+        if _notification_queue is None:
+            _notification_queue = NotificationQueue(logger.getChild("sns_step_notification"))
+            atexit.register(_notification_queue.flush)
+        return _notification_queue
+
+
 def task(cfg, logger, run_id, run_dir, task, **recv):
     """
     on completion of any task sends a message to sns with the output files
@@ -48,11 +171,12 @@ def task(cfg, logger, run_id, run_dir, task, **recv):
         message_attributes = {
             "WorkflowName": {"DataType": "String", "StringValue": run_id[0]},
             "TaskName": {"DataType": "String", "StringValue": run_id[-1]},
-            "ExecutionId": {
-                "DataType": "String",
-                "StringValue": "execution_id_to_be_passed_in",
-            },
         }
+        if os.getenv("SFN_EXECUTION_ID"):
+            message_attributes["ExecutionId"] = {
+                "DataType": "String",
+                "StringValue": os.environ["SFN_EXECUTION_ID"],
+            }
 
         outputs = process_outputs(values_to_json(recv["outputs"]))
         message_body = {
@@ -65,7 +189,10 @@ def task(cfg, logger, run_id, run_dir, task, **recv):
             "resources": [],
             "detail": outputs,
         }
-        send_message(message_attributes, json.dumps(message_body))
+        s3prefix = None
+        if cfg.has_option("s3_progressive_upload", "uri_prefix"):
+            s3prefix = cfg["s3_progressive_upload"]["uri_prefix"]
+        notification_queue(logger).put(s3prefix, message_attributes, message_body)
 
     yield recv
 
@@ -73,8 +200,12 @@ def task(cfg, logger, run_id, run_dir, task, **recv):
 def workflow(cfg, logger, run_id, run_dir, workflow, **recv):
     log = logger.getChild("sns_step_notification")
 
-    # ignore inputs
-    recv = yield recv
-
-    log.info(_("ignores workflow calls"))
-    yield recv
+    try:
+        # ignore inputs
+        recv = yield recv
+        yield recv
+    finally:
+        # publish the notifications still queued
+        if _notification_queue:
+            log.info(_("flushing sns notifications"))
+            _notification_queue.flush()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+Keeps miniwdl's download cache directory within a size budget, evicting entries by a cost-aware
+LRU/LFU policy (Greedy-Dual-Size-Frequency): each entry's priority is the cost of fetching it
+again per byte of space it takes, times the number of times it's been used, plus an "inflation"
+value that rises as entries are evicted, so that entries not used for a while eventually go too.
+Small files that are expensive to refetch relative to their size, and large reference databases
+that are used by job after job, stay warm; a large file used once goes first.
+
+The cache's entries (downloaded files, downloaded directories, and the s3parcp plugin's stored
+directory versions) are indexed in <cache dir>/_cache_index.json with their size, last access and
+hit count. An entry counts as accessed when its atime or mtime advances, or when it's found in use:
+flocked by a miniwdl process, which holds a shared flock on each cache entry it's using (for a
+directory, on the adjacent <entry>._miniwdl_flock file). Scanning reads the flocks from /proc/locks
+rather than probing them, so it never makes miniwdl's nonblocking flock of an entry fail. Entries
+in use are never evicted: each is deleted only under a nonblocking exclusive flock, taken while
+holding miniwdl's cache-wide _miniwdl_flock, so eviction can run in the background without
+blocking downloads. Sizes count each file once, however many entries hardlink it.
+
+usage: download_cache_manager.py CACHE_DIR MAX_GB [--interval SECONDS | --once]
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import uuid
+import re
+import argparse
+from typing import Any, Dict, Iterator, Optional, Set, Tuple
+
+INDEX = "_cache_index.json"
+# estimated cost of fetching an entry again: a fixed overhead (e.g. starting a download container)
+# plus the transfer time
+FETCH_OVERHEAD_SECONDS = 5.0
+FETCH_BYTES_PER_SECOND = 200e6
+
+
+def entries(cache_dir: str) -> Iterator[str]:
+    """
+    cache entries, as paths relative to cache_dir
+    """
+    # files/<scheme>/<host>/<path>/<name> are files, dirs/<scheme>/<host>/<path>/<name> are
+    # directories, and so are _s3dir/<bucket>/<prefix hash>/<fingerprint>
+    for top, depth in (("files", None), ("dirs", 4), ("_s3dir", 3)):
+        root = os.path.join(cache_dir, top)
+        for dn, subdirs, files in os.walk(root):
+            level = os.path.relpath(dn, root).count(os.sep) + 1 if dn != root else 0
+            if depth is None:
+                for fn in files:
+                    yield os.path.relpath(os.path.join(dn, fn), cache_dir)
+            elif level == depth - 1:
+                for sub in subdirs:
+                    # skip _s3dir entries still being downloaded
+                    if not sub.startswith("tmp_"):
+                        yield os.path.relpath(os.path.join(dn, sub), cache_dir)
+                subdirs.clear()
+
+
+def lock_path(path: str) -> str:
+    """
+    the file miniwdl flocks to use the cache entry at path: the file itself, or for a directory, an
+    adjacent lockfile (as not all filesystems support flocking directories)
+    """
+    return path + "._miniwdl_flock" if os.path.isdir(path) else path
+
+
+def disk_usage(path: str, seen: Set[Tuple[int, int]]) -> int:
+    """
+    bytes taken by the file or directory at path, not counting files already seen (by device &
+    inode), such as hardlinks between downloaded directories and the s3parcp plugin's stored copies
+    """
+    total = 0
+    for fn in [path] if not os.path.isdir(path) else (
+        os.path.join(dn, fn) for dn, _, files in os.walk(path) for fn in files
+    ):
+        st = os.lstat(fn)
+        if (st.st_dev, st.st_ino) not in seen:
+            seen.add((st.st_dev, st.st_ino))
+            total += st.st_blocks * 512
+    return total
+
+
+def locked_files() -> Optional[Set[Tuple[int, int]]]:
+    """
+    the (device, inode) of each file flocked by any process, as listed in /proc/locks (Linux); or
+    None if that's unavailable
+    """
+    try:
+        with open("/proc/locks") as infile:
+            lines = infile.read().splitlines()
+    except OSError:
+        return None
+    ans = set()
+    for line in lines:
+        # e.g. "1: FLOCK  ADVISORY  READ 1234 fd:01:5678 0 EOF", where the device numbers are hex
+        for field in line.split():
+            found = re.fullmatch(r"([0-9a-f]+):([0-9a-f]+):(\d+)", field)
+            if found:
+                ans.add((os.makedev(int(found.group(1), 16), int(found.group(2), 16)), int(found.group(3))))
+                break
+    return ans
+
+
+def in_use(path: str, locked: Optional[Set[Tuple[int, int]]]) -> bool:
+    """
+    whether the cache entry at path is flocked by a miniwdl process using it. Without /proc/locks,
+    probe with a nonblocking shared flock, which doesn't get in the way of miniwdl's own shared
+    flocks (but only detects exclusive ones, i.e. an entry being added or removed).
+    """
+    try:
+        st = os.stat(lock_path(path))
+    except FileNotFoundError:
+        # a directory nobody has flocked yet
+        return False
+    if locked is not None:
+        return (st.st_dev, st.st_ino) in locked
+    fd = os.open(lock_path(path), os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        return False
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+
+
+def try_flock(path: str, create: bool = False) -> Any:
+    """
+    open path and take a nonblocking exclusive flock on it, returning the file descriptor; or None if
+    it's flocked by someone else (i.e. in use)
+    """
+    fd = os.open(path, os.O_RDONLY | (os.O_CREAT if create else 0), 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return fd
+    except BlockingIOError:
+        os.close(fd)
+        return None
+
+
+def cost_per_byte(size: int) -> float:
+    size = max(size, 1 << 20)
+    return (FETCH_OVERHEAD_SECONDS + size / FETCH_BYTES_PER_SECOND) / (size / 2 ** 30)
+
+
+def load_index(cache_dir: str) -> Dict[str, Any]:
+    try:
+        with open(os.path.join(cache_dir, INDEX)) as infile:
+            return json.load(infile)
+    except (FileNotFoundError, ValueError):
+        return {"inflation": 0.0, "entries": {}}
+
+
+def save_index(cache_dir: str, index: Dict[str, Any]) -> None:
+    tmp = os.path.join(cache_dir, INDEX + ".tmp")
+    with open(tmp, "w") as outfile:
+        json.dump(index, outfile)
+    os.replace(tmp, os.path.join(cache_dir, INDEX))
+
+
+def scan(cache_dir: str, index: Dict[str, Any]) -> None:
+    """
+    bring the index up to date with the cache directory, without taking any flocks (which could
+    make a concurrent miniwdl lookup of the entry miss)
+    """
+    now = time.time()
+    indexed = index["entries"]
+    found = {}
+    locked = locked_files()
+    seen: Set[Tuple[int, int]] = set()
+    for entry in entries(cache_dir):
+        path = os.path.join(cache_dir, entry)
+        try:
+            st = os.stat(path)
+            size = disk_usage(path, seen)
+            entry_in_use = in_use(path, locked)
+        except FileNotFoundError:
+            continue
+        info = indexed.get(entry)
+        if info is None:
+            info = {"size": size, "last_access": st.st_mtime, "hits": 1, "in_use": False}
+            info["priority"] = index["inflation"] + cost_per_byte(info["size"])
+        info["size"] = size
+        used = max(st.st_atime, st.st_mtime)
+        if used > info["last_access"] + 1 or (entry_in_use and not info["in_use"]):
+            # a new access (the atime may lag, depending on the filesystem's mount options)
+            info["hits"] += 1
+            info["last_access"] = max(used, now if entry_in_use else 0)
+            info["priority"] = index["inflation"] + info["hits"] * cost_per_byte(info["size"])
+        elif entry_in_use:
+            info["last_access"] = now
+        info["in_use"] = entry_in_use
+        found[entry] = info
+    index["entries"] = found
+
+
+def evict(cache_dir: str, index: Dict[str, Any], max_bytes: int) -> Tuple[int, int]:
+    """
+    delete lowest-priority entries not in use until the cache fits in max_bytes; returns the number
+    of entries and bytes evicted
+    """
+    indexed = index["entries"]
+    open(os.path.join(cache_dir, "_miniwdl_flock"), "a").close()
+    total = sum(info["size"] for info in indexed.values())
+    evicted = evicted_bytes = 0
+    for entry in sorted(indexed, key=lambda e: (indexed[e]["priority"], indexed[e]["last_access"])):
+        if total <= max_bytes:
+            break
+        info = indexed[entry]
+        path = os.path.join(cache_dir, entry)
+        # transient exclusive flock on the whole cache directory (miniwdl's protocol for adding and
+        # removing entries), without waiting for it
+        lock = try_flock(os.path.join(cache_dir, "_miniwdl_flock"))
+        if lock is None:
+            break
+        doomed = None
+        try:
+            lockfile = lock_path(path)
+            fd = try_flock(lockfile, create=lockfile != path)
+            if fd is None:
+                continue
+            try:
+                if lockfile != path:
+                    # rename first, so that an interrupted deletion can't leave a partial directory
+                    # to be found in the cache, and to delete its contents after releasing the lock
+                    doomed = os.path.join(os.path.dirname(path), ".rmtree_atomic." + str(uuid.uuid4()))
+                    os.rename(path, doomed)
+                    os.unlink(lockfile)
+                else:
+                    os.unlink(path)
+            finally:
+                os.close(fd)
+        except FileNotFoundError:
+            pass
+        finally:
+            os.close(lock)
+        if doomed:
+            shutil.rmtree(doomed, ignore_errors=True)
+        del indexed[entry]
+        index["inflation"] = max(index["inflation"], info["priority"])
+        total -= info["size"]
+        evicted += 1
+        evicted_bytes += info["size"]
+    return evicted, evicted_bytes
+
+
+def run_once(cache_dir: str, max_bytes: int) -> None:
+    index = load_index(cache_dir)
+    scan(cache_dir, index)
+    evicted, evicted_bytes = evict(cache_dir, index, max_bytes)
+    save_index(cache_dir, index)
+    if evicted:
+        print(
+            f"download_cache_manager: evicted {evicted} entries ({evicted_bytes / 2 ** 30:.1f} GiB) from {cache_dir}",
+            file=sys.stderr,
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("cache_dir")
+    parser.add_argument("max_gb", type=float)
+    parser.add_argument("--interval", type=float, default=60.0, help="seconds between passes")
+    parser.add_argument("--once", action="store_true", help="make one pass and exit")
+    args = parser.parse_args()
+    max_bytes = int(args.max_gb * 2 ** 30)
+    os.makedirs(args.cache_dir, exist_ok=True)
+
+    # only one manager at a time per cache directory (e.g. with several jobs on the instance)
+    with open(os.path.join(args.cache_dir, "_cache_manager_flock"), "w") as manager_lock:
+        while True:
+            try:
+                fcntl.flock(manager_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if args.once:
+                    return 0
+                time.sleep(args.interval)
+        while True:
+            run_once(args.cache_dir, max_bytes)
+            if args.once:
+                return 0
+            time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
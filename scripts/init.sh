@@ -47,10 +47,12 @@ clean_wd() {
   (shopt -s nullglob;
   for wf_log in $MINIWDL_DIR/20??????_??????_*/workflow.log; do
     flock -n $wf_log rm -rf $(dirname $wf_log) || true;
-  done;
-  flock -x $MINIWDL_DIR/download_cache/_miniwdl_flock clean_download_cache.sh $MINIWDL_DIR/download_cache $DOWNLOAD_CACHE_MAX_GB)
+  done)
 }
 clean_wd
+# keep the download cache within its budget in the background, without blocking downloads
+download_cache_manager.py $MINIWDL_DIR/download_cache ${DOWNLOAD_CACHE_MAX_GB:-500} --interval 60 &
+DOWNLOAD_CACHE_MANAGER_PID=$!
 df -h / $MINIWDL_DIR
 export MINIWDL__S3_PROGRESSIVE_UPLOAD__URI_PREFIX=$(dirname "$WDL_OUTPUT_URI")
 
@@ -100,3 +102,7 @@ handle_error() {
 trap handle_error EXIT
 miniwdl run $PASSTHRU_ARGS --dir $MINIWDL_DIR $(basename "$WDL_WORKFLOW_URI") --input wdl_input.json --verbose --error-json -o wdl_output.json
 clean_wd
+# leave the cache within its budget for the next job on this instance (without failing this one)
+kill $DOWNLOAD_CACHE_MANAGER_PID && wait $DOWNLOAD_CACHE_MANAGER_PID || true
+download_cache_manager.py $MINIWDL_DIR/download_cache ${DOWNLOAD_CACHE_MAX_GB:-500} --once \
+  || echo "WARNING: download cache eviction failed" >> /dev/stderr
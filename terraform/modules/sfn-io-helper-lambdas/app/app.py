@@ -11,7 +11,8 @@ The helper Lambda performs the following functions:
   lifting, but while Batch jobs can receive symbolic input via their command and environment variables, they cannot
   directly generate symbolic output. AWS Lambda can do that, so we have the Batch jobs upload their output as JSON
   to S3, and this function downloads and emits it as output. The state machine can then use this Lambda to load this
-  data into its state.
+  data into its state. Output values too large for the state are left in S3 and referenced as
+  {"swipe_offload_uri": "s3://..."}, to be resolved when wiring them into the input of a later stage.
 
 - It acts as an I/O mapping adapter for legacy I/O names for different stages. The original workflows used implicit
   matching of filenames to map the outputs of one workflow to the inputs of the next. The WDL workflows require the
@@ -31,6 +32,7 @@ The helper Lambda performs the following functions:
 import os
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from sfn_io_helper import batch_events, reporting, stage_io
 
@@ -50,12 +52,24 @@ def preprocess_input(sfn_data, _):
 
 def process_stage_output(sfn_data, _):
     assert sfn_data["CurrentState"].endswith("ReadOutput")
-    stage_io.broadcast_stage_complete(
-        sfn_data["ExecutionId"],
-        sfn_data["CurrentState"][:-len("ReadOutput")],
-    )
-    sfn_state = stage_io.read_state_from_s3(sfn_state=sfn_data["Input"], current_state=sfn_data["CurrentState"])
-    stage_io.link_outputs(sfn_state)
+    # overlap the completion broadcast and the stage IO map fetch with reading the stage output
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        broadcast = executor.submit(
+            stage_io.broadcast_stage_complete,
+            sfn_data["ExecutionId"],
+            sfn_data["CurrentState"][:-len("ReadOutput")],
+        )
+        stage_io_dict = executor.submit(stage_io.get_stage_io_map, sfn_data["Input"])
+        try:
+            sfn_state = stage_io.read_state_from_s3(sfn_state=sfn_data["Input"], current_state=sfn_data["CurrentState"])
+            stage_io.link_outputs(sfn_state, stage_io_dict=stage_io_dict.result(), changed_only=True)
+        except Exception:
+            # raise this error, but don't lose a broadcast failure behind it
+            broadcast_error = broadcast.exception()
+            if broadcast_error is not None:
+                logging.error("Stage complete broadcast also failed", exc_info=broadcast_error)
+            raise
+        broadcast.result()
     sfn_state = stage_io.trim_batch_job_details(sfn_state=sfn_state)
     return sfn_state
 
@@ -0,0 +1,55 @@
+"""
+In-memory cache of JSON configuration objects in S3 (such as the stage IO map), so that warm Lambda containers serve
+them from memory. Entries younger than CONFIG_CACHE_TTL_SECONDS (default 300) are served as is; older ones are
+revalidated with a conditional GET on their ETag, which costs a round trip but no transfer if they're unchanged.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from typing import Any, Dict, Tuple
+
+from botocore.exceptions import ClientError  # type: ignore
+
+from . import s3
+
+logger = logging.getLogger()
+
+ttl_seconds = float(os.environ.get("CONFIG_CACHE_TTL_SECONDS", 300))
+
+# uri -> (time fetched or revalidated, ETag, parsed JSON)
+_cache: Dict[str, Tuple[float, str, Any]] = {}
+_lock = threading.Lock()
+counters = {"hit": 0, "revalidated": 0, "miss": 0}
+
+
+def get_json(uri: str) -> Any:
+    """
+    The parsed JSON object at uri, which callers must not modify (it's shared with later invocations)
+    """
+    bucket, key = uri.split("/", 3)[2:]
+    now = time.time()
+    with _lock:
+        entry = _cache.get(uri)
+    if entry and now - entry[0] < ttl_seconds:
+        outcome = "hit"
+        value = entry[2]
+    else:
+        kwargs = {"IfNoneMatch": entry[1]} if entry else {}
+        try:
+            response = s3.meta.client.get_object(Bucket=bucket, Key=key, **kwargs)
+            outcome = "miss"
+            value = json.loads(response["Body"].read().decode())
+            etag = response["ETag"]
+        except ClientError as e:
+            if not entry or e.response["Error"]["Code"] not in ("304", "NotModified"):
+                raise e
+            outcome = "revalidated"
+            value, etag = entry[2], entry[1]
+        with _lock:
+            _cache[uri] = (now, etag, value)
+    with _lock:
+        counters[outcome] += 1
+        logger.info("config cache %s for %s (%s)", outcome, uri, ", ".join(f"{k}={v}" for k, v in counters.items()))
+    return value
@@ -1,18 +1,27 @@
 import os
 import re
 import json
+import hashlib
 import logging
-from typing import List
+from typing import Any, Dict, List
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from uuid import uuid4
 
 from botocore import xform_name
 from botocore.exceptions import ClientError  # type: ignore
 
-from . import s3_object, sqs
+from . import config_cache, s3, s3_object, sqs
 
 logger = logging.getLogger()
 
+# Result values and state subtrees larger than this (as JSON) are kept in S3 rather than in the Step Functions state,
+# which is limited to 256 KiB, and replaced with {"swipe_offload_uri": "s3://..."}
+offload_threshold_bytes = int(os.environ.get("STATE_OFFLOAD_THRESHOLD_BYTES", 16384))
+# If the state is still larger than this, its largest values are offloaded too, however small, until it fits
+state_budget_bytes = int(os.environ.get("STATE_SIZE_BUDGET_BYTES", 192 * 1024))
+OFFLOAD_URI_KEY = "swipe_offload_uri"
+
 
 def get_input_uri_key(stage):
     return f"{xform_name(stage).upper()}_INPUT_URI"
@@ -28,8 +37,49 @@ def get_stage_input(sfn_state, stage):
 
 
 def put_stage_input(sfn_state, stage, stage_input):
-    input_uri = sfn_state[get_input_uri_key(stage)]
-    s3_object(input_uri).put(Body=json.dumps(stage_input).encode())
+    # use the (thread-safe) client, as link_outputs writes stage inputs concurrently
+    bucket, key = sfn_state[get_input_uri_key(stage)].split("/", 3)[2:]
+    s3.meta.client.put_object(Bucket=bucket, Key=key, Body=json.dumps(resolve_offloaded(stage_input)).encode())
+
+
+def offload(sfn_state, value, force=False):
+    """
+    If value is larger than the offload threshold as JSON (or force), store it in S3 (next to the stage inputs and
+    outputs, named by its content hash) and return a reference to it; otherwise return value itself.
+    """
+    body = json.dumps(value, sort_keys=True).encode()
+    if (len(body) <= offload_threshold_bytes and not force) or is_offloaded(value):
+        return value
+    output_uri = next(v for k, v in sfn_state.items() if k.endswith("_OUTPUT_URI"))
+    bucket, key = os.path.dirname(output_uri).split("/", 3)[2:]
+    key = os.path.join(key, "sfn_state", hashlib.sha256(body).hexdigest() + ".json")
+    s3.meta.client.put_object(Bucket=bucket, Key=key, Body=body)
+    return {OFFLOAD_URI_KEY: f"s3://{bucket}/{key}"}
+
+
+def is_offloaded(value):
+    return isinstance(value, dict) and list(value) == [OFFLOAD_URI_KEY]
+
+
+_offloaded: Dict[str, Any] = {}
+
+
+def resolve_offloaded(value):
+    """
+    value with any references to offloaded values (at any depth) replaced by the values themselves
+    """
+    if is_offloaded(value):
+        uri = value[OFFLOAD_URI_KEY]
+        # offloaded objects are named by their content hash, so never change
+        if uri not in _offloaded:
+            bucket, key = uri.split("/", 3)[2:]
+            _offloaded[uri] = json.loads(s3.meta.client.get_object(Bucket=bucket, Key=key)["Body"].read().decode())
+        return resolve_offloaded(_offloaded[uri])
+    if isinstance(value, dict):
+        return {k: resolve_offloaded(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [resolve_offloaded(v) for v in value]
+    return value
 
 
 def get_stage_output(sfn_state, stage):
@@ -56,21 +106,52 @@ def read_state_from_s3(sfn_state, current_state):
             error_type = type(stage_output["error"], (Exception,), dict())
             raise error_type(stage_output.get("cause", stage_output.get("message")))
 
-    # HACK: don't include list outputs due to the SFN state size limit
-    sfn_state["Result"].update({k: v for k, v in stage_output.items() if not isinstance(v, list)})
+    # keep large outputs (e.g. scatter outputs) out of the state, to stay within the SFN state size limit
+    sfn_state["Result"].update({k: offload(sfn_state, v) for k, v in stage_output.items()})
 
     return sfn_state
 
 
 def trim_batch_job_details(sfn_state):
     """
-    Remove large redundant batch job description items from Step Function state to avoid overrunning the Step Functions
-    state size limit.
+    Move batch job description items from Step Function state to S3, and then as many result and stage input values as
+    needed to fit the state size budget, to avoid overrunning the Step Functions state size limit.
     """
-    sfn_state["BatchJobDetails"] = {k: {} for k in sfn_state["BatchJobDetails"]}
+    # each is the size of a Batch job description (with its attempts), so none is worth keeping in the state
+    sfn_state["BatchJobDetails"] = {
+        k: offload(sfn_state, v, force=True) for k, v in sfn_state["BatchJobDetails"].items()
+    }
+    fit_state_budget(sfn_state)
     return sfn_state
 
 
+def fit_state_budget(sfn_state):
+    """
+    Offload the largest result and stage input values, largest first, until the state fits the state size budget.
+    Each value may be under the offload threshold, but many of them (e.g. the outputs of a wide workflow) add up.
+    """
+    size = len(json.dumps(sfn_state))
+    if size <= state_budget_bytes:
+        return
+    parents = [sfn_state.get("Result", {})] + list(sfn_state.get("Input", {}).values())
+    candidates = sorted(
+        ((len(json.dumps(v)), parent, k) for parent in parents for k, v in parent.items() if not is_offloaded(v)),
+        key=lambda candidate: candidate[0],
+        reverse=True,
+    )
+    for value_size, parent, k in candidates:
+        if size <= state_budget_bytes:
+            break
+        reference = offload(sfn_state, parent[k], force=True)
+        if len(json.dumps(reference)) >= value_size:
+            # the rest are no larger than a reference to them
+            break
+        parent[k] = reference
+        size -= value_size - len(json.dumps(reference))
+    if size > state_budget_bytes:
+        logger.warning("State is %d bytes after offloading, over the budget of %d bytes", size, state_budget_bytes)
+
+
 def segment_path(path: str) -> List[str]:
     _path = path
     segments: List[str] = []
@@ -88,25 +169,47 @@ def get_workflow_name(sfn_state):
             return os.path.splitext(name)[0]
 
 
-def link_outputs(sfn_state):
+def get_stage_io_map(sfn_state):
+    stages_json_uri = sfn_state.get("STAGES_IO_MAP_JSON")
+    if not stages_json_uri:
+        return {}
+    # effectively immutable for a given pipeline version, so served from the warm container's cache
+    return config_cache.get_json(stages_json_uri)
+
+
+def link_outputs(sfn_state, stage_io_dict=None, changed_only=False):
+    """
+    Wire results and other stages' inputs into each stage's input, according to the stage IO map, and write the stage
+    inputs to S3. With changed_only, write only the stage inputs that changed (the others were written before).
+    Offloaded values stay references in the state, and are resolved only in the stage inputs written.
+    """
     if len(list(sfn_state["Input"])) == 0:
         return
 
-    stages_json_uri = sfn_state.get("STAGES_IO_MAP_JSON")
-    stage_io_dict = {}
-    if stages_json_uri:
-        stage_io_dict = json.loads(s3_object(stages_json_uri).get()["Body"].read().decode())
+    if stage_io_dict is None:
+        stage_io_dict = get_stage_io_map(sfn_state)
 
     stripped_result = {k.split(".")[1]: v for k, v in sfn_state.get("Result", {}).items()}
 
+    changed_stages = []
     for stage in sfn_state["Input"].keys():
         stage_input = sfn_state["Input"][stage]
+        original_input = dict(stage_input)
         for input_name, source in stage_io_dict.get(stage, {}).items():
             if isinstance(source, list):
                 stage_input[input_name] = sfn_state["Input"].get(source[0], {}).get(source[1])
             elif source in stripped_result:
                 stage_input[input_name] = stripped_result[source]
-        put_stage_input(sfn_state=sfn_state, stage=stage, stage_input=stage_input)
+        if not changed_only or stage_input != original_input:
+            changed_stages.append(stage)
+
+    logger.info("Writing inputs for stages %s", changed_stages)
+    if changed_stages:
+        with ThreadPoolExecutor(max_workers=len(changed_stages)) as executor:
+            futures = [executor.submit(put_stage_input, sfn_state, stage, sfn_state["Input"][stage])
+                       for stage in changed_stages]
+        for future in futures:
+            future.result()
 
 
 def preprocess_sfn_input(sfn_state, aws_region, aws_account_id, state_machine_name):
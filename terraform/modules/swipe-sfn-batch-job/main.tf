@@ -54,7 +54,8 @@ resource "aws_iam_policy" "swipe_batch_main_job" {
           "s3:GetObject*",
           "s3:PutObject*",
           "s3:DeleteObjectTagging",
-          "s3:CreateMultipartUpload"
+          "s3:CreateMultipartUpload",
+          "s3:AbortMultipartUpload"
         ],
         Resource : concat(compact([
           "arn:aws:s3:::aegea-batch-jobs-${data.aws_caller_identity.current.account_id}",
@@ -0,0 +1,145 @@
+import hashlib
+import io
+from base64 import b64encode
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+import botocore.exceptions  # type: ignore
+
+
+def client_error(code: str, operation: str) -> botocore.exceptions.ClientError:
+    return botocore.exceptions.ClientError({"Error": {"Code": code}}, operation)
+
+
+class FakeS3:
+    """
+    just enough of an S3 client for the tests, over a dict of objects by key (in any one bucket)
+    """
+
+    def __init__(self, objects: Optional[Dict[str, bytes]] = None, page_size: int = 1000):
+        self.objects: Dict[str, bytes] = objects if objects is not None else {}
+        self.page_size = page_size
+        self.metadata: Dict[str, Dict[str, str]] = {}
+        # ETags differing from the MD5 of the content (e.g. multipart or KMS-encrypted objects)
+        self.etags: Dict[str, str] = {}
+        self.last_modified: Dict[str, datetime] = {}
+        # extra HEAD response fields, e.g. ServerSideEncryption
+        self.head_fields: Dict[str, str] = {}
+        # error codes that requests fail with, by (operation, key)
+        self.errors: Dict[Tuple[str, str], str] = {}
+        # (operation, key or prefix) of each request
+        self.requests: List[Tuple[str, str]] = []
+        self.parts: Dict[str, Dict[int, bytes]] = {}
+
+    def count(self, operation: str) -> int:
+        return sum(1 for request in self.requests if request[0] == operation)
+
+    def etag(self, key: str) -> str:
+        return self.etags.get(key, hashlib.md5(self.objects[key]).hexdigest())
+
+    def _request(self, operation: str, key: str) -> None:
+        self.requests.append((operation, key))
+        if (operation, key) in self.errors:
+            raise client_error(self.errors[(operation, key)], operation)
+
+    def head_object(self, Bucket, Key):
+        self._request("head_object", Key)
+        if Key not in self.objects:
+            raise client_error("404", "HeadObject")
+        return {
+            "ContentLength": len(self.objects[Key]),
+            "ETag": f'"{self.etag(Key)}"',
+            "Metadata": self.metadata.get(Key, {}),
+            **self.head_fields,
+        }
+
+    def get_object(self, Bucket, Key, IfMatch=None, IfNoneMatch=None):
+        self._request("get_object", Key)
+        if Key not in self.objects:
+            raise client_error("NoSuchKey", "GetObject")
+        etag = f'"{self.etag(Key)}"'
+        if IfMatch is not None and IfMatch != etag:
+            raise client_error("PreconditionFailed", "GetObject")
+        if IfNoneMatch == etag:
+            raise client_error("304", "GetObject")
+        body = self.objects[Key]
+        return {"Body": io.BytesIO(body), "ContentLength": len(body), "ETag": etag}
+
+    def put_object(self, Bucket, Key, Body, ContentMD5=None, Metadata=None):
+        self._request("put_object", Key)
+        if ContentMD5 is not None and ContentMD5 != b64encode(hashlib.md5(Body).digest()).decode():
+            raise client_error("BadDigest", "PutObject")
+        self.objects[Key] = Body
+        self.etags.pop(Key, None)
+        self.metadata[Key] = Metadata or {}
+        return {"ETag": f'"{self.etag(Key)}"'}
+
+    def create_multipart_upload(self, Bucket, Key, Metadata=None):
+        self._request("create_multipart_upload", Key)
+        self.parts[Key] = {}
+        self.metadata[Key] = Metadata or {}
+        return {"UploadId": Key}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ContentMD5=None):
+        self._request("upload_part", Key)
+        if ContentMD5 is not None and ContentMD5 != b64encode(hashlib.md5(Body).digest()).decode():
+            raise client_error("BadDigest", "UploadPart")
+        self.parts[UploadId][PartNumber] = Body
+        return {"ETag": f'"{hashlib.md5(Body).hexdigest()}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._request("complete_multipart_upload", Key)
+        uploaded = self.parts.pop(UploadId)
+        parts = [uploaded[part["PartNumber"]] for part in MultipartUpload["Parts"]]
+        self.objects[Key] = b"".join(parts)
+        # as S3 computes a multipart upload's ETag
+        self.etags[Key] = hashlib.md5(b"".join(hashlib.md5(part).digest() for part in parts)).hexdigest()
+        self.etags[Key] += f"-{len(parts)}"
+        return {"ETag": f'"{self.etags[Key]}"'}
+
+    def delete_objects(self, Bucket, Delete):
+        deleted, errors = [], []
+        for obj in Delete["Objects"]:
+            try:
+                self._request("delete_objects", obj["Key"])
+            except botocore.exceptions.ClientError as exn:
+                errors.append({"Key": obj["Key"], "Code": exn.response["Error"]["Code"]})
+                continue
+            self.objects.pop(obj["Key"], None)
+            deleted.append({"Key": obj["Key"]})
+        return {"Deleted": deleted, "Errors": errors}
+
+    def list_objects_v2(self, Bucket, Prefix, MaxKeys=1000):
+        self._request("list_objects_v2", Prefix)
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))[:MaxKeys]
+        return {"KeyCount": len(keys), "Contents": [self._listing(key) for key in keys]}
+
+    def get_paginator(self, operation):
+        assert operation == "list_objects_v2"
+        return self
+
+    def paginate(self, Bucket, Prefix, Delimiter=None):
+        self._request("list_objects_v2", Prefix)
+        contents = []
+        common_prefixes = set()
+        for key in sorted(self.objects):
+            if not key.startswith(Prefix):
+                continue
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                common_prefixes.add(Prefix + rest.split(Delimiter)[0] + Delimiter)
+            else:
+                contents.append(self._listing(key))
+        for i in range(0, max(len(contents), 1), self.page_size):
+            page = {"Contents": contents[i:i + self.page_size]}
+            if i == 0 and common_prefixes:
+                page["CommonPrefixes"] = [{"Prefix": prefix} for prefix in sorted(common_prefixes)]
+            yield page
+
+    def _listing(self, key: str):
+        return {
+            "Key": key,
+            "Size": len(self.objects[key]),
+            "ETag": f'"{self.etag(key)}"',
+            "LastModified": self.last_modified.get(key, datetime.now(timezone.utc)),
+        }
@@ -0,0 +1,82 @@
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from os.path import dirname, join, realpath
+from typing import Any, List
+from unittest import mock
+
+from WDL.runtime import config
+
+sys.path.insert(0, join(dirname(dirname(realpath(__file__))), "miniwdl-plugins", "aria2_download"))
+
+import miniwdl_aria2  # type: ignore  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+class TestDownload(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cfg = config.Loader(logger)
+        self.cfg.override({"download_cache": {"put": False}, "aria2": {"dir": self.tmp.name}})
+        self.running = 0
+        self.overlapped = False
+        self.patches: List[Any] = [
+            mock.patch.object(miniwdl_aria2, "head", lambda uri: {"content-length": "5"}),
+            mock.patch.object(miniwdl_aria2.subprocess, "run", self.aria2c),
+            mock.patch.object(miniwdl_aria2, "_download_dirs", []),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.tmp.cleanup()
+
+    def aria2c(self, cmd, **kwargs):
+        self.running += 1
+        self.overlapped = self.overlapped or self.running > 1
+        time.sleep(0.05)
+        with open(os.path.join(cmd[cmd.index("-d") + 1], cmd[cmd.index("-o") + 1]), "w") as outfile:
+            outfile.write("hello")
+        self.running -= 1
+        return subprocess.CompletedProcess(cmd, 0, "")
+
+    def download(self, uri):
+        return miniwdl_aria2.download(self.cfg, logger, uri)
+
+    def test_lockfile_removed(self):
+        fn = self.download("https://example.com/a/hello.txt")
+        with open(fn) as infile:
+            self.assertEqual(infile.read(), "hello")
+        self.assertEqual(os.listdir(os.path.join(self.tmp.name, "aria2")), [])
+
+    def test_concurrent(self):
+        files = []
+        threads = [
+            threading.Thread(target=lambda: files.append(self.download("https://example.com/hello.txt")))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(files)), 4)
+        self.assertFalse(self.overlapped)
+        self.assertEqual(os.listdir(os.path.join(self.tmp.name, "aria2")), [])
+
+    def test_download_dirs_removed(self):
+        fns = [self.download(f"https://example.com/{name}.txt") for name in ("a", "b")]
+        self.assertTrue(all(os.path.isfile(fn) for fn in fns))
+        miniwdl_aria2.remove_download_dirs()
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), ["aria2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+import fcntl
+import os
+import sys
+import tempfile
+import unittest
+from os.path import dirname, join, realpath
+from unittest import mock
+
+sys.path.insert(0, join(dirname(dirname(realpath(__file__))), "scripts"))
+
+import download_cache_manager  # type: ignore  # noqa: E402
+
+MiB = 1024 * 1024
+
+
+class TestDownloadCacheManager(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = self.tmp.name
+        self.locks = []
+
+    def tearDown(self):
+        for lockfile in self.locks:
+            lockfile.close()
+        self.tmp.cleanup()
+
+    def path(self, entry):
+        return os.path.join(self.cache_dir, entry)
+
+    def add_file(self, entry, size=MiB):
+        os.makedirs(os.path.dirname(self.path(entry)), exist_ok=True)
+        with open(self.path(entry), "wb") as outfile:
+            outfile.write(os.urandom(size))
+
+    def add_dir(self, entry, size=MiB):
+        self.add_file(os.path.join(entry, "a"), size)
+        self.add_file(os.path.join(entry, "sub", "b"), size)
+
+    def use(self, entry):
+        # as miniwdl does: a shared flock on the file, or on the lockfile next to the directory
+        path = self.path(entry)
+        if os.path.isdir(path):
+            path += "._miniwdl_flock"
+        lockfile = open(path, "a")
+        fcntl.flock(lockfile, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        self.locks.append(lockfile)
+
+    def scan(self):
+        index = download_cache_manager.load_index(self.cache_dir)
+        download_cache_manager.scan(self.cache_dir, index)
+        return index
+
+    def test_entries(self):
+        self.add_file("files/https/example.com/a/b.txt")
+        self.add_dir("dirs/s3/bucket/prefix/dir")
+        self.add_dir("_s3dir/bucket/0123456789abcdef/fingerprint")
+        self.add_dir("_s3dir/bucket/0123456789abcdef/tmp_partial")
+        self.use("dirs/s3/bucket/prefix/dir")
+        self.assertEqual(
+            sorted(download_cache_manager.entries(self.cache_dir)),
+            [
+                "_s3dir/bucket/0123456789abcdef/fingerprint",
+                "dirs/s3/bucket/prefix/dir",
+                "files/https/example.com/a/b.txt",
+            ],
+        )
+
+    def test_scan_in_use(self):
+        self.add_file("files/s3/bucket/used.txt")
+        self.add_file("files/s3/bucket/unused.txt")
+        self.add_dir("dirs/s3/bucket/prefix/used")
+        self.add_dir("dirs/s3/bucket/prefix/unused")
+        self.use("files/s3/bucket/used.txt")
+        self.use("dirs/s3/bucket/prefix/used")
+        for locked in (download_cache_manager.locked_files(), None):
+            with mock.patch.object(download_cache_manager, "locked_files", lambda: locked):
+                index = self.scan()
+            self.assertEqual(
+                {entry for entry, info in index["entries"].items() if info["in_use"]},
+                {"files/s3/bucket/used.txt", "dirs/s3/bucket/prefix/used"} if locked is not None else set(),
+            )
+
+    def test_scan_takes_no_exclusive_flock(self):
+        self.add_file("files/s3/bucket/a.txt")
+        self.add_dir("dirs/s3/bucket/prefix/dir")
+        self.use("dirs/s3/bucket/prefix/dir")
+        flocks = []
+        with mock.patch.object(download_cache_manager.fcntl, "flock", lambda fd, op: flocks.append(op)):
+            self.scan()
+        self.assertFalse([op for op in flocks if op & fcntl.LOCK_EX])
+
+    def test_hardlinks_counted_once(self):
+        self.add_dir("_s3dir/bucket/0123456789abcdef/fingerprint/dir")
+        os.makedirs(self.path("dirs/s3/bucket/prefix/dir/sub"))
+        for fn in ("a", "sub/b"):
+            os.link(
+                self.path(f"_s3dir/bucket/0123456789abcdef/fingerprint/dir/{fn}"),
+                self.path(f"dirs/s3/bucket/prefix/dir/{fn}"),
+            )
+        index = self.scan()
+        total = sum(info["size"] for info in index["entries"].values())
+        self.assertGreaterEqual(total, 2 * MiB)
+        self.assertLess(total, 3 * MiB)
+
+    def test_evict(self):
+        for i in range(4):
+            self.add_file(f"files/s3/bucket/{i}.bin")
+        self.add_dir("dirs/s3/bucket/prefix/unused")
+        self.add_dir("dirs/s3/bucket/prefix/used")
+        self.use("dirs/s3/bucket/prefix/used")
+        # a lockfile left by an earlier use of the unused directory
+        open(self.path("dirs/s3/bucket/prefix/unused._miniwdl_flock"), "w").close()
+        self.use("files/s3/bucket/0.bin")
+        index = self.scan()
+        evicted, _evicted_bytes = download_cache_manager.evict(self.cache_dir, index, 3 * MiB)
+        self.assertGreater(evicted, 0)
+        remaining = set(download_cache_manager.entries(self.cache_dir))
+        self.assertEqual(remaining, set(index["entries"]))
+        self.assertIn("dirs/s3/bucket/prefix/used", remaining)
+        self.assertIn("files/s3/bucket/0.bin", remaining)
+        self.assertTrue(os.path.exists(self.path("dirs/s3/bucket/prefix/used._miniwdl_flock")))
+        self.assertNotIn("dirs/s3/bucket/prefix/unused", remaining)
+        self.assertEqual(
+            [fn for fn in os.listdir(self.path("dirs/s3/bucket/prefix")) if fn.startswith("unused")], []
+        )
+
+    def test_evict_waits_for_cache_lock(self):
+        self.add_file("files/s3/bucket/a.bin")
+        index = self.scan()
+        with open(self.path("_miniwdl_flock"), "w") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            self.assertEqual(download_cache_manager.evict(self.cache_dir, index, 0), (0, 0))
+        self.assertEqual(download_cache_manager.evict(self.cache_dir, index, 0)[0], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,262 @@
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from os.path import dirname, join, realpath
+from typing import Any, Dict, List
+from unittest import mock
+
+import botocore
+from WDL.runtime import cache, config
+from WDL.runtime.error import DownloadFailed
+
+from .fakes import FakeS3
+
+sys.path.insert(0, join(dirname(dirname(realpath(__file__))), "miniwdl-plugins", "s3parcp_download"))
+
+import miniwdl_s3parcp  # type: ignore  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+class S3ParcpTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.client = FakeS3({})
+        self.patches: List[Any] = [
+            mock.patch.object(miniwdl_s3parcp, "_s3_client", self.client),
+            mock.patch.object(miniwdl_s3parcp, "_heads", {}),
+            mock.patch.object(miniwdl_s3parcp, "_staging_dirs", {}),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.tmp.cleanup()
+
+    def loader(self, cache=False, **options):
+        cfg = config.Loader(logger)
+        cfg.override(
+            {
+                "download_cache": {"put": cache, "dir": os.path.join(self.tmp.name, "cache")},
+                "s3parcp": {"dir": os.path.join(self.tmp.name, "s3parcp"), **options},
+            }
+        )
+        return cfg
+
+
+class TestHead(S3ParcpTestCase):
+    def test_object_size(self):
+        self.client.objects["a/b.txt"] = b"hello"
+        self.assertEqual(miniwdl_s3parcp.object_size("s3://bucket/a/b.txt"), 5)
+        self.assertIsNone(miniwdl_s3parcp.object_size("s3://bucket/missing"))
+
+    def test_object_size_botocore_error(self):
+        def head_object(Bucket, Key):
+            raise botocore.exceptions.EndpointConnectionError(endpoint_url="http://localhost")
+
+        with mock.patch.object(self.client, "head_object", head_object):
+            self.assertIsNone(miniwdl_s3parcp.object_size("s3://bucket/a/b.txt"))
+
+    def test_checksum_arg(self):
+        self.client.objects.update({"plain": b"x", "checksummed": b"y"})
+        self.client.metadata["checksummed"] = {"crc32c": "abc"}
+        self.assertEqual(miniwdl_s3parcp.checksum_arg(["s3://bucket/checksummed"]), "--checksum")
+        self.assertEqual(miniwdl_s3parcp.checksum_arg(["s3://bucket/checksummed", "s3://bucket/plain"]), "")
+
+
+class TestInProcess(S3ParcpTestCase):
+    def test_download(self):
+        self.client.objects["a/b.txt"] = b"hello"
+        fn = miniwdl_s3parcp.download_inprocess(self.loader(), logger, "s3://bucket/a/b.txt")
+        self.assertEqual(os.path.basename(fn), "b.txt")
+        with open(fn, "rb") as infile:
+            self.assertEqual(infile.read(), b"hello")
+
+    def test_corrupt(self):
+        self.client.objects["a/b.txt"] = b"hello"
+        self.client.etags["a/b.txt"] = hashlib.md5(b"goodbye").hexdigest()
+        cfg = self.loader()
+        with self.assertRaises(DownloadFailed):
+            miniwdl_s3parcp.download_inprocess(cfg, logger, "s3://bucket/a/b.txt")
+        self.assertEqual(os.listdir(miniwdl_s3parcp.staging_dir(cfg)), [])
+
+    def test_put_download(self):
+        # miniwdl moves each download into its cache, removing the emptied staging directories
+        cfg = self.loader(cache=True)
+        with cache.CallCache(cfg, logger) as call_cache:
+            for name in ("a.txt", "b.txt"):
+                self.client.objects[name] = name.encode()
+                fn = miniwdl_s3parcp.download_inprocess(cfg, logger, f"s3://bucket/{name}")
+                cached = call_cache.put_download(f"s3://bucket/{name}", fn)
+                with open(cached, "rb") as infile:
+                    self.assertEqual(infile.read(), name.encode())
+            self.client.objects.update({"dir/c.txt": b"c"})
+            dn = miniwdl_s3parcp.download_directory(cfg, logger, "s3://bucket/dir")
+            cached = call_cache.put_download("s3://bucket/dir", dn, directory=True)
+        self.assertEqual(os.listdir(cached), ["c.txt"])
+
+    def test_main_small_object(self):
+        self.client.objects["a/b.txt"] = b"hello"
+        gen = miniwdl_s3parcp.main(self.loader(), logger, "s3://bucket/a/b.txt")
+        fn = next(gen)["outputs"]["file"]
+        with open(fn, "rb") as infile:
+            self.assertEqual(infile.read(), b"hello")
+
+
+class TestDirectory(S3ParcpTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.objects.update(
+            {
+                "run/dir/a.txt": b"a",
+                "run/dir/sub/b.txt": b"b",
+                "run/dir/sub/deeper/c.txt": b"c",
+                "run/dir/placeholder/": b"",
+                "run/dir2/d.txt": b"d",
+            }
+        )
+
+    def contents(self, dn):
+        ans = {}
+        for parent, _subdirs, files in os.walk(dn):
+            for fn in files:
+                with open(os.path.join(parent, fn), "rb") as infile:
+                    ans[os.path.relpath(os.path.join(parent, fn), dn)] = infile.read()
+        return ans
+
+    def test_download(self):
+        dn = miniwdl_s3parcp.download_directory(self.loader(), logger, "s3://bucket/run/dir")
+        self.assertEqual(os.path.basename(dn), "dir")
+        self.assertEqual(self.contents(dn), {"a.txt": b"a", "sub/b.txt": b"b", "sub/deeper/c.txt": b"c"})
+
+    def test_keys_outside_directory(self):
+        self.client.objects.update({"run/dir//etc/passwd": b"x", "run/dir/../escaped.txt": b"x", "run/dir/..b": b"b"})
+        dn = miniwdl_s3parcp.download_directory(self.loader(), logger, "s3://bucket/run/dir")
+        self.assertEqual(
+            self.contents(dn),
+            {"a.txt": b"a", "sub/b.txt": b"b", "sub/deeper/c.txt": b"c", "..b": b"b"},
+        )
+        self.assertFalse(os.path.exists(os.path.join(os.path.dirname(dn), "escaped.txt")))
+
+    def test_stored_copy_reused(self):
+        cfg = self.loader(cache=True)
+        first = miniwdl_s3parcp.download_directory(cfg, logger, "s3://bucket/run/dir/")
+        gets = self.client.count("get_object")
+        second = miniwdl_s3parcp.download_directory(cfg, logger, "s3://bucket/run/dir/")
+        self.assertNotEqual(first, second)
+        self.assertEqual(self.client.count("get_object"), gets)
+        self.assertEqual(self.contents(first), self.contents(second))
+        # hardlinked from the copy under _s3dir
+        self.assertGreater(os.stat(os.path.join(second, "a.txt")).st_nlink, 1)
+
+        # changed content is downloaded again
+        self.client.objects["run/dir/a.txt"] = b"A"
+        third = miniwdl_s3parcp.download_directory(cfg, logger, "s3://bucket/run/dir/")
+        self.assertGreater(self.client.count("get_object"), gets)
+        self.assertEqual(self.contents(third)["a.txt"], b"A")
+
+    def test_staging_removed(self):
+        cfg = self.loader()
+        self.client.objects["a/b.txt"] = b"hello"
+        fn = miniwdl_s3parcp.download_inprocess(cfg, logger, "s3://bucket/a/b.txt")
+        dn = miniwdl_s3parcp.download_directory(cfg, logger, "s3://bucket/run/dir")
+        self.assertTrue(os.path.exists(fn) and os.path.isdir(dn))
+        miniwdl_s3parcp.remove_staging_dirs()
+        self.assertFalse(os.path.exists(fn) or os.path.exists(dn))
+        self.assertEqual(os.listdir(os.path.join(self.tmp.name, "s3parcp")), [])
+
+
+class TestBatch(S3ParcpTestCase):
+    def test_batch(self):
+        cfg = self.loader(batch_window_seconds=0.2, docker_image="s3parcp")
+        uris = [f"s3://bucket/big{i}" for i in range(3)]
+        self.client.objects.update({uri[len("s3://bucket/"):]: b"x" for uri in uris})
+        self.client.metadata.update({uri[len("s3://bucket/"):]: {"crc32c": "x"} for uri in uris})
+        results: Dict[str, Any] = {}
+
+        def follower(uri):
+            results[uri] = next(miniwdl_s3parcp.batch_download(cfg, logger, uri))
+
+        broker = mock.Mock(dir="/credentials", region="us-west-2")
+        with mock.patch.object(miniwdl_s3parcp, "credential_broker", lambda cfg, logger: broker):
+            leader = miniwdl_s3parcp.batch_download(cfg, logger, uris[0])
+            threads = []
+            leader_started = threading.Thread(target=lambda: results.update(task=next(leader)))
+            leader_started.start()
+            time.sleep(0.05)
+            for uri in uris[1:]:
+                threads.append(threading.Thread(target=follower, args=(uri,)))
+                threads[-1].start()
+            leader_started.join()
+            task = results["task"]
+            self.assertEqual(task["inputs"]["uris"], uris)
+            self.assertEqual(task["inputs"]["checksum_arg"], "--checksum")
+            files = [f"/run/__out/{i}/big{i}" for i in range(3)]
+            done = leader.send({"outputs": {"files": files}, "dir": "/run"})
+            for thread in threads:
+                thread.join()
+        self.assertEqual(done["outputs"]["file"], files[0])
+        for i, uri in enumerate(uris[1:], 1):
+            self.assertEqual(results[uri], {"outputs": {"file": files[i]}})
+
+        # the next download starts a new batch
+        gen = miniwdl_s3parcp.batch_download(cfg, logger, uris[0])
+        with mock.patch.object(miniwdl_s3parcp, "credential_broker", lambda cfg, logger: broker):
+            self.assertEqual(next(gen)["inputs"]["uris"], uris[:1])
+
+    def test_batch_failed(self):
+        cfg = self.loader(batch_window_seconds=0.2, docker_image="s3parcp")
+        broker = mock.Mock(dir="/credentials", region="us-west-2")
+        with mock.patch.object(miniwdl_s3parcp, "credential_broker", lambda cfg, logger: broker):
+            leader = miniwdl_s3parcp.batch_download(cfg, logger, "s3://bucket/a")
+            started = threading.Thread(target=lambda: next(leader))
+            started.start()
+            time.sleep(0.05)
+            failures = []
+
+            def follow():
+                try:
+                    next(miniwdl_s3parcp.batch_download(cfg, logger, "s3://bucket/b"))
+                except Exception as exn:
+                    failures.append(exn)
+
+            follower = threading.Thread(target=follow)
+            follower.start()
+            started.join()
+            with self.assertRaises(RuntimeError):
+                leader.throw(RuntimeError("container failed"))
+            follower.join()
+        self.assertEqual(len(failures), 1)
+        self.assertIsInstance(failures[0], DownloadFailed)
+
+
+class TestDownloadResources(S3ParcpTestCase):
+    def test_sizing(self):
+        cfg = self.loader()
+        self.assertEqual(miniwdl_s3parcp.download_resources(cfg, None), {})
+        small = miniwdl_s3parcp.download_resources(cfg, 1024)
+        self.assertEqual((small["cpu"], small["memory_gb"], small["concurrency"]), (1, 1, 1))
+        large = miniwdl_s3parcp.download_resources(cfg, 100 * 1024 ** 3)
+        self.assertEqual(large["part_size"], 64 * 1024 ** 2)
+        self.assertEqual(large["concurrency"], 32)
+        self.assertLessEqual(large["cpu"], 8)
+        self.assertLessEqual(large["memory_gb"], 8)
+
+    def test_limits(self):
+        cfg = self.loader(max_cpu=2, max_concurrency=64, max_memory_gb=1)
+        resources = miniwdl_s3parcp.download_resources(cfg, 100 * 1024 ** 3)
+        self.assertEqual(resources["cpu"], 2)
+        self.assertEqual(resources["memory_gb"], 1)
+        # two buffered 64 MiB parts per transfer within 1G
+        self.assertEqual(resources["concurrency"], 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
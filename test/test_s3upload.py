@@ -0,0 +1,419 @@
+import errno
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from os.path import dirname, join, realpath
+from typing import Any, Dict, List
+from unittest import mock
+
+import WDL
+from WDL import Env, Type, Value
+from WDL.runtime import config
+
+from .fakes import FakeS3
+
+sys.path.insert(0, join(dirname(dirname(realpath(__file__))), "miniwdl-plugins", "s3upload"))
+
+import miniwdl_s3upload  # type: ignore  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+def loader(**options):
+    cfg = config.Loader(logger)
+    cfg.override({"call_cache": {"put": True}, "s3_progressive_upload": options})
+    return cfg
+
+
+class TestPendingCachePuts(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.files = []
+        for name in ("a", "b"):
+            fn = os.path.join(self.tmp.name, name)
+            with open(fn, "w") as outfile:
+                outfile.write(name)
+            self.files.append(fn)
+        self.cfg = loader()
+        self.written: List[str] = []
+        self.patches: List[Any] = [
+            mock.patch.object(miniwdl_s3upload, "_uploaded_files", {}),
+            mock.patch.object(miniwdl_s3upload, "_cached_files", {}),
+            mock.patch.object(miniwdl_s3upload, "_pending_cache_puts", {}),
+            mock.patch.object(miniwdl_s3upload, "upload_registry", lambda cfg: None),
+            mock.patch.object(miniwdl_s3upload, "cache_entry", lambda cfg, key, outputs: (key, b"{}")),
+            mock.patch.object(miniwdl_s3upload, "cache_put", lambda cfg, logger, uri, body: self.written.append(uri)),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.tmp.cleanup()
+
+    def outputs(self, *fns):
+        env: Env.Bindings[Value.Base] = Env.Bindings()
+        for i, fn in enumerate(fns):
+            env = env.bind(f"out{i}", Value.File(fn))
+        return env
+
+    def uploaded(self, fn):
+        with miniwdl_s3upload._uploaded_files_lock:
+            miniwdl_s3upload._uploaded_files[miniwdl_s3upload.inode(fn)] = "s3://bucket/" + os.path.basename(fn)
+            return miniwdl_s3upload.cache_file_uploaded(self.cfg, miniwdl_s3upload.inode(fn))
+
+    def test_written_upon_last_upload(self):
+        call_cache = miniwdl_s3upload.CallCache(self.cfg, logger)
+        call_cache.put("task/key", self.outputs(*self.files))
+        self.assertEqual(self.uploaded(self.files[0]), [])
+        self.assertEqual(self.uploaded(self.files[1]), [("task/key", b"{}")])
+        self.assertEqual(miniwdl_s3upload._pending_cache_puts, {})
+
+    def test_repeated_put(self):
+        call_cache = miniwdl_s3upload.CallCache(self.cfg, logger)
+        call_cache.put("task/key", self.outputs(*self.files))
+        call_cache.put("task/key", self.outputs(self.files[1]))
+        # the file only the superseded put was waiting on doesn't write the entry (nor raise)
+        self.assertEqual(self.uploaded(self.files[0]), [])
+        self.assertEqual(self.uploaded(self.files[1]), [("task/key", b"{}")])
+        self.assertEqual(miniwdl_s3upload._pending_cache_puts, {})
+
+    def test_put_superseding_pending(self):
+        call_cache = miniwdl_s3upload.CallCache(self.cfg, logger)
+        call_cache.put("task/key", self.outputs(self.files[0]))
+        self.uploaded(self.files[1])
+        call_cache.put("task/key", self.outputs(self.files[1]))
+        self.assertEqual(self.written, ["task/key"])
+        self.assertEqual(self.uploaded(self.files[0]), [])
+
+
+class TestUploadPool(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.run_dir = self.tmp.name
+        self.uploads: Dict[str, str] = {}
+        self.running = {True: 0, False: 0}
+        self.peak = {True: 0, False: 0}
+        self.lock = threading.Lock()
+        self.patches: List[Any] = [
+            mock.patch.object(miniwdl_s3upload, "_uploaded_files", {}),
+            mock.patch.object(miniwdl_s3upload, "_upload_pools", {}),
+            mock.patch.object(miniwdl_s3upload, "upload_registry", lambda cfg: None),
+            mock.patch.object(miniwdl_s3upload, "upload", self.upload),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for pool in miniwdl_s3upload._upload_pools.values():
+            pool.shutdown()
+        for patch in self.patches:
+            patch.stop()
+        self.tmp.cleanup()
+
+    def upload(self, cfg, logger, fn, s3uri):
+        large = os.path.getsize(fn) >= 10
+        with self.lock:
+            self.running[large] += 1
+            self.peak[large] = max(self.peak[large], self.running[large])
+        time.sleep(0.05)
+        with self.lock:
+            self.running[large] -= 1
+            self.uploads[fn] = s3uri
+        return None
+
+    def output(self, name, fn, content):
+        # as miniwdl links task outputs under out/
+        work_fn = os.path.join(self.run_dir, "work", fn)
+        os.makedirs(os.path.dirname(work_fn), exist_ok=True)
+        with open(work_fn, "w") as outfile:
+            outfile.write(content)
+        link = os.path.join(self.run_dir, "out", name, os.path.basename(fn))
+        os.makedirs(os.path.dirname(link), exist_ok=True)
+        os.symlink(work_fn, link)
+        return link
+
+    def run_task(self, **options):
+        cfg = loader(uri_prefix="s3://bucket/run", **options)
+        gen = miniwdl_s3upload.task(cfg, logger, ["call_test", "call-t"], self.run_dir, None)
+        recv = next(gen)
+        recv = gen.send(recv)
+        return gen.send(recv)
+
+    def test_upload(self):
+        small = [self.output(f"small/{i}", f"small{i}.txt", "x") for i in range(6)]
+        large = [self.output(f"large/{i}", f"large{i}.txt", "x" * 10) for i in range(3)]
+        recv = self.run_task(max_concurrent_uploads=2, max_concurrent_large_uploads=1, large_upload_threshold=10)
+        self.assertIn("s3_upload_seconds", recv)
+        uris = {fn: "s3://bucket/run/" + os.path.basename(fn) for fn in small + large}
+        self.assertEqual(self.uploads, uris)
+        self.assertEqual(self.peak, {False: 2, True: 1})
+        self.assertEqual(set(miniwdl_s3upload._uploaded_files.values()), set(uris.values()))
+
+    def test_failure(self):
+        self.output("out", "a.txt", "a")
+
+        def upload(cfg, logger, fn, s3uri):
+            raise WDL.Error.RuntimeError("failed uploading")
+
+        with mock.patch.object(miniwdl_s3upload, "upload", upload), self.assertRaises(WDL.Error.RuntimeError):
+            self.run_task()
+        self.assertEqual(miniwdl_s3upload._uploaded_files, {})
+
+
+class TestCallCachePrefetch(unittest.TestCase):
+    def prefetch(self, client, **options):
+        cfg = loader(uri_prefix="s3://bucket/run", **options)
+        with mock.patch.object(miniwdl_s3upload.boto3, "client", lambda *args, **kwargs: client):
+            prefetch = miniwdl_s3upload.CallCachePrefetch(cfg, logger)
+            return prefetch.entries(), prefetch.complete
+
+    def test_prefetch(self):
+        client = FakeS3({f"run/cache/task/{i}.json": str(i).encode() for i in range(5)}, page_size=2)
+        entries, complete = self.prefetch(client)
+        self.assertEqual(entries, {f"task/{i}": str(i).encode() for i in range(5)})
+        self.assertTrue(complete)
+
+    def test_prefetch_capped(self):
+        client = FakeS3({f"run/cache/task/{i}.json": str(i).encode() for i in range(5)}, page_size=2)
+        entries, complete = self.prefetch(client, call_cache_prefetch_max_entries=3)
+        self.assertEqual(len(entries), 3)
+        self.assertFalse(complete)
+        # stops listing & fetching once capped
+        self.assertEqual(client.count("get_object"), 3)
+
+    def test_lookup_while_prefetching(self):
+        client = FakeS3({f"run/cache/task/{i}.json": str(i).encode() for i in range(5)}, page_size=2)
+        listed = threading.Event()
+        paginate = client.paginate
+
+        def slow_paginate(Bucket, Prefix):
+            for i, page in enumerate(paginate(Bucket, Prefix)):
+                if i == 1:
+                    listed.wait()
+                yield page
+
+        client.paginate = slow_paginate  # type: ignore
+        cfg = loader(uri_prefix="s3://bucket/run")
+        with mock.patch.object(miniwdl_s3upload.boto3, "client", lambda *args, **kwargs: client):
+            prefetch = miniwdl_s3upload.CallCachePrefetch(cfg, logger)
+            # the first page is usable while the rest of the listing is pending
+            for _ in range(100):
+                if prefetch.lookup("task/0")[0] is not None:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(prefetch.lookup("task/0"), (b"0", False))
+            self.assertEqual(prefetch.lookup("task/4"), (None, False))
+            listed.set()
+            prefetch.entries()
+        self.assertEqual(prefetch.lookup("task/4"), (b"4", True))
+        self.assertEqual(prefetch.lookup("task/5"), (None, True))
+
+
+class TestCallCacheValidation(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.client = FakeS3({"run/a.txt": b"", "run/dir/b.txt": b""})
+        self.client.errors[("head_object", "forbidden")] = "403"
+        self.patches: List[Any] = [
+            mock.patch.object(miniwdl_s3upload, "_s3_exists_memo", {}),
+            mock.patch.object(miniwdl_s3upload, "upload_client", lambda cfg: (self.client, None)),
+            mock.patch.object(miniwdl_s3upload, "call_cache_prefetch", lambda cfg, logger: None),
+            # (miniwdl's own check is of local files' modification times)
+            mock.patch.object(miniwdl_s3upload.cache, "_check_files_coherence", lambda *args: True),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.tmp.cleanup()
+
+    def test_exists(self):
+        uris = {"s3://bucket/run/a.txt", "s3://bucket/run/gone.txt", "s3://bucket/run/dir/", "s3://bucket/run/gone/",
+                "s3://bucket/forbidden"}
+        self.assertEqual(
+            miniwdl_s3upload.s3_objects_exist(loader(), uris),
+            {
+                "s3://bucket/run/a.txt": True,
+                "s3://bucket/run/gone.txt": False,
+                "s3://bucket/run/dir/": True,
+                "s3://bucket/run/gone/": False,
+                # only a definite 404 counts as missing
+                "s3://bucket/forbidden": True,
+            },
+        )
+
+    def test_memo(self):
+        cfg = loader()
+        uris = {"s3://bucket/run/a.txt", "s3://bucket/run/gone.txt"}
+        miniwdl_s3upload.s3_objects_exist(cfg, uris)
+        self.client.objects["run/gone.txt"] = b""
+        self.assertEqual(miniwdl_s3upload.s3_objects_exist(cfg, uris)["s3://bucket/run/gone.txt"], False)
+        self.assertEqual(len(self.client.requests), 2)
+        # not beyond the TTL
+        self.assertEqual(
+            miniwdl_s3upload.s3_objects_exist(loader(call_cache_validate_ttl=0), uris)["s3://bucket/run/gone.txt"],
+            True,
+        )
+        self.assertEqual(len(self.client.requests), 4)
+
+    def get(self, cfg, outputs):
+        def download_file(bucket, key, fn):
+            with open(fn, "w") as outfile:
+                json.dump(outputs, outfile)
+
+        call_cache = miniwdl_s3upload.CallCache(cfg, logger)
+        with mock.patch.object(miniwdl_s3upload.s3_client, "download_file", download_file):
+            output_types: Env.Bindings[Type.Base] = Env.Bindings()
+            output_types = output_types.bind("out", Type.File())
+            return call_cache.get("task/key", Env.Bindings(), output_types)
+
+    def test_get(self):
+        cfg = loader(uri_prefix="s3://bucket/run")
+        cfg.override({"call_cache": {"get": True, "dir": self.tmp.name}})
+        hit = self.get(cfg, {"out": "s3://bucket/run/a.txt"})
+        self.assertEqual(hit["out"].value, "s3://bucket/run/a.txt")
+
+        # a hit referencing a missing object is a miss, and the stale entry is removed
+        self.assertIsNone(self.get(cfg, {"out": "s3://bucket/run/gone.txt"}))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, "task/key.json")))
+
+        cfg.override({"s3_progressive_upload": {"call_cache_validate": False}})
+        self.assertIsNotNone(self.get(cfg, {"out": "s3://bucket/run/gone.txt"}))
+
+
+class TestContentDigest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cfg = loader(multipart_threshold=1024, registry_dir=self.tmp.name)
+        self.client = FakeS3()
+        self.part_pool = ThreadPoolExecutor(4)
+        self.patches: List[Any] = [
+            mock.patch.object(miniwdl_s3upload, "upload_client", lambda cfg: (self.client, self.part_pool)),
+            mock.patch.object(miniwdl_s3upload, "_s3_content_digests", None),
+            mock.patch.object(miniwdl_s3upload, "multipart_chunksize", lambda cfg, size: 1000),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.part_pool.shutdown()
+        self.tmp.cleanup()
+
+    def file(self, name, size):
+        fn = os.path.join(self.tmp.name, name)
+        with open(fn, "wb") as outfile:
+            outfile.write(os.urandom(size))
+        return fn
+
+    def test_local_etag_matches_upload(self):
+        for size in (0, 100, 1000, 2500, 3000):
+            fn = self.file(f"f{size}", size)
+            etag = miniwdl_s3upload.put_file(self.cfg, logger, fn, f"s3://bucket/f{size}")
+            self.assertEqual(etag, self.client.etag(f"f{size}"))
+            self.assertEqual(miniwdl_s3upload.local_etag(fn, miniwdl_s3upload.put_chunksize(self.cfg, size)), etag)
+
+    def test_crc32c_metadata(self):
+        self.assertEqual(miniwdl_s3upload.crc32c(b"123456789"), 0xE3069283)
+        self.assertEqual(miniwdl_s3upload.crc32c(b"6789", miniwdl_s3upload.crc32c(b"12345")), 0xE3069283)
+        for size in (0, 100, 2500):
+            fn = self.file(f"f{size}", size)
+            miniwdl_s3upload.put_file(self.cfg, logger, fn, f"s3://bucket/f{size}")
+            crc = miniwdl_s3upload.crc32c(self.client.objects[f"f{size}"])
+            self.assertEqual(self.client.metadata[f"f{size}"], {miniwdl_s3upload.CRC32C_METADATA_KEY: str(crc)})
+
+    def test_digest_without_download(self):
+        for size in (100, 2500):
+            fn = self.file(f"f{size}", size)
+            miniwdl_s3upload.put_file(self.cfg, logger, fn, f"s3://bucket/f{size}")
+            self.assertEqual(
+                miniwdl_s3upload.content_digest(self.cfg, f"s3://bucket/f{size}"),
+                miniwdl_s3upload.content_digest(self.cfg, fn),
+            )
+        self.assertEqual(self.client.count("get_object"), 0)
+
+    def test_kms_digest_persisted(self):
+        fn = self.file("kms", 2500)
+        miniwdl_s3upload.put_file(self.cfg, logger, fn, "s3://bucket/kms")
+        self.client.head_fields = {"ServerSideEncryption": "aws:kms"}
+        self.client.etags["kms"] = "0123456789abcdef0123456789abcdef"
+        digest = miniwdl_s3upload.content_digest(self.cfg, "s3://bucket/kms")
+        self.assertEqual(digest, miniwdl_s3upload.content_digest(self.cfg, fn))
+        # reloaded from registry_dir by another process
+        miniwdl_s3upload._s3_content_digests = None
+        self.assertEqual(miniwdl_s3upload.content_digest(self.cfg, "s3://bucket/kms"), digest)
+        self.assertEqual(self.client.count("get_object"), 1)
+
+
+class TestCollectCallCache(unittest.TestCase):
+    def test_collect(self):
+        now = datetime.now(timezone.utc)
+        objects = {
+            "run/cache/task/live.json": b'{"out": "s3://bucket/run/live.txt"}',
+            "run/cache/task/dangling.json": b'{"out": ["s3://bucket/run/expired.txt"]}',
+            "run/cache/task/undeletable.json": b'{"out": "s3://bucket/run/expired.txt"}',
+            "run/cache/task/old.json": b"{}",
+        }
+        client = FakeS3(dict(objects))
+        client.last_modified = {key: now - timedelta(days=100 if "old" in key else 1) for key in objects}
+        client.errors[("delete_objects", "run/cache/task/undeletable.json")] = "AccessDenied"
+        exists = {"s3://bucket/run/live.txt": True, "s3://bucket/run/expired.txt": False}
+        with mock.patch.object(miniwdl_s3upload, "s3_client", client), mock.patch.object(
+            miniwdl_s3upload, "s3_objects_exist", lambda cfg, uris: {uri: exists[uri] for uri in uris}
+        ):
+            live, dead = miniwdl_s3upload.collect_call_cache(
+                loader(), logger, "s3://bucket/run", max_age=timedelta(days=30)
+            )
+        self.assertEqual((live, dead), (1, 2))
+        self.assertEqual(
+            sorted(set(objects) - set(client.objects)), ["run/cache/task/dangling.json", "run/cache/task/old.json"]
+        )
+
+
+class TestSeedDownloadCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cfg = loader()
+        self.cfg.override({"download_cache": {"put": True, "dir": os.path.join(self.tmp.name, "cache")}})
+        self.fn = os.path.join(self.tmp.name, "out.txt")
+        with open(self.fn, "w") as outfile:
+            outfile.write("hello")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def seed(self):
+        miniwdl_s3upload.seed_download_cache(self.cfg, logger, self.fn, "s3://bucket/run/out.txt")
+        cache_path = os.path.join(self.tmp.name, "cache", "files", "s3", "bucket", "_run", "out.txt")
+        with open(cache_path) as infile:
+            self.assertEqual(infile.read(), "hello")
+        self.assertEqual(os.listdir(os.path.dirname(cache_path)), ["out.txt"])
+        return cache_path
+
+    def test_hardlink(self):
+        self.assertEqual(os.stat(self.seed()).st_ino, os.stat(self.fn).st_ino)
+
+    def test_copy_across_filesystems(self):
+        def exdev(*args):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+        with mock.patch.object(miniwdl_s3upload.os, "link", exdev), mock.patch.object(
+            miniwdl_s3upload.fcntl, "ioctl", exdev
+        ):
+            self.assertNotEqual(os.stat(self.seed()).st_ino, os.stat(self.fn).st_ino)
+
+
+if __name__ == "__main__":
+    unittest.main()
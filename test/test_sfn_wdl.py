@@ -0,0 +1,267 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import unittest
+from os.path import dirname, join, realpath
+from typing import Any, Dict, List
+from unittest import mock
+
+import botocore
+import WDL
+from WDL.runtime import config
+
+sys.path.insert(0, join(dirname(dirname(realpath(__file__))), "miniwdl-plugins", "sfn_wdl"))
+
+import sfnwdl_miniwdl_plugin  # type: ignore  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+class FakeObject:
+    def __init__(self, objects: Dict[str, bytes], uri: str):
+        self.objects = objects
+        self.uri = uri
+
+    def get(self):
+        if self.uri not in self.objects:
+            raise botocore.exceptions.ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": mock.Mock(read=lambda: self.objects[self.uri])}
+
+    def put(self, Body):
+        self.objects[self.uri] = Body
+
+
+class TestStatusWriter(unittest.TestCase):
+    status_uri = "s3://bucket/out/test_status2.json"
+
+    def setUp(self):
+        self.objects: Dict[str, bytes] = {}
+        self.puts: List[str] = []
+        self.patches: List[Any] = [
+            mock.patch.object(sfnwdl_miniwdl_plugin, "s3_object", self.s3_object),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def s3_object(self, uri):
+        obj = FakeObject(self.objects, uri)
+        put = obj.put
+
+        def record_put(Body):
+            self.puts.append(uri)
+            put(Body)
+
+        obj.put = record_put  # type: ignore
+        return obj
+
+    def status(self):
+        return json.loads(self.objects[self.status_uri])
+
+    def test_coalesced(self):
+        writer = sfnwdl_miniwdl_plugin.StatusWriter(logger, self.status_uri, 0.2)
+        writer.update("a", {"status": "running"})
+        writer.update("b", {"status": "running"})
+        writer.update("a", {"status": "uploaded"})
+        time.sleep(0.5)
+        self.assertEqual(len(self.puts), 1)
+        self.assertEqual(self.status(), {"a": {"status": "uploaded"}, "b": {"status": "running"}})
+
+    def test_flush(self):
+        # a resumed run keeps the statuses of the steps it doesn't rerun
+        self.objects[self.status_uri] = json.dumps({"old": {"status": "uploaded"}}).encode()
+        writer = sfnwdl_miniwdl_plugin.StatusWriter(logger, self.status_uri, 60)
+        writer.update("a", {"status": "running", "start_time": "1"})
+        writer.update("a", {"status": "pipeline_errored"})
+        writer.flush()
+        self.assertEqual(
+            self.status(),
+            {"old": {"status": "uploaded"}, "a": {"status": "pipeline_errored", "start_time": "1"}},
+        )
+        writer.flush()
+        self.assertEqual(len(self.puts), 1)
+
+    def test_failed_put_retried(self):
+        writer = sfnwdl_miniwdl_plugin.StatusWriter(logger, self.status_uri, 60)
+        writer.update("a", {"status": "running"})
+        with mock.patch.object(FakeObject, "get", side_effect=RuntimeError("S3 unavailable")):
+            writer.flush()
+        self.assertEqual(self.puts, [])
+        writer.update("b", {"status": "running"})
+        writer.flush()
+        self.assertEqual(self.status(), {"a": {"status": "running"}, "b": {"status": "running"}})
+
+    def test_update_status_json(self):
+        cfg = mock.Mock(has_option=lambda section, key: False)
+        with mock.patch.dict(os.environ, {"OUTPUT_STATUS_JSON_FILES": "true"}), mock.patch.object(
+            sfnwdl_miniwdl_plugin, "_status_writers", {}
+        ):
+            for step_name in ("a", "b"):
+                sfnwdl_miniwdl_plugin.update_status_json(
+                    logger, cfg, step_name, ["call_test", "call-" + step_name], "s3://bucket/out", {"status": "running"}
+                )
+            self.assertEqual(len(sfnwdl_miniwdl_plugin._status_writers), 1)
+            sfnwdl_miniwdl_plugin.flush_status_json()
+        self.assertEqual(self.puts, [self.status_uri])
+        self.assertEqual(self.status(), {"a": {"status": "running"}, "b": {"status": "running"}})
+
+
+class TestStderrRateLimiter(unittest.TestCase):
+    def limiter(self, **options):
+        cfg = config.Loader(logger)
+        cfg.override({"sfn_wdl": options})
+        return sfnwdl_miniwdl_plugin.StderrRateLimiter(cfg)
+
+    def test_burst(self):
+        limiter = self.limiter(stderr_lines_per_second=1, stderr_burst_lines=10)
+        allowed = sum(limiter.allow() for _ in range(100))
+        self.assertEqual(allowed, 10)
+        self.assertEqual(limiter.suppressed, 90)
+
+    def test_refill(self):
+        limiter = self.limiter(stderr_lines_per_second=100, stderr_burst_lines=5)
+        self.assertEqual(sum(limiter.allow() for _ in range(10)), 5)
+        # refilled at the rate, up to the burst
+        limiter.t_last -= 0.03
+        self.assertEqual(sum(limiter.allow() for _ in range(10)), 3)
+        limiter.t_last -= 60
+        self.assertEqual(sum(limiter.allow() for _ in range(10)), 5)
+        self.assertEqual(limiter.suppressed, 17)
+
+    def test_unlimited(self):
+        limiter = self.limiter(stderr_lines_per_second=0, stderr_burst_lines=1)
+        self.assertTrue(all(limiter.allow() for _ in range(100)))
+        self.assertEqual(limiter.suppressed, 0)
+
+
+class FakeDockerContainer:
+    def __init__(self, work_dir, samples):
+        self.attrs = {"Mounts": [{"Source": work_dir}], "State": {"StartedAt": "2021-01-01T00:00:00.5Z"}}
+        self.samples = samples
+
+    def stats(self, stream, one_shot):
+        return self.samples.pop(0)
+
+
+class TestTaskProfiler(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.tmp.name, "scratch"), "wb") as outfile:
+            outfile.write(os.urandom(1024 * 1024))
+        self.container = mock.Mock(run_id="call-t", host_work_dir=lambda: self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def stats(self, cpu_seconds, usage_gb, cache_gb, read_gb):
+        gib = 2 ** 30
+        return {
+            "cpu_stats": {"cpu_usage": {"total_usage": int(cpu_seconds * 1e9)}},
+            "memory_stats": {"usage": int(usage_gb * gib), "stats": {"inactive_file": int(cache_gb * gib)}},
+            "blkio_stats": {"io_service_bytes_recursive": [{"op": "Read", "value": int(read_gb * gib)}]},
+        }
+
+    def test_summary(self):
+        cfg = config.Loader(logger)
+        cfg.override({"sfn_wdl": {"profile_interval_seconds": 3600}})
+        ctr = FakeDockerContainer(
+            self.tmp.name, [self.stats(10, 2, 1, 1), self.stats(20, 4, 3.5, 2), {"memory_stats": {}}]
+        )
+        client = mock.Mock()
+        client.containers.list.return_value = [ctr]
+        with mock.patch.object(sfnwdl_miniwdl_plugin.docker, "from_env", side_effect=RuntimeError("no docker")):
+            profiler = sfnwdl_miniwdl_plugin.TaskProfiler(cfg, logger, self.container)
+            self.assertTrue(profiler._sample(client))
+            self.assertTrue(profiler._sample(client))
+            # the container exited
+            self.assertFalse(profiler._sample(client))
+            summary = profiler.stop()
+        self.assertEqual(profiler.started_at, 1609459200.5)
+        self.assertEqual(summary["cpu_seconds"], 20)
+        # excluding reclaimable page cache
+        self.assertEqual(summary["peak_memory_gb"], 1)
+        self.assertEqual(summary["read_gb"], 2)
+        self.assertGreaterEqual(profiler._peak_scratch, 1024 * 1024)
+        self.assertEqual(summary["samples"], 2)
+
+    def test_disabled(self):
+        cfg = config.Loader(logger)
+        cfg.override({"sfn_wdl": {"profile_interval_seconds": 0}})
+        self.assertEqual(sfnwdl_miniwdl_plugin.TaskProfiler(cfg, logger, self.container).stop(), {})
+
+
+timeline_wdl = """
+version 1.0
+workflow test {
+  call t as a
+  call t as b { input: x = a.out }
+  call t as c
+  scatter (i in [1, 2]) {
+    call t as d { input: x = b.out }
+  }
+  Int total = length(d.out) + c.out
+  call t as e { input: x = total }
+}
+
+task t {
+  input {
+    Int x = 0
+  }
+  command <<<>>>
+  output {
+    Int out = x + 1
+  }
+}
+"""
+
+
+class TestTimeline(unittest.TestCase):
+    def setUp(self):
+        doc = WDL.parse_document(timeline_wdl)
+        doc.typecheck()
+        self.workflow = doc.workflow
+
+    def test_call_dependencies(self):
+        self.assertEqual(sfnwdl_miniwdl_plugin.call_dependencies(self.workflow, "call-a"), set())
+        self.assertEqual(sfnwdl_miniwdl_plugin.call_dependencies(self.workflow, "call-d"), {"call-b"})
+        # through the declaration and the scatter's gather, stopping at the nearest calls
+        self.assertEqual(
+            sfnwdl_miniwdl_plugin.call_dependencies(self.workflow, "call-e"), {"call-c", "call-d"}
+        )
+
+    def test_critical_path(self):
+        run_id = "call_test"
+        t_0 = 1000.0
+        for call, start, end in [
+            ("call-a", 0, 10),
+            ("call-b", 10, 20),
+            ("call-c", 0, 25),
+            ("call-d-0", 20, 30),
+            ("call-d-1", 20, 40),
+            ("call-e", 40, 45),
+        ]:
+            sfnwdl_miniwdl_plugin.record_timeline(
+                [run_id, call], [("download inputs", t_0 + start, t_0 + start + 1), ("run", t_0 + start + 1, t_0 + end)]
+            )
+        with tempfile.TemporaryDirectory() as run_dir:
+            sfnwdl_miniwdl_plugin.write_timeline(logger, [run_id], run_dir, self.workflow, "", t_0)
+            with open(os.path.join(run_dir, "test_timeline.json")) as infile:
+                timeline = json.load(infile)
+        self.assertEqual(
+            [(c["call"], c["seconds"]) for c in timeline["otherData"]["critical_path"]],
+            [("call-a", 10), ("call-b", 10), ("call-d", 20), ("call-e", 5)],
+        )
+        calls = [event for event in timeline["traceEvents"] if event["cat"] == "call"]
+        self.assertEqual(len(calls), 6)
+        self.assertEqual(len(timeline["traceEvents"]), 18)
+        self.assertNotIn(run_id, sfnwdl_miniwdl_plugin._timelines)
+
+
+if __name__ == "__main__":
+    unittest.main()
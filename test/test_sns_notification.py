@@ -0,0 +1,119 @@
+import json
+import logging
+import sys
+import unittest
+from os.path import dirname, join, realpath
+from typing import Any, List
+from unittest import mock
+
+from .fakes import FakeS3
+
+sys.path.insert(0, join(dirname(dirname(realpath(__file__))), "miniwdl-plugins", "sns_notification"))
+
+import sns_notification  # type: ignore  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+attr = {"WorkflowName": {"DataType": "String", "StringValue": "call_test"}}
+
+
+class FakeSNS:
+    def __init__(self):
+        self.batches: List[List[str]] = []
+        self.published: List[str] = []
+        self.fail_ids: List[str] = []
+
+    def publish(self, TopicArn, Message, MessageAttributes):
+        self.published.append(Message)
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self.batches.append([entry["Message"] for entry in PublishBatchRequestEntries])
+        return {"Failed": [{"Id": id} for id in self.fail_ids]}
+
+
+class TestSNSNotification(unittest.TestCase):
+    def setUp(self):
+        self.sns = FakeSNS()
+        self.s3 = FakeS3()
+        self.patches: List[Any] = [
+            mock.patch.object(sns_notification, "sns_client", self.sns),
+            mock.patch.object(sns_notification, "s3_client", self.s3),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def message_body(self, outputs):
+        return {"detail-type": "Step Functions Execution Step Notification", "detail": json.dumps(outputs)}
+
+    def delivered(self):
+        return [json.loads(body) for batch in self.sns.batches for body in batch] + [
+            json.loads(body) for body in self.sns.published
+        ]
+
+    def test_offload_detail(self):
+        small = self.message_body({"test.t.out": "s3://bucket/out/a.txt"})
+        self.assertEqual(json.loads(sns_notification.offload_detail("s3://bucket/out", attr, small)), small)
+        self.assertEqual(self.s3.objects, {})
+
+        large = self.message_body({"test.t.out": [f"s3://bucket/out/{i}.txt" for i in range(20000)]})
+        body = json.loads(sns_notification.offload_detail("s3://bucket/out", attr, large))
+        self.assertEqual(body["detail-type"], large["detail-type"])
+        uri = json.loads(body["detail"])["swipe_offload_uri"]
+        self.assertTrue(uri.startswith("s3://bucket/out/sns_notifications/"))
+        self.assertEqual(self.s3.objects[uri[len("s3://bucket/"):]].decode(), large["detail"])
+        with self.assertRaises(AssertionError):
+            sns_notification.offload_detail(None, attr, large)
+
+    def test_batches(self):
+        messages = [(attr, json.dumps(self.message_body({"i": i}))) for i in range(10)]
+        sns_notification.NotificationQueue(logger)._publish(messages)
+        self.assertEqual([len(batch) for batch in self.sns.batches], [10])
+
+        # split to keep each request within the size limit
+        self.sns.batches = []
+        large = "x" * (100 * 1024)
+        messages = [(attr, json.dumps(self.message_body({"i": i, "large": large}))) for i in range(5)]
+        sns_notification.NotificationQueue(logger)._publish(messages)
+        self.assertEqual([len(batch) for batch in self.sns.batches], [2, 2])
+        self.assertEqual(len(self.sns.published), 1)
+
+    def test_failed_entries_published_individually(self):
+        self.sns.fail_ids = ["1"]
+        messages = [(attr, json.dumps(self.message_body({"i": i}))) for i in range(3)]
+        sns_notification.NotificationQueue(logger)._publish(messages)
+        self.assertEqual(len(self.sns.batches), 1)
+        self.assertEqual([json.loads(json.loads(body)["detail"]) for body in self.sns.published], [{"i": 1}])
+
+    def test_without_publish_batch(self):
+        client = mock.Mock(spec=["publish"])
+        with mock.patch.object(sns_notification, "sns_client", client), self.assertLogs(logger, "WARNING") as logs:
+            notifications = sns_notification.NotificationQueue(logger)
+            for i in range(3):
+                notifications.put("s3://bucket/out", attr, self.message_body({"i": i}))
+            notifications.flush()
+        self.assertEqual(client.publish.call_count, 3)
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn("publish_batch", logs.output[0])
+
+    def test_queue(self):
+        notifications = sns_notification.NotificationQueue(logger)
+        for i in range(25):
+            notifications.put("s3://bucket/out", attr, self.message_body({"i": i}))
+        large = self.message_body({"large": "x" * sns_notification.MAX_MESSAGE_BYTES})
+        notifications.put("s3://bucket/out", attr, large)
+        notifications.flush()
+        delivered = self.delivered()
+        self.assertEqual(len(delivered), 26)
+        self.assertEqual(
+            sorted(json.loads(body["detail"]).get("i", -1) for body in delivered), [-1] + list(range(25))
+        )
+        self.assertTrue(all(len(batch) <= sns_notification.MAX_BATCH_ENTRIES for batch in self.sns.batches))
+        self.assertEqual(len(self.s3.objects), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
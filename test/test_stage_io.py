@@ -0,0 +1,189 @@
+import json
+import os
+import sys
+import unittest
+from os.path import dirname, join, realpath
+from typing import Any, Dict, List
+from unittest import mock
+
+from .fakes import FakeS3
+
+sys.path.insert(
+    0, join(dirname(dirname(realpath(__file__))), "terraform", "modules", "sfn-io-helper-lambdas", "app")
+)
+
+from sfn_io_helper import config_cache, stage_io  # type: ignore  # noqa: E402
+
+with mock.patch.dict(os.environ, {"APP_NAME": "swipe-test"}):
+    import app  # type: ignore  # noqa: E402
+
+
+class StageIOTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeS3()
+        self.patches: List[Any] = [
+            mock.patch.object(stage_io.s3, "meta", mock.Mock(client=self.client)),
+            mock.patch.object(config_cache, "_cache", {}),
+            mock.patch.object(stage_io, "_offloaded", {}),
+            mock.patch.object(stage_io, "offload_threshold_bytes", 1024),
+            mock.patch.object(stage_io, "state_budget_bytes", 16384),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+
+class TestOffload(StageIOTestCase):
+    def state(self, **kwargs):
+        return {
+            "Input": {"Run": {"docker_image_id": "swipe"}},
+            "RUN_INPUT_URI": "s3://bucket/out/run_input.json",
+            "RUN_OUTPUT_URI": "s3://bucket/out/run_output.json",
+            **kwargs,
+        }
+
+    def test_offload(self):
+        sfn_state = self.state()
+        small = ["s3://bucket/out/a.txt"]
+        self.assertIs(stage_io.offload(sfn_state, small), small)
+        large = [f"s3://bucket/out/{i}.txt" for i in range(100)]
+        reference = stage_io.offload(sfn_state, large)
+        self.assertTrue(stage_io.is_offloaded(reference))
+        self.assertTrue(reference[stage_io.OFFLOAD_URI_KEY].startswith("s3://bucket/out/sfn_state/"))
+        self.assertEqual(stage_io.offload(sfn_state, reference), reference)
+        self.assertEqual(stage_io.resolve_offloaded({"x": [reference, small]}), {"x": [large, small]})
+
+    def test_batch_job_details_offloaded(self):
+        details = {"JobId": "1", "Attempts": []}
+        sfn_state = stage_io.trim_batch_job_details(self.state(BatchJobDetails={"Run": details}))
+        reference = sfn_state["BatchJobDetails"]["Run"]
+        self.assertTrue(stage_io.is_offloaded(reference))
+        self.assertEqual(stage_io.resolve_offloaded(reference), details)
+
+    def test_many_mid_sized_outputs(self):
+        # each output is under the offload threshold, but together they're over the state size budget
+        outputs: Dict[str, Any] = {
+            f"swipe.out{i}": [f"s3://bucket/out/{i}/{j}.txt" for j in range(30)] for i in range(40)
+        }
+        outputs["swipe.small"] = "s3://bucket/out/small.txt"
+        outputs["swipe.count"] = 40
+        for value in outputs.values():
+            self.assertLessEqual(len(json.dumps(value)), stage_io.offload_threshold_bytes)
+        self.assertGreater(len(json.dumps(outputs)), stage_io.state_budget_bytes)
+
+        sfn_state = self.state(BatchJobDetails={"Run": {"JobId": "1"}})
+        with mock.patch.object(stage_io, "get_stage_output", lambda sfn_state, stage: outputs):
+            sfn_state = stage_io.read_state_from_s3(sfn_state, "RunReadOutput")
+        sfn_state = stage_io.trim_batch_job_details(sfn_state)
+
+        self.assertLessEqual(len(json.dumps(sfn_state)), stage_io.state_budget_bytes)
+        # only as many as needed were offloaded, and the small values stay in the state
+        offloaded = [k for k, v in sfn_state["Result"].items() if stage_io.is_offloaded(v)]
+        self.assertGreater(len(offloaded), 0)
+        self.assertLess(len(offloaded), 40)
+        self.assertEqual(sfn_state["Result"]["swipe.small"], "s3://bucket/out/small.txt")
+        self.assertEqual(sfn_state["Result"]["swipe.count"], 40)
+        self.assertEqual(stage_io.resolve_offloaded(sfn_state["Result"]), outputs)
+
+    def test_largest_first(self):
+        outputs = {"swipe.large": ["x" * 100] * 90, "swipe.medium": ["x" * 100] * 40}
+        sfn_state = self.state(Result=outputs, BatchJobDetails={})
+        with mock.patch.object(stage_io, "state_budget_bytes", len(json.dumps(sfn_state)) - 1000):
+            sfn_state = stage_io.trim_batch_job_details(sfn_state)
+        self.assertTrue(stage_io.is_offloaded(sfn_state["Result"]["swipe.large"]))
+        self.assertEqual(sfn_state["Result"]["swipe.medium"], outputs["swipe.medium"])
+
+
+class TestLinkOutputs(StageIOTestCase):
+    stage_io_map = {"Two": {"hello_world": "out_world", "docker_image_id": ["One", "docker_image_id"]}}
+
+    def state(self, **kwargs):
+        return {
+            "Input": {"One": {"docker_image_id": "swipe"}, "Two": {}, "Three": {"x": 1}},
+            **{
+                f"{stage.upper()}_{io}_URI": f"s3://bucket/out/{stage.lower()}_{io.lower()}.json"
+                for stage in ("One", "Two", "Three")
+                for io in ("INPUT", "OUTPUT")
+            },
+            **kwargs,
+        }
+
+    def stage_input(self, stage):
+        return json.loads(self.client.objects[f"out/{stage}_input.json"])
+
+    def test_changed_only(self):
+        sfn_state = self.state()
+        stage_io.link_outputs(sfn_state, self.stage_io_map)
+        self.assertEqual(self.client.count("put_object"), 3)
+        self.assertEqual(self.stage_input("two"), {"docker_image_id": "swipe"})
+
+        sfn_state["Result"] = {"one.out_world": "s3://bucket/out/out_world.txt", "one.other": "x"}
+        stage_io.link_outputs(sfn_state, self.stage_io_map, changed_only=True)
+        self.assertEqual(self.client.count("put_object"), 4)
+        self.assertEqual(
+            self.stage_input("two"), {"docker_image_id": "swipe", "hello_world": "s3://bucket/out/out_world.txt"}
+        )
+
+        # nothing changed, so nothing written
+        stage_io.link_outputs(sfn_state, self.stage_io_map, changed_only=True)
+        self.assertEqual(self.client.count("put_object"), 4)
+
+    def test_offloaded_resolved(self):
+        large = [f"s3://bucket/out/{i}.txt" for i in range(100)]
+        sfn_state = self.state()
+        sfn_state["Result"] = {"one.out_world": stage_io.offload(sfn_state, large)}
+        stage_io.link_outputs(sfn_state, self.stage_io_map, changed_only=True)
+        # a reference in the state, but the value itself in the stage input
+        self.assertTrue(stage_io.is_offloaded(sfn_state["Input"]["Two"]["hello_world"]))
+        self.assertEqual(self.stage_input("two")["hello_world"], large)
+
+
+class TestConfigCache(StageIOTestCase):
+    uri = "s3://bucket/stage_io_map.json"
+    key = "stage_io_map.json"
+
+    def test_get_json(self):
+        self.client.objects[self.key] = json.dumps({"Two": {"hello_world": "out_world"}}).encode()
+        self.assertEqual(config_cache.get_json(self.uri), {"Two": {"hello_world": "out_world"}})
+        # served from memory within the TTL
+        config_cache.get_json(self.uri)
+        self.assertEqual(self.client.count("get_object"), 1)
+        with mock.patch.object(config_cache, "ttl_seconds", 0):
+            # revalidated, unchanged
+            self.assertEqual(config_cache.get_json(self.uri), {"Two": {"hello_world": "out_world"}})
+            self.assertEqual(self.client.count("get_object"), 2)
+            self.client.objects[self.key] = json.dumps({}).encode()
+            self.assertEqual(config_cache.get_json(self.uri), {})
+
+    def test_get_stage_io_map(self):
+        self.client.objects[self.key] = json.dumps({"Two": {}}).encode()
+        self.assertEqual(stage_io.get_stage_io_map({"STAGES_IO_MAP_JSON": self.uri}), {"Two": {}})
+        self.assertEqual(stage_io.get_stage_io_map({}), {})
+
+
+class TestProcessStageOutput(StageIOTestCase):
+    sfn_data = {"ExecutionId": "arn", "CurrentState": "RunReadOutput", "Input": {}}
+
+    def test_errors(self):
+        def fail(message):
+            def raise_error(*args, **kwargs):
+                raise RuntimeError(message)
+
+            return raise_error
+
+        with mock.patch.object(stage_io, "broadcast_stage_complete", fail("broadcast failed")):
+            with mock.patch.object(stage_io, "read_state_from_s3", fail("read failed")):
+                # the read error is raised, and the broadcast error logged rather than lost
+                with self.assertRaisesRegex(RuntimeError, "read failed"), self.assertLogs(level="ERROR") as logs:
+                    app.process_stage_output(self.sfn_data, None)
+                self.assertIn("broadcast failed", logs.output[0])
+            with mock.patch.object(stage_io, "read_state_from_s3", lambda sfn_state, current_state: {"Input": {}}):
+                with self.assertRaisesRegex(RuntimeError, "broadcast failed"):
+                    app.process_stage_output(self.sfn_data, None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -229,6 +229,50 @@ task add_smile {
 }
 """
 
+test_list_wdl = """
+version 1.0
+workflow list_test {
+  input {
+    File hello
+    String docker_image_id
+  }
+
+  scatter (suffix in ["a", "b", "c"]) {
+    call add_suffix {
+      input:
+        input_file = hello,
+        suffix = suffix,
+        docker_image_id = docker_image_id
+    }
+  }
+
+  output {
+    Array[File] out_suffixed = add_suffix.out_suffixed
+  }
+}
+
+task add_suffix {
+  input {
+    File input_file
+    String suffix
+    String docker_image_id
+  }
+
+  command <<<
+    cat ~{input_file} > out_~{suffix}.txt
+    echo ~{suffix} >> out_~{suffix}.txt
+  >>>
+
+  output {
+    File out_suffixed = "out_~{suffix}.txt"
+  }
+
+  runtime {
+      docker: docker_image_id
+  }
+}
+"""
+
 test_stage_io_map = {
     "Two": {
         "hello_world": "out_world",
@@ -257,6 +301,8 @@ class TestSFNWDL(unittest.TestCase):
         self.wdl_fail_obj.put(Body=test_fail_wdl.encode())
         self.wdl_two_obj = self.test_bucket.Object("test-two-v1.0.0.wdl")
         self.wdl_two_obj.put(Body=test_two_wdl.encode())
+        self.wdl_list_obj = self.test_bucket.Object("test-list-v1.0.0.wdl")
+        self.wdl_list_obj.put(Body=test_list_wdl.encode())
         self.wdl_obj_temp = self.test_bucket.Object("test-temp-v1.0.0.wdl")
         self.wdl_obj_temp.put(
             Body=test_wdl_temp.replace("swipe_test", "temp_test").encode()
@@ -577,6 +623,60 @@ class TestSFNWDL(unittest.TestCase):
         output_text = outputs_obj.get()["Body"].read().decode()
         self.assertEqual(output_text, "cache_break\nfarewell\n")
 
+    def test_call_cache_stale_hit(self):
+        output_prefix = "out-stale"
+        sfn_input: Dict[str, Any] = {
+            "RUN_WDL_URI": f"s3://{self.wdl_obj.bucket_name}/{self.wdl_obj.key}",
+            "OutputPrefix": f"s3://{self.input_obj.bucket_name}/{output_prefix}",
+            "Input": {
+                "Run": {
+                    "hello": f"s3://{self.input_obj.bucket_name}/{self.input_obj.key}",
+                    "docker_image_id": "ubuntu",
+                }
+            },
+        }
+
+        self._wait_sfn(sfn_input, self.single_sfn_arn)
+
+        # as if removed by a lifecycle rule, leaving the call cache entries that reference it
+        self.test_bucket.Object(f"{output_prefix}/test-1/out_world.txt").delete()
+        self.test_bucket.Object(f"{output_prefix}/test-1/run_output.json").delete()
+
+        self._wait_sfn(sfn_input, self.single_sfn_arn)
+
+        # the stale hit was treated as a miss, so add_world ran again
+        outputs_obj = self.test_bucket.Object(f"{output_prefix}/test-1/out_world.txt")
+        output_text = outputs_obj.get()["Body"].read().decode()
+        self.assertEqual(output_text, "hello\nworld\n")
+
+    def test_list_outputs(self):
+        output_prefix = "out-list"
+        sfn_input: Dict[str, Any] = {
+            "RUN_WDL_URI": f"s3://{self.wdl_list_obj.bucket_name}/{self.wdl_list_obj.key}",
+            "OutputPrefix": f"s3://{self.input_obj.bucket_name}/{output_prefix}",
+            "Input": {
+                "Run": {
+                    "hello": f"s3://{self.input_obj.bucket_name}/{self.input_obj.key}",
+                    "docker_image_id": "ubuntu",
+                }
+            },
+        }
+
+        _, description, _, step_messages = self._wait_sfn(sfn_input, self.single_sfn_arn)
+
+        # list outputs are kept in the stage result
+        output = json.loads(description["output"])
+        self.assertEqual(
+            output["Result"],
+            {
+                "list_test.out_suffixed": [
+                    f"s3://{self.input_obj.bucket_name}/{output_prefix}/test-list-1/out_{suffix}.txt"
+                    for suffix in "abc"
+                ],
+            },
+        )
+        self.assertEqual(len(step_messages), 3)
+
     def test_zip_wdls(self):
         output_prefix = "zip-output"
         sfn_input: Dict[str, Any] = {